@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import os
+
+import telethon
+
+from metrics import STAGE_SECONDS
+from models import ChatAvatar
+
+# pylint: disable=missing-class-docstring, missing-function-docstring, invalid-name
+
+logger = logging.getLogger('bridge.avatars')
+
+
+def _load(session):
+    return session.query(ChatAvatar.chatid, ChatAvatar.photoid, ChatAvatar.url).all()
+
+def _store(session, chatid, photoid, url):
+    session.merge(ChatAvatar(chatid=chatid, photoid=photoid, url=url))
+
+
+class AvatarCache:
+    """
+    Maps Telegram chat ids to the public URL of the chat's current profile photo.
+
+    Entries are keyed by Telegram's photo id and persisted in the database, so a profile photo is
+    only downloaded and uploaded again when the chat changes it.
+    """
+
+    def __init__(self, sqlexec, cache_dir, upload):
+        self.sqlexec = sqlexec
+        self.cache_dir = cache_dir
+        self.upload = upload  # coroutine function uploading a file in `cache_dir` by name, returning its URL
+        self._avatars = {}  # chat id -> (photo id, url), url is None if the photo couldn't be downloaded
+        self._inflight = {}
+
+    async def load(self):
+        for chatid, photoid, url in await self.sqlexec.run(_load):
+            self._avatars[chatid] = (photoid, url)
+        logger.debug(f'Loaded {len(self._avatars)} cached profile photos')
+
+    async def resolve(self, tgclient, chat):
+        """Public URL of `chat`'s profile photo, or None if it has none."""
+        photo = getattr(chat, 'photo', None)
+        if photo is None or isinstance(photo, (telethon.types.ChatPhotoEmpty, telethon.types.UserProfilePhotoEmpty)):
+            return None
+
+        chatid = telethon.utils.get_peer_id(chat)
+        cached = self._avatars.get(chatid)
+        if cached is not None and cached[0] == photo.photo_id:
+            return cached[1]
+
+        key = (chatid, photo.photo_id)
+        fetch = self._inflight.get(key)
+        if fetch is None:
+            fetch = asyncio.ensure_future(self._fetch(tgclient, chat, chatid, photo.photo_id))
+            self._inflight[key] = fetch
+            fetch.add_done_callback(lambda _: self._inflight.pop(key, None))
+
+        return await asyncio.shield(fetch)
+
+    async def _fetch(self, tgclient, chat, chatid, photoid):
+        # Channel icons can be assumed to be JPEGs for the foreseeable future.
+        # The photo id is part of the name so Discord doesn't keep showing an old icon from its cache.
+        filename = f"{chatid}-{photoid}.jpg"
+        with STAGE_SECONDS.time(stage='avatar_download'):
+            path = await tgclient.download_profile_photo(chat, file=os.path.join(self.cache_dir, filename))
+        if path is None:
+            # e.g. removed since the chat was fetched, not asked for again until the photo id changes
+            self._avatars[chatid] = (photoid, None)
+            logger.debug(f'Profile photo {photoid} of {chatid} could not be downloaded')
+            return None
+
+        url = await self.upload(filename)
+        self._avatars[chatid] = (photoid, url)
+        await self.sqlexec.run(_store, chatid, photoid, url)
+        logger.debug(f'Profile photo of {chatid} changed to {photoid}')
+        return url
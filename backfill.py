@@ -0,0 +1,139 @@
+import asyncio
+import logging
+
+import telethon
+from sqlalchemy import select
+
+from database import insert
+from models import ChannelWatermark
+
+# pylint: disable=missing-class-docstring, missing-function-docstring, invalid-name
+
+logger = logging.getLogger('bridge.backfill')
+
+
+def get_marks(session, shard):
+    """Id of the newest delivered message of every chat `shard` delivered to, by chat id."""
+    return dict(session.execute(select(ChannelWatermark.channelid, ChannelWatermark.messageid).where(ChannelWatermark.shard == shard)).all())
+
+def advance(session, shard, channelid, messageid):
+    """Move the watermark of `channelid` up to `messageid`, it never moves back for retries delivered late."""
+    stmt = insert(session, ChannelWatermark).values(shard=shard, channelid=channelid, messageid=messageid)
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=["shard", "channelid"],
+        set_={"messageid": stmt.excluded.messageid},
+        where=ChannelWatermark.__table__.c.messageid < stmt.excluded.messageid
+    ))
+
+def group_albums(messages):
+    """Split messages, oldest first, into the messages of each album and single messages."""
+    batch = []
+    for message in messages:
+        if batch and not (message.grouped_id and message.grouped_id == batch[0].grouped_id):
+            yield batch
+            batch = []
+        batch.append(message)
+
+    if batch:
+        yield batch
+
+
+class Backfiller:
+    """
+    Catches up on messages posted while the bridge was down or disconnected.
+
+    Every delivered message moves the watermark of its chat (see `advance`). Backfilling pages
+    through everything newer than the watermark, oldest first, and hands it to `enqueue` just like
+    the event handlers do, so missed messages go through the delivery queue in order and the
+    ledger drops the ones that were delivered after all. Chats are backfilled in parallel, each
+    one page at a time with a pause in between to stay clear of Telegram's flood limits.
+    """
+
+    def __init__(self, sqlexec, shard, enqueue, workers=4, max_messages=1000, page_size=100, page_wait=1.0):
+        self.sqlexec = sqlexec
+        self.shard = shard
+        self.enqueue = enqueue  # enqueue(channelid, messages), e.g. DeliveryQueue.enqueue
+        self.workers = workers
+        self.max_messages = max_messages
+        self.page_size = page_size
+        self.page_wait = page_wait
+
+    async def run(self, tgclient, channelids):
+        """Backfill `channelids`, chats nothing was delivered from yet have no watermark and are skipped."""
+        marks = await self.sqlexec.run(get_marks, self.shard)
+        pending = [(channelid, marks[channelid]) for channelid in channelids if channelid in marks]
+        if not pending:
+            return
+
+        slots = asyncio.Semaphore(self.workers)
+
+        async def backfill(channelid, mark):
+            async with slots:
+                try:
+                    return await self.channel(tgclient, channelid, mark)
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception(f'Unable to backfill chat {channelid}, messages missed since {mark} will not be delivered')
+                    return 0
+
+        counts = await asyncio.gather(*(backfill(channelid, mark) for channelid, mark in pending))
+        logger.info(f'Backfilled {sum(counts)} missed messages from {sum(1 for count in counts if count)} of {len(pending)} chats')
+
+    async def channel(self, tgclient, channelid, mark):
+        """Enqueue the messages of `channelid` newer than `mark`, oldest first. Returns the number of messages enqueued."""
+        latest = await tgclient.get_messages(channelid, limit=1)
+        if not latest or latest[0].id <= mark:
+            return 0
+
+        # ids in a chat are (close to) sequential, so this skips all but the newest max_messages
+        start = max(mark, latest[0].id - self.max_messages)
+        if start > mark:
+            logger.warning(f'Chat {channelid} missed {latest[0].id - mark} messages, only the newest {self.max_messages} are backfilled')
+
+        count, carry = 0, []
+        while True:
+            try:
+                page = await tgclient.get_messages(channelid, min_id=start, limit=self.page_size, reverse=True)
+            except telethon.errors.FloodWaitError as err:
+                logger.warning(f'Flood wait while backfilling chat {channelid}, pausing for {err.seconds} seconds')
+                await asyncio.sleep(err.seconds)
+                continue
+
+            done = len(page) < self.page_size
+            batches = list(group_albums(carry + [message for message in page if not isinstance(message, telethon.types.MessageService)]))
+            # an album at the end of a full page may go on in the next one
+            carry = batches.pop() if batches and not done and batches[-1][0].grouped_id else []
+
+            for batch in batches:
+                await self.enqueue(channelid, batch)
+                count += len(batch)
+
+            if done:
+                return count
+
+            start = page[-1].id
+            await asyncio.sleep(self.page_wait)
+
+    async def watch(self, tgclient, channels):
+        """Backfill `channels()` every time the client reconnects to Telegram on its own, until cancelled."""
+        # Telethon has no reconnect event, but its sender calls the client back once it reconnected.
+        sender = tgclient._sender  # pylint: disable=protected-access
+        callback = sender._auto_reconnect_callback  # pylint: disable=protected-access
+        reconnected = asyncio.Event()
+
+        async def on_reconnect():
+            reconnected.set()
+            if callback:
+                await callback()
+
+        sender._auto_reconnect_callback = on_reconnect  # pylint: disable=protected-access
+        try:
+            while True:
+                await reconnected.wait()
+                reconnected.clear()  # a reconnect during the backfill is caught up on by the next one
+                logger.info('Reconnected to Telegram, backfilling missed messages..')
+                try:
+                    await self.run(tgclient, channels())
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception('Unable to backfill after reconnecting, messages missed while disconnected will not be delivered')
+        finally:
+            sender._auto_reconnect_callback = callback  # pylint: disable=protected-access
@@ -0,0 +1,145 @@
+"""
+Benchmarks for the bridge against a seeded database and a fake Discord.
+
+    python -m benchmarks.bench_bridge [--min-time SECONDS] [--channels N] [--webhooks N]
+
+Runs on a new SQLite database unless BENCH_DBURL points at a scratch database, e.g. a local
+Postgres. The database is filled with a routing table, so never point it at a real one.
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import tempfile
+
+import yaml
+from telethon import events
+from sqlalchemy import create_engine, delete
+
+from benchmarks import fixtures
+from benchmarks.bench_format import synthetic_post
+from benchmarks.harness import measure, measure_async, report
+
+# pylint: disable=missing-class-docstring, missing-function-docstring, invalid-name
+
+def load_bridge(dburl, workdir):
+    """Import bridge.py configured for the benchmark database, with local storage under `workdir`."""
+    config = {
+        "telegram": {"api_id": 1, "api_hash": "bench", "sessionfile": os.path.join(workdir, "bench.session")},
+        "storage": {
+            "cache_dir": workdir + os.sep,
+            "local": {"enabled": True, "file_prefix": workdir, "url_prefix": "http://localhost/media"},
+            "b2": {"enabled": False, "api_id": "", "api_key": "", "url_prefix": "", "bucket_name": "bench"},
+        },
+        "dburl": dburl,
+    }
+    path = os.path.join(workdir, "config.yml")
+    with open(path, "w") as f:
+        yaml.safe_dump(config, f)
+
+    os.environ["CONFIG"] = path
+    import bridge  # pylint: disable=import-outside-toplevel
+    import schema  # pylint: disable=import-outside-toplevel
+    schema.upgrade(bridge.sqlengine)
+    logging.getLogger('bridge').setLevel(logging.WARNING)  # keep per-message logging out of the measurements
+    return bridge
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="tgbridge-bench-")
+    dburl = fixtures.database_url()
+    discord = fixtures.FakeDiscord()
+
+    bridge = load_bridge(dburl, workdir)
+    session = bridge.sqlsessionmaker()
+    channelids = fixtures.seed_routing(session, channels=args.channels, webhooks=args.webhooks, url=discord.url)
+    session.close()
+
+    results = []
+    tgclient = fixtures.FakeTelegramClient()
+    min_time = args.min_time
+
+    # routing
+    results.append(await measure_async("routing/load", bridge.routes.refresh, min_time=min_time,
+                                       extra={"channels": args.channels, "webhooks": args.webhooks}))
+
+    hot = fixtures.make_message(tgclient, fixtures.make_channel(channelids[0], "Hot"), 1)
+    unwatched = fixtures.make_message(tgclient, fixtures.make_channel(fixtures.marked_id(10 ** 9), "Unknown"), 1)
+    results.append(measure("is_watched/watched", lambda: bridge.is_watched(hot), min_time=min_time,
+                           extra={"webhooks": len(bridge.is_watched(hot))}))
+    results.append(measure("is_watched/unknown", lambda: bridge.is_watched(unwatched), min_time=min_time))
+
+    # dialog sync, the first run after seeding only compares names, later runs stop at the watermark
+    key = f'dialogs:{bridge.settings.telegram.sessionfile}'
+    full = fixtures.FakeTelegramClient(fixtures.make_dialogs(args.channels))
+
+    async def sync_full():
+        await bridge.sqlexec.run(lambda session: session.execute(delete(bridge.dialogs.BridgeState)))
+        await bridge.sync_dialogs(full)
+
+    results.append(await measure_async("sync_dialogs/full", sync_full, min_time=min_time, min_iterations=5,
+                                       extra={"dialogs": args.channels}))
+
+    incremental = fixtures.FakeTelegramClient(fixtures.make_dialogs(args.channels, renamed=20))
+    async def sync_incremental():
+        await bridge.sqlexec.run(bridge.dialogs.set_watermark, key, incremental.dialogs[19].date)
+        await bridge.sync_dialogs(incremental)
+
+    results.append(await measure_async("sync_dialogs/incremental", sync_incremental, min_time=min_time,
+                                       extra={"dialogs": args.channels, "scanned": 20}))
+
+    await discord.start()
+    try:
+        # the whole delivery of one post to every webhook watching the hottest channel
+        channel = fixtures.make_channel(channelids[0], "Hot channel", username="hot")
+        origin = fixtures.make_channel(fixtures.marked_id(42), "Origin", username="origin")
+        post = synthetic_post(10)
+        messageids = itertools.count(1)
+
+        def next_message():
+            return fixtures.make_message(tgclient, channel, next(messageids), post.message, post.entities, forward_from=origin)
+
+        async def deliver():
+            await bridge.deliver(tgclient, [next_message()])
+
+        watchers = len(bridge.is_watched(next_message()))
+        results.append(await measure_async("deliver", deliver, min_time=min_time, extra={"webhooks": watchers}))
+
+        # on_message through the delivery queue until the last webhook answered
+        done = {}
+        async def deliver_job(channelid, ids, messages):
+            try:
+                await bridge.deliver_job(tgclient, channelid, ids, messages)
+            finally:
+                done.pop((channelid, ids[0])).set_result(None)
+
+        workers = asyncio.ensure_future(bridge.deliveries.run(deliver_job))
+
+        async def on_message():
+            message = next_message()
+            delivered = done[(message.chat_id, message.id)] = asyncio.get_running_loop().create_future()
+            await bridge.on_message(events.NewMessage.Event(message))
+            await delivered
+
+        results.append(await measure_async("on_message", on_message, min_time=min_time, extra={"webhooks": watchers}))
+        workers.cancel()
+    finally:
+        await discord.stop()
+        await bridge.dispatcher.close()
+
+    dialect = create_engine(dburl).dialect.name
+    for result in results:
+        result["database"] = dialect
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--min-time", type=float, default=1.0, help="seconds to run each benchmark for")
+    parser.add_argument("--channels", type=int, default=5000, help="Telegram channels in the routing table")
+    parser.add_argument("--webhooks", type=int, default=300, help="webhooks in the routing table")
+    args = parser.parse_args()
+
+    report(asyncio.run(run(args)))
+
+if __name__ == "__main__":
+    main()
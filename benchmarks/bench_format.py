@@ -0,0 +1,93 @@
+"""
+Micro-benchmarks for rendering Telegram messages to Discord markdown.
+
+    python -m benchmarks.bench_format [--min-time SECONDS]
+"""
+import argparse
+import asyncio
+import random
+
+from telethon import types
+
+from formatting import format_message, format_forwarding, forward_origins
+from benchmarks.fixtures import FakeTelegramClient, make_channel, make_message, marked_id
+from benchmarks.harness import measure, measure_async, report
+
+# pylint: disable=missing-class-docstring, missing-function-docstring, invalid-name
+
+WORDS = ["breaking", "news", "the", "report", "says", "officials", "near", "border", "update", "via",
+         "sources", "said", "*", "_", "ещё", "сообщают", "🇺🇦", "🔥"]
+
+def synthetic_post(entity_count, seed=0):
+    """A news-style post with `entity_count` links, mentions and formatting spans, some of them nested."""
+    rng = random.Random(seed)
+    parts, entities = [], []
+    offset = 0
+
+    def add(text):
+        nonlocal offset
+        start = offset
+        parts.append(text)
+        offset += len(text.encode("utf-16-le")) // 2
+        return start, offset - start
+
+    for i in range(entity_count):
+        add(" ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 12))) + " ")
+
+        kind = i % 5
+        if kind == 0:
+            entities.append(types.MessageEntityUrl(*add(f"example{i}.com/news/{i}")))
+        elif kind == 1:
+            entities.append(types.MessageEntityTextUrl(*add(f"source {i}"), url=f"https://example.com/{i}"))
+        elif kind == 2:
+            entities.append(types.MessageEntityMention(*add(f"@channel_{i}")))
+        elif kind == 3:
+            start, length = add(f"important {rng.choice(WORDS)} words")
+            entities.append(types.MessageEntityBold(start, length))
+            entities.append(types.MessageEntityItalic(start + 10, length - 10))
+        else:
+            entities.append(types.MessageEntityCode(*add(f"code_{i}()")))
+
+        if i % 10 == 9:
+            add("\n\n")
+
+    return types.Message(id=1, peer_id=types.PeerChannel(1), date=None, message="".join(parts), entities=entities)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--min-time", type=float, default=1.0, help="seconds to run each benchmark for")
+    args = parser.parse_args()
+
+    results = []
+    for name, count in (("plain", 0), ("short", 10), ("long", 300), ("dense", 1500)):
+        message = synthetic_post(count)
+        if not count:
+            message.message = message.message or " ".join(WORDS * 50)
+        result = measure(f"format_message/{name}", lambda message=message: format_message(message), min_time=args.min_time,
+                         extra={"chars": len(message.message), "entities": len(message.entities or ())})
+        result["chars_per_sec"] = round(result["ops_per_sec"] * result["chars"])
+        results.append(result)
+
+    # forward headers, resolving the origin once and then from the cache
+    tgclient = FakeTelegramClient()
+    origin = make_channel(marked_id(42), "Origin", username="origin")
+    forwarded = make_message(tgclient, make_channel(marked_id(1), "Channel"), 1, "text", forward_from=origin)
+
+    async def forwarding_cold():
+        forward_origins.clear()
+        await format_forwarding(forwarded)
+
+    async def forwarding_warm():
+        await format_forwarding(forwarded)
+
+    async def run_async():
+        return [
+            await measure_async("format_forwarding/uncached", forwarding_cold, min_time=args.min_time),
+            await measure_async("format_forwarding/cached", forwarding_warm, min_time=args.min_time),
+        ]
+
+    results += asyncio.run(run_async())
+    report(results)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""
+Storage and join cost of the schema before and after the bigint key migration.
+
+    python -m benchmarks.bench_schema [--min-time SECONDS] [--messages N] [--fanout N]
+
+Seeds a database with the uuid keyed layout of schema version 0, measures table sizes and the
+routing and ledger joins, migrates it in place like a starting bridge would and measures again.
+Runs on a new SQLite database unless BENCH_DBURL points at a scratch database, e.g. a local
+Postgres. Never point it at a real one.
+"""
+import argparse
+import random
+import time
+import uuid
+
+from sqlalchemy import MetaData, Table, Column, String, BigInteger, Boolean, ForeignKey, Index, create_engine, insert, text
+
+from benchmarks import fixtures
+from benchmarks.harness import measure, report
+import schema
+
+# pylint: disable=missing-class-docstring, missing-function-docstring, invalid-name
+
+TABLES = ['dwebhook', 'tgwatchgroup', 'tgchannel', 'dwh2wg_association', 'dwh2tgc_association', 'tgmessage', 'dmessage']
+
+# Same statements for both layouts, the table and column names didn't change.
+ROUTING = text("""
+    SELECT a.tgchannelid, w.url FROM dwh2tgc_association a JOIN dwebhook w ON w.id = a.webhookid
+    UNION ALL
+    SELECT c.id, w.url FROM tgchannel c JOIN dwh2wg_association g ON g.watchgroupid = c.watchgroupid JOIN dwebhook w ON w.id = g.webhookid
+""")
+LOOKUP = text("""
+    SELECT t.messageid, d.id, w.id, w.url FROM tgmessage t
+    JOIN dmessage d ON d.tgmessageid = t.id JOIN dwebhook w ON w.id = d.webhookid
+    WHERE t.channelid = :channelid AND t.messageid BETWEEN :first AND :last
+""")
+SENT = text("""
+    SELECT d.webhookid FROM dmessage d JOIN tgmessage t ON t.id = d.tgmessageid
+    WHERE t.channelid = :channelid AND t.messageid = :messageid
+""")
+
+
+def v0_tables():
+    """The layout before schema versioning, uuid strings from gen_random_uuid() as keys."""
+    metadata = MetaData()
+    Table('dwebhook', metadata,
+        Column('id', String(128), primary_key=True),
+        Column('url', String(128), nullable=False, unique=True),
+        Column('serverid', BigInteger, nullable=False),
+        Column('active', Boolean),
+    )
+    Table('tgwatchgroup', metadata,
+        Column('id', String(128), primary_key=True),
+        Column('name', String(128), unique=True, nullable=False),
+    )
+    Table('tgchannel', metadata,
+        Column('id', BigInteger, primary_key=True),
+        Column('name', String(128)),
+        Column('registered', Boolean),
+        Column('watchgroupid', String(128), ForeignKey('tgwatchgroup.id')),
+        Column('shard', String(128)),
+    )
+    Table('dwh2wg_association', metadata,
+        Column('webhookid', String(128), ForeignKey('dwebhook.id'), primary_key=True),
+        Column('watchgroupid', String(128), ForeignKey('tgwatchgroup.id'), primary_key=True),
+    )
+    Table('dwh2tgc_association', metadata,
+        Column('webhookid', String(128), ForeignKey('dwebhook.id'), primary_key=True),
+        Column('tgchannelid', BigInteger, ForeignKey('tgchannel.id'), primary_key=True),
+    )
+    Table('tgmessage', metadata,
+        Column('id', String(128), primary_key=True),
+        Column('messageid', BigInteger),
+        Column('channelid', BigInteger),
+        Column('shard', String(128)),
+        Index('ix_tgmessage_channel_message', 'channelid', 'messageid', unique=True),
+    )
+    Table('dmessage', metadata,
+        Column('id', BigInteger, primary_key=True),
+        Column('tgmessageid', String(128), ForeignKey('tgmessage.id')),
+        Column('webhookid', String(128)),
+        Index('ix_dmessage_tgmessage_webhook', 'tgmessageid', 'webhookid', unique=True),
+    )
+    return metadata
+
+def seed(engine, channels, webhooks, watchgroups, messages, fanout, seed=0):
+    """Fill the version 0 layout with a routing table and `messages` ledger entries sent to `fanout` webhooks each."""
+    rng = random.Random(seed)
+    newid = lambda: str(uuid.UUID(int=rng.getrandbits(128)))
+    metadata = v0_tables()
+    metadata.create_all(engine)
+    t = metadata.tables
+
+    channelids = [fixtures.marked_id(i + 1) for i in range(channels)]
+    groupids = [newid() for _ in range(watchgroups)]
+    webhookids = [newid() for _ in range(webhooks)]
+    with engine.begin() as conn:
+        conn.execute(insert(t['tgwatchgroup']), [{"id": groupid, "name": f"Group {i}"} for i, groupid in enumerate(groupids)])
+        conn.execute(insert(t['tgchannel']), [
+            {"id": chatid, "name": f"Channel {i}", "registered": True, "watchgroupid": groupids[i % watchgroups]} for i, chatid in enumerate(channelids)
+        ])
+        conn.execute(insert(t['dwebhook']), [{"id": webhookid, "url": f"https://discord.com/api/webhooks/{i}/token", "serverid": i, "active": True} for i, webhookid in enumerate(webhookids)])
+        conn.execute(insert(t['dwh2tgc_association']), [
+            {"webhookid": webhookid, "tgchannelid": chatid} for webhookid in webhookids for chatid in rng.sample(channelids, 20)
+        ])
+        conn.execute(insert(t['dwh2wg_association']), [
+            {"webhookid": webhookid, "watchgroupid": groupid} for webhookid in webhookids for groupid in rng.sample(groupids, 3)
+        ])
+
+    # the ledger, in batches so SQLite stays under its parameter limit
+    dmessageids = iter(range(10 ** 17, 10 ** 18))
+    hot = channelids[:50]
+    for start in range(0, messages, 2000):
+        tgrows, drows = [], []
+        for messageid in range(start + 1, min(start + 2000, messages) + 1):
+            tmsgid = newid()
+            tgrows.append({"id": tmsgid, "channelid": hot[messageid % len(hot)], "messageid": messageid, "shard": "main"})
+            drows += [{"id": next(dmessageids), "tgmessageid": tmsgid, "webhookid": webhookid} for webhookid in rng.sample(webhookids, fanout)]
+        with engine.begin() as conn:
+            conn.execute(insert(t['tgmessage']), tgrows)
+            conn.execute(insert(t['dmessage']), drows)
+
+    return hot
+
+def sizes(engine):
+    """Bytes used by each table with its indexes."""
+    with engine.connect() as conn:
+        if engine.dialect.name == 'postgresql':
+            conn.execute(text("ANALYZE"))
+            return {name: conn.execute(text(f"SELECT pg_total_relation_size('{name}')")).scalar() for name in TABLES}
+
+        conn.execute(text("VACUUM"))
+        try:
+            # dbstat names indexes by themselves, they are added up by the table they belong to
+            owners = dict(conn.execute(text("SELECT name, tbl_name FROM sqlite_master WHERE type IN ('table', 'index')")).all())
+            used = {}
+            for name, pgsize in conn.execute(text("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name")):
+                used[owners.get(name, name)] = used.get(owners.get(name, name), 0) + pgsize
+            return {name: used.get(name, 0) for name in TABLES}
+        except Exception:  # pylint: disable=broad-except
+            # SQLite built without the dbstat table, only the whole file can be measured
+            return {"total": conn.execute(text("PRAGMA page_count")).scalar() * conn.execute(text("PRAGMA page_size")).scalar()}
+
+def joins(engine, layout, hot, messages, min_time):
+    rng = random.Random(1)
+    results = []
+    with engine.connect() as conn:
+        results.append(measure(f"schema/routing_join/{layout}", lambda: conn.execute(ROUTING).all(), min_time=min_time, min_iterations=5))
+
+        def lookup():
+            first = rng.randrange(1, messages - 100)
+            conn.execute(LOOKUP, {"channelid": hot[first % len(hot)], "first": first, "last": first + 100}).all()
+        results.append(measure(f"schema/ledger_lookup/{layout}", lookup, min_time=min_time))
+
+        def sent():
+            messageid = rng.randrange(1, messages)
+            conn.execute(SENT, {"channelid": hot[messageid % len(hot)], "messageid": messageid}).all()
+        results.append(measure(f"schema/ledger_sent/{layout}", sent, min_time=min_time))
+
+    return results
+
+def run(args):
+    dburl = fixtures.database_url()
+    engine = create_engine(dburl)
+    hot = seed(engine, args.channels, args.webhooks, 50, args.messages, args.fanout)
+
+    before = sizes(engine)
+    results = joins(engine, "v0", hot, args.messages, args.min_time)
+
+    # the database has no schema version yet, so this runs migrations.bigint_keys like a bridge starting on it would
+    started = time.perf_counter()
+    schema.upgrade(engine)
+    results.append({"benchmark": "schema/migrate", "seconds": round(time.perf_counter() - started, 3), "version": schema.VERSION})
+
+    after = sizes(engine)
+    results += joins(engine, "v1", hot, args.messages, args.min_time)
+
+    for name in before:
+        results.append({"benchmark": f"schema/size/{name}", "v0_bytes": before[name], "v1_bytes": after.get(name),
+                        "saved": round(1 - after.get(name, 0) / before[name], 3) if before[name] else None})
+
+    for result in results:
+        result.update({"database": engine.dialect.name, "messages": args.messages, "fanout": args.fanout})
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--min-time", type=float, default=1.0, help="seconds to run each benchmark for")
+    parser.add_argument("--channels", type=int, default=5000, help="Telegram channels in the routing table")
+    parser.add_argument("--webhooks", type=int, default=300, help="webhooks in the routing table")
+    parser.add_argument("--messages", type=int, default=200000, help="Telegram messages in the ledger")
+    parser.add_argument("--fanout", type=int, default=5, help="webhooks each message was sent to")
+    args = parser.parse_args()
+
+    report(run(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Upload throughput of the storage backends.
+
+    python -m benchmarks.bench_storage [--min-time SECONDS] [--batch N] [--large-size BYTES]
+
+Stores small files one at a time, in batches and from the cache directory, and large files as
+streams, in a temporary directory, in B2 and in S3. B2 is b2sdk's in-memory simulator. S3 is a
+local fake unless BENCH_S3_URL points at a scratch bucket's endpoint, e.g. a local MinIO, with
+BENCH_S3_BUCKET, BENCH_S3_ACCESS_KEY and BENCH_S3_SECRET_KEY.
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import tempfile
+
+from benchmarks import fixtures
+from benchmarks.harness import measure_async, report
+from config import LocalStorageConfig, B2StorageConfig, S3StorageConfig
+from storage import LocalStorage, B2Storage, S3Storage
+
+# pylint: disable=missing-class-docstring, missing-function-docstring, invalid-name
+
+SMALL_SIZE = 64 * 1024  # a compressed photo
+
+async def stream(size, chunk_size=512 * 1024):
+    """`size` bytes in chunks, like a download from Telegram."""
+    chunk = os.urandom(chunk_size)
+    for offset in range(0, size, chunk_size):
+        yield chunk[:min(chunk_size, size - offset)]
+
+async def bench_backend(name, storage, args, results):
+    names = (f"bench-{i}.jpg" for i in itertools.count())
+    small = os.urandom(SMALL_SIZE)
+
+    async def put_small():
+        await storage.put(next(names), small)
+    results.append(await measure_async(f"storage/put_small/{name}", put_small, min_time=args.min_time, extra={"bytes": SMALL_SIZE}))
+
+    async def put_many():
+        await storage.put_many([(next(names), small) for _ in range(args.batch)])
+    results.append(await measure_async(f"storage/put_many/{name}", put_many, min_time=args.min_time, min_iterations=5,
+                                       extra={"bytes": SMALL_SIZE, "files": args.batch}))
+
+    async def put_large():
+        await storage.put(next(names), stream(args.large_size))
+    results.append(await measure_async(f"storage/put_large/{name}", put_large, min_time=args.min_time, min_iterations=3,
+                                       extra={"bytes": args.large_size}))
+
+    # from the cache directory like profile photos, writing the file is part of the measurement
+    cache_dir = tempfile.mkdtemp(prefix="tgbridge-bench-cache-")
+    async def upload():
+        filename = next(names)
+        with open(os.path.join(cache_dir, filename), "wb") as f:
+            f.write(small)
+        await storage.upload(os.path.join(cache_dir, filename), filename)
+    results.append(await measure_async(f"storage/upload/{name}", upload, min_time=args.min_time, extra={"bytes": SMALL_SIZE}))
+
+    stored = next(names)
+    await storage.put(stored, small)
+    results.append(await measure_async(f"storage/exists/{name}", lambda: storage.exists(stored), min_time=args.min_time))
+    results.append(await measure_async(f"storage/missing/{name}", lambda: storage.exists(next(names)), min_time=args.min_time))
+    if not await storage.exists(stored) or await storage.exists(next(names)):
+        raise AssertionError(f"{name} storage doesn't tell stored files from missing ones")
+
+async def run(args):
+    results = []
+
+    workdir = tempfile.mkdtemp(prefix="tgbridge-bench-")
+    await bench_backend("local", LocalStorage(LocalStorageConfig(file_prefix=workdir, url_prefix="http://localhost/media")), args, results)
+
+    api_config, keyid, key = fixtures.b2_simulator()
+    b2 = B2Storage(B2StorageConfig(api_id=keyid, api_key=key, url_prefix="https://f000.backblazeb2.com", bucket_name="bench", file_prefix="media"),
+                   api_config=api_config)
+    await bench_backend("b2", b2, args, results)
+    await b2.close()
+
+    fake = None
+    if os.environ.get("BENCH_S3_URL"):
+        config = S3StorageConfig(endpoint_url=os.environ["BENCH_S3_URL"], bucket_name=os.environ["BENCH_S3_BUCKET"],
+                                 access_key=os.environ["BENCH_S3_ACCESS_KEY"], secret_key=os.environ["BENCH_S3_SECRET_KEY"])
+    else:
+        fake = fixtures.FakeS3()
+        await fake.start()
+        config = S3StorageConfig(endpoint_url=fake.url, bucket_name="bench", access_key="bench", secret_key="bench")
+
+    try:
+        storage = S3Storage(config)
+        await bench_backend("s3", storage, args, results)
+        await storage.close()
+
+        # a new client per file, to see what keeping connections open saves
+        small = os.urandom(SMALL_SIZE)
+        names = (f"bench-cold-{i}.jpg" for i in itertools.count())
+        async def put_cold():
+            cold = S3Storage(config)
+            try:
+                await cold.put(next(names), small)
+            finally:
+                await cold.close()
+        results.append(await measure_async("storage/put_small/s3_new_connection", put_cold, min_time=args.min_time, extra={"bytes": SMALL_SIZE}))
+    finally:
+        if fake:
+            await fake.stop()
+
+    for result in results:
+        result["s3"] = "fake" if fake else "remote"
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--min-time", type=float, default=1.0, help="seconds to run each benchmark for")
+    parser.add_argument("--batch", type=int, default=32, help="files stored at once by put_many")
+    parser.add_argument("--large-size", type=int, default=24 * 1024 * 1024, help="bytes of the large files, S3 uploads them in parts")
+    args = parser.parse_args()
+
+    report(asyncio.run(run(args)))
+
+if __name__ == "__main__":
+    main()
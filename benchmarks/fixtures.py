@@ -0,0 +1,228 @@
+"""
+Synthetic Telegram objects, a seeded routing database, a fake Discord and fake S3 and B2 for the benchmarks.
+"""
+import itertools
+import os
+import random
+import socket
+import tempfile
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from aiohttp import web
+from b2sdk.v2 import B2Api, B2HttpApiConfig, InMemoryAccountInfo, RawSimulator
+from sqlalchemy import insert
+from telethon import types
+from telethon.utils import get_peer_id
+from telethon._updates import EntityCache
+
+from models import Webhook, Watchgroup, TelegramChannel, dwh2tgc_association_table, dwh2wg_association_table
+
+# pylint: disable=missing-class-docstring, missing-function-docstring, invalid-name
+
+def database_url():
+    """BENCH_DBURL if set (e.g. a scratch Postgres database), otherwise a new SQLite file."""
+    if os.environ.get("BENCH_DBURL"):
+        return os.environ["BENCH_DBURL"]
+    return "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="tgbridge-bench-"), "bench.db")
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class FakeTelegramClient:
+    """Just enough of TelegramClient for messages and the bridge to work without a connection."""
+
+    def __init__(self, dialogs=()):
+        self._self_id = 1
+        self._mb_entity_cache = EntityCache()
+        self.dialogs = list(dialogs)
+
+    async def iter_dialogs(self):
+        for dialog in self.dialogs:
+            yield dialog
+
+    async def get_messages(self, chat, ids=None):
+        return [None for _ in ids]
+
+def marked_id(channelid):
+    """Chat id of a channel as the bridge stores it."""
+    return get_peer_id(types.PeerChannel(channelid))
+
+def make_channel(chatid, title, username=None):
+    """A channel with the marked chat id `chatid`."""
+    channelid = -chatid - 1000000000000
+    return types.Channel(id=channelid, title=title, photo=types.ChatPhotoEmpty(), date=None, username=username,
+                         broadcast=True, access_hash=channelid * 7)
+
+def make_message(client, channel, messageid, text="", entities=None, forward_from=None):
+    """A channel post as Telethon would build it from an update, `forward_from` is a channel it was forwarded from."""
+    fwd_from = None
+    known = {get_peer_id(channel): channel}
+    if forward_from is not None:
+        fwd_from = types.MessageFwdHeader(date=datetime.now(timezone.utc), from_id=types.PeerChannel(forward_from.id))
+        known[get_peer_id(forward_from)] = forward_from
+
+    message = types.Message(id=messageid, peer_id=types.PeerChannel(channel.id), date=datetime.now(timezone.utc),
+                            message=text, entities=entities, fwd_from=fwd_from, post=True)
+    message._finish_init(client, known, None)
+    return message
+
+def make_dialogs(count, renamed=0, now=None, seed=0):
+    """`count` dialogs newest first, like iter_dialogs. The newest `renamed` ones have a new name and date."""
+    rng = random.Random(seed)
+    now = now or datetime.now(timezone.utc)
+    dialogs = []
+    for i in range(count):
+        chatid = marked_id(i + 1)
+        name = f"Channel {i}" if i >= renamed else f"Renamed channel {i} {rng.random():.6f}"
+        date = now - timedelta(minutes=i) if i < renamed else now - timedelta(days=1, minutes=i)
+        dialogs.append(SimpleNamespace(id=chatid, name=name, date=date, pinned=False))
+    return dialogs
+
+
+def seed_routing(session, channels=5000, webhooks=300, watchgroups=50, per_webhook=20, groups_per_webhook=3,
+                 url="https://discord.com/api/webhooks", seed=0):
+    """
+    Fill an empty database with a routing table shaped like a busy deployment.
+
+    Every channel is in a watchgroup, every webhook watches `per_webhook` channels directly and
+    `groups_per_webhook` watchgroups. Returns the channel ids, hottest (most watched) first.
+    """
+    rng = random.Random(seed)
+    channelids = [marked_id(i + 1) for i in range(channels)]
+    groupids = list(range(1, watchgroups + 1))
+    webhookids = list(range(1, webhooks + 1))
+
+    session.execute(insert(Watchgroup.__table__), [{"id": groupid, "name": f"Group {i}"} for i, groupid in enumerate(groupids)])
+    session.execute(insert(TelegramChannel.__table__), [
+        {"id": chatid, "name": f"Channel {i}", "registered": i % 10 != 9, "watchgroupid": groupids[i % watchgroups]}
+        for i, chatid in enumerate(channelids)
+    ])
+    session.execute(insert(Webhook.__table__), [
+        {"id": webhookid, "url": f"{url}/{i}/token", "serverid": i, "active": True} for i, webhookid in enumerate(webhookids)
+    ])
+
+    # A few channels are watched by a large share of the webhooks, like the big news channels are.
+    hot = channelids[:10]
+    explicit = set()
+    for webhookid in webhookids:
+        for chatid in rng.sample(hot, 3) + rng.sample(channelids, per_webhook - 3):
+            explicit.add((webhookid, chatid))
+    session.execute(insert(dwh2tgc_association_table), [{"webhookid": w, "tgchannelid": c} for w, c in explicit])
+    session.execute(insert(dwh2wg_association_table), [
+        {"webhookid": webhookid, "watchgroupid": groupid}
+        for webhookid in webhookids for groupid in rng.sample(groupids, groups_per_webhook)
+    ])
+    session.commit()
+    return channelids
+
+
+class FakeDiscord:
+    """Local HTTP server answering webhook executions like Discord does, without rate limiting anyone."""
+
+    def __init__(self, host="127.0.0.1", port=None):
+        self.host = host
+        self.port = port or free_port()
+        self.requests = 0
+        self._ids = itertools.count(1)
+        self._runner = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}/api/webhooks"
+
+    async def _execute(self, request):
+        await request.read()
+        self.requests += 1
+        return web.json_response({"id": str(next(self._ids))}, headers={"X-RateLimit-Remaining": "5", "X-RateLimit-Reset-After": "1"})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/api/webhooks/{id}/{token}", self._execute)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+class FakeS3:
+    """
+    Local HTTP server answering the S3 object requests the bridge makes, like a MinIO would.
+
+    Objects are kept in memory by bucket and key. Signatures aren't checked, but every request has
+    to be signed.
+    """
+
+    def __init__(self, host="127.0.0.1", port=None):
+        self.host = host
+        self.port = port or free_port()
+        self.objects = {}
+        self.requests = 0
+        self._uploads = {}  # upload id -> {part number: bytes}
+        self._ids = itertools.count(1)
+        self._runner = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def _handle(self, request):
+        self.requests += 1
+        if not request.headers.get("Authorization", "").startswith("AWS4-HMAC-SHA256 "):
+            return web.Response(status=403, text="<Error><Message>Unsigned request</Message></Error>")
+
+        key = (request.match_info["bucket"], request.match_info["key"])
+        query = request.query
+        if request.method == "HEAD":
+            return web.Response(status=200 if key in self.objects else 404)
+        elif request.method == "GET":
+            return web.Response(body=self.objects[key]) if key in self.objects else web.Response(status=404)
+        elif request.method == "PUT" and "uploadId" in query:
+            self._uploads[query["uploadId"]][int(query["partNumber"])] = await request.read()
+            return web.Response(headers={"ETag": f'"{query["partNumber"]}"'})
+        elif request.method == "PUT":
+            self.objects[key] = await request.read()
+            return web.Response(headers={"ETag": '"0"'})
+        elif request.method == "POST" and "uploads" in query:
+            uploadid = str(next(self._ids))
+            self._uploads[uploadid] = {}
+            return web.Response(text=f"<InitiateMultipartUploadResult><UploadId>{uploadid}</UploadId></InitiateMultipartUploadResult>")
+        elif request.method == "POST" and "uploadId" in query:
+            await request.read()
+            parts = self._uploads.pop(query["uploadId"])
+            self.objects[key] = b"".join(parts[number] for number in sorted(parts))
+            return web.Response(text="<CompleteMultipartUploadResult><ETag>\"0\"</ETag></CompleteMultipartUploadResult>")
+        elif request.method == "DELETE" and "uploadId" in query:
+            self._uploads.pop(query["uploadId"], None)
+            return web.Response(status=204)
+        return web.Response(status=501)
+
+    async def start(self):
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_route("*", "/{bucket}/{key:.+}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+def b2_simulator(bucket_name="bench"):
+    """
+    b2sdk's in-memory stand-in for the B2 API with an account and a public bucket, returns the
+    api_config to pass to B2Storage along with the account's key id and key.
+    """
+    simulator = RawSimulator()
+    api_config = B2HttpApiConfig(_raw_api_class=lambda *args, **kwargs: simulator)  # every client shares the one account
+    keyid, key = simulator.create_account()
+
+    api = B2Api(InMemoryAccountInfo(), api_config=api_config)
+    api.authorize_account("production", keyid, key)
+    api.create_bucket(bucket_name, "allPublic")
+    return api_config, keyid, key
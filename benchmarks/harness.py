@@ -0,0 +1,60 @@
+import json
+import platform
+import subprocess
+import sys
+import time
+
+# pylint: disable=missing-class-docstring, missing-function-docstring, invalid-name
+
+def _percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+def _summarize(name, samples, extra):
+    samples.sort()
+    total = sum(samples)
+    result = {
+        "benchmark": name,
+        "iterations": len(samples),
+        "ops_per_sec": round(len(samples) / (total / 1e9), 2) if total else None,
+        "p50_us": round(_percentile(samples, 0.50) / 1e3, 3),
+        "p99_us": round(_percentile(samples, 0.99) / 1e3, 3),
+        "mean_us": round(total / len(samples) / 1e3, 3),
+    }
+    result.update(extra or {})
+    return result
+
+def measure(name, fn, min_time=1.0, min_iterations=20, extra=None):
+    """Call `fn()` repeatedly for at least `min_time` seconds and summarize its latency."""
+    fn()  # warm up
+    samples = []
+    deadline = time.perf_counter() + min_time
+    while time.perf_counter() < deadline or len(samples) < min_iterations:
+        start = time.perf_counter_ns()
+        fn()
+        samples.append(time.perf_counter_ns() - start)
+    return _summarize(name, samples, extra)
+
+async def measure_async(name, fn, min_time=1.0, min_iterations=20, extra=None):
+    """Await `fn()` repeatedly for at least `min_time` seconds and summarize its latency."""
+    await fn()  # warm up
+    samples = []
+    deadline = time.perf_counter() + min_time
+    while time.perf_counter() < deadline or len(samples) < min_iterations:
+        start = time.perf_counter_ns()
+        await fn()
+        samples.append(time.perf_counter_ns() - start)
+    return _summarize(name, samples, extra)
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "machine": platform.machine()}
+
+def report(results, out=sys.stdout):
+    """Print results as JSON lines, one benchmark per line, so runs on different commits can be diffed."""
+    env = environment()
+    for result in results:
+        out.write(json.dumps({**result, **env}, sort_keys=True) + "\n")
+    out.flush()
@@ -1,20 +1,20 @@
 import asyncio
 import telethon
-from discord import Webhook
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 import yaml
-import aiohttp
 import os
 import logging
-import re
-import sqlalchemy.exc
 from rich.logging import RichHandler
-import shutil
-import b2sdk
+import functools
+import hashlib
+import signal
+import subprocess
 import sys
-from b2sdk.v2 import InMemoryAccountInfo, B2Api
+import tempfile
+import time
 import telethon.events as tgevents
+from typing import NamedTuple, Optional, Tuple
 
 # pylint: disable=missing-class-docstring, missing-function-docstring, invalid-name
 
@@ -34,75 +34,143 @@ else:
     logger.warning(f"No config file was found at {os.environ.get('CONFIG', 'config.yml')}, failing over to environment variables.\nIf this was intentional, set TGBRIDGE_ENVCONFIG=true to hide this warning.")
     settings = Settings()
 
+# With shards configured the bridge is started once without TGBRIDGE_SHARD, that process
+# supervises a process per shard which runs with TGBRIDGE_SHARD set to the shard name.
+shardname = os.environ.get('TGBRIDGE_SHARD')
+if shardname:
+    tgsettings = next((shard for shard in settings.shards if shard.name == shardname), None)
+    if tgsettings is None:
+        raise SystemExit(f'No shard named {shardname} is configured')
+else:
+    tgsettings = settings.telegram or settings.shards[0]
+
 sqlengine = create_engine(settings.dburl)
 sqlsessionmaker = sessionmaker(bind=sqlengine)
 
-from models import db, Webhook as DBWebhook, TelegramChannel, Watchgroup, TelegramMessage, DiscordMessage
-# db.metadata.drop_all(sqlengine)
-db.metadata.create_all(sqlengine)
+import schema
+import retention
+if __name__ == "__main__" and not shardname:
+    schema.upgrade(sqlengine)  # shards are started by the supervising process, which has upgraded the database already
+    if settings.ledger.partitioned:
+        retention.partition(sqlengine, settings.ledger.partition_interval)
 
+def _terminate(signum, frame):
+    raise KeyboardInterrupt
 
-def slash_join(*args):
-    '''
-    Joins a set of strings with a slash (/) between them. Useful for creating URLs.
-    If the strings already have a trailing or leading slash, it is ignored.
-    Note that the python's urllib.parse.urljoin() does not offer this functionality.
+def supervise():
+    """Run every configured shard in a process of its own, restarting the ones that exit."""
+    processes = {shard.name: None for shard in settings.shards}
+    restart_at = {shard.name: 0.0 for shard in settings.shards}
+    signal.signal(signal.SIGTERM, _terminate)
+
+    try:
+        while True:
+            now = time.monotonic()
+            for name, process in processes.items():
+                if process is not None and process.poll() is not None:
+                    logger.error(f'Shard {name} exited with code {process.returncode}, restarting it in 10 seconds')
+                    processes[name], restart_at[name] = None, now + 10
+                elif process is None and now >= restart_at[name]:
+                    logger.info(f'Starting shard {name}')
+                    processes[name] = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env={**os.environ, 'TGBRIDGE_SHARD': name})
+            time.sleep(1)
+    except KeyboardInterrupt:
+        logger.info("Signal received, stopping shards..")
+        for process in processes.values():
+            if process is not None and process.poll() is None:
+                process.send_signal(signal.SIGINT)
+        for process in processes.values():
+            if process is not None:
+                process.wait()
+
+if __name__ == "__main__" and settings.shards and not shardname:
+    supervise()
+    sys.exit(0)
+
+from database import SessionExecutor
+sqlexec = SessionExecutor(sqlsessionmaker, max_workers=settings.dbworkers)
+
+from routing import RoutingTable, RoutedWebhook
+routes = RoutingTable(sqlexec)
+
+from metrics import EVENTS, EVENTS_UNWATCHED, STAGE_SECONDS, INFLIGHT, MEDIA_OVERSIZED, MEDIA_DEDUPLICATED
+import metrics
+
+from dispatch import WebhookDispatcher
+dispatcher = WebhookDispatcher()
+
+import ledger
+import dialogs
+from shards import ShardCoordinator
+coordinator = ShardCoordinator(sqlexec, tgsettings.name)
+from delivery import DeliveryQueue
+deliveries = DeliveryQueue(sqlexec, tgsettings.name, workers=settings.delivery.workers, max_attempts=settings.delivery.max_attempts, backoff=settings.delivery.backoff, lease=settings.delivery.lease)
+import backfill
+ledger_retention = retention.LedgerRetention(sqlexec, retention_days=settings.ledger.retention_days, interval=settings.ledger.partition_interval,
+                                             archive=settings.ledger.archive, period=settings.ledger.retention_interval)
+backfiller = backfill.Backfiller(sqlexec, tgsettings.name, deliveries.enqueue, workers=settings.backfill.workers, max_messages=settings.backfill.max_messages,
+                                 page_size=settings.backfill.page_size, page_wait=settings.backfill.page_wait)
+
+from avatars import AvatarCache
+from formatting import format_message, format_forwarding
+import media
+import mediaindex
+media_index = mediaindex.MediaIndex(sqlexec, cache_size=settings.media.index_cache_size)
+from storage import open_storage
+storage = open_storage(settings.storage)
 
-    https://codereview.stackexchange.com/questions/175421/joining-strings-to-form-a-url
-    '''
-    return "/".join(arg.strip("/") for arg in args)
 
 async def upload_media(filename):
     """Upload file named `filename` which is in the configured cache directory to configured storage, then delete the cached copy after upload."""
-    if settings.storage.local.enabled:
-        shutil.copyfile(settings.storage.cache_dir+filename, slash_join(settings.storage.local.file_prefix, filename))
-
-        try:
-            os.remove(settings.storage.cache_dir+filename)
-        except FileNotFoundError:
-            pass # If it doesn't exist, we don't need to do anything about it.
-
-        # {url_prefix}/{filename}
-        url = slash_join(settings.storage.local.url_prefix, filename)
-        logger.debug(f'URL created using local storage: {url}')
-        return url
+    with STAGE_SECONDS.time(stage='avatar_upload'):
+        url = await storage.upload(os.path.join(settings.storage.cache_dir, filename), filename)
 
-    elif settings.storage.b2.enabled:
-        info = InMemoryAccountInfo()  # TODO: put this somewhere else
-        b2_api = B2Api(info)
-        b2_api.authorize_account("production", settings.storage.b2.api_id, settings.storage.b2.api_key)
+    try:
+        os.remove(os.path.join(settings.storage.cache_dir, filename))
+    except FileNotFoundError:
+        pass # If it doesn't exist, we don't need to do anything about it.
+
+    logger.debug(f'URL created using {type(storage).__name__}: {url}')
+    return url
+
+avatars = AvatarCache(sqlexec, settings.storage.cache_dir, upload_media)
+
+async def put_media(filename, data):
+    """
+    Store `data`, bytes or an async iterator of them, under `filename` and return its URL. The time
+    spent waiting for an iterator, e.g. a download it is streamed from, isn't part of the upload stage.
+    """
+    waited = 0.0
+
+    async def pull(chunks):
+        nonlocal waited
+        resumed = time.perf_counter()
+        async for chunk in chunks:
+            waited += time.perf_counter() - resumed
+            yield chunk
+            resumed = time.perf_counter()
+        waited += time.perf_counter() - resumed
+
+    start = time.perf_counter()
+    try:
+        return await storage.put(filename, data if isinstance(data, bytes) else pull(data))
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start - waited, stage='media_upload')
 
-        if settings.storage.b2.bucket_name:
-            bucket = b2_api.get_bucket_by_name(settings.storage.b2.bucket_name)
-        elif settings.storage.b2.bucket_id:
-            bucket = b2_api.get_bucket_by_id(settings.storage.b2.bucket_id)
-        else:
-            raise Exception("no bucket name or id given")
-
-        try:
-            bucket.get_file_info_by_name(slash_join(settings.storage.b2.file_prefix, filename))
-        except b2sdk.exception.FileNotPresent:
-            bucket.upload_local_file(
-                local_file=os.path.join(settings.storage.cache_dir, filename),
-                file_name=slash_join(settings.storage.b2.file_prefix, filename)
-            )
-        else:
-            logger.debug(f"File \"{os.path.join(settings.storage.b2.file_prefix, filename)}\" already exists on B2 Backblaze.")
+INFLIGHT.set_function(lambda: deliveries.inflight, kind='deliveries')
+INFLIGHT.set_function(lambda: len(media_inflight), kind='media_transfers')
 
-        try:
-            os.remove(os.path.join(settings.storage.cache_dir, filename))
-        except FileNotFoundError:
-            pass # If it doesn't exist, we don't need to do anything about it.
+media_slots = None  # bounds concurrent transfers, created on first use inside the running event loop
 
-        # {url_prefix}/file/{bucket.name}/{url_prefix}{filename}
-        url = slash_join(settings.storage.b2.url_prefix, "/file/"+bucket.name, settings.storage.b2.file_prefix, filename)
+async def download_media_message(tgclient, message):
+    global media_slots
+    if media_slots is None:
+        media_slots = asyncio.Semaphore(settings.mediaworkers)
 
-        logger.debug(f'URL created using B2 Backblaze storage: {url}')
-        return url
+    async with media_slots:
+        return await _download_media_message(tgclient, message)
 
-# TODO: a flag to allow/deny large files beyond a certain size?
-# FIXME: replace dictionary subscripting with .get and/or validation so its actually reliable
-async def download_media_message(tgclient, message):
+async def _download_media_message(tgclient, message):
     if message.file and not message.web_preview:
         # These are all JPEGs, renaming them makes it easier for everyone.
         # .jpe is the only one seen on Telegram due to a Telegram quirk though.
@@ -111,273 +179,391 @@ async def download_media_message(tgclient, message):
         else:
             mfpext = message.file.ext
 
+        # forwards of a message share its Telegram file, which is only stored the first time
+        key = mediaindex.media_key(message) if settings.media.deduplicate else None
+        url = key and await media_index.get(key)
+        if url:
+            MEDIA_DEDUPLICATED.inc(by='id')
+            logger.debug(f'{key} is already stored, skipping download')
+            return url
+
         filename = f"{message.chat_id}-{message.id}{mfpext}"
-        # download the file to cached directory so we can pass it to other handlers
-        with open(os.path.join(settings.storage.cache_dir, filename), 'wb') as f:
-            async for chunk in tgclient.iter_download(message.file.media):
-                f.write(chunk)
-
-        return await upload_media(filename)
-
-# TODO: hash db to see if we've downloaded a profile photo before
-async def download_profile_photo(event):
-    """Download a Chat's profile photo from an event (preferably NewMessage) and upload it for use from the configured storage system."""
-    chat = await event.get_chat()
-    tgclient = event.client
-
-    filename = f"{event.chat_id}.jpg"  # Channel icons can be assumed to be JPEGs for the foreseeable future.
-    if not os.path.exists(filename) and not isinstance(chat.photo, telethon.types.ChatPhotoEmpty):
-        await tgclient.download_profile_photo(await event.get_chat(), file=os.path.join(settings.storage.cache_dir, filename))
-        return await upload_media(filename)
-    else:
+        # the size is unknown for some files, those are only stored by name as they could be any size
+        by_content = settings.media.deduplicate and message.file.size is not None and message.file.size <= settings.media.hash_max_size
+        if not by_content and await storage.exists(filename):
+            # only files stored under the message's own name can be found by it, small ones are named by their hash
+            logger.debug(f'{filename} is already stored, skipping download')
+            url = await storage.url_for(filename)
+            await media_index.add([key], url)
+            return url
+
+        chunks = media.iter_download(tgclient, message.file.media, message.file.size, filename, part_size=settings.media.part_size,
+                                     connections=settings.media.connections, threshold=settings.media.parallel_threshold)
+        if by_content:
+            url = await _store_by_content(message, chunks, key, filename, mfpext)
+        else:
+            # stream the file from Telegram straight into storage
+            url = await put_media(filename, chunks)
+            await media_index.add([key], url)
+
+        logger.debug(f'URL created using {type(storage).__name__}: {url}')
+        return url
+
+# Bytes of a file being hashed that are kept in memory, the rest is spooled to disk.
+SPOOL_MEMORY_SIZE = 1024 * 1024
+
+async def _unspool(spool, rest=None):
+    """The data written to `spool` so far, followed by the chunks of `rest`."""
+    loop = asyncio.get_running_loop()
+    spool.seek(0)
+    while True:
+        chunk = await loop.run_in_executor(None, spool.read, SPOOL_MEMORY_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+    if rest is not None:
+        async for chunk in rest:
+            yield chunk
+
+async def _store_by_content(message, chunks, key, filename, ext):
+    """
+    Store a small file under the hash of its content, unless a copy uploaded to Telegram separately
+    already is. It has to be downloaded to be hashed, but the upload is skipped. A file that turns
+    out bigger than media.hash_max_size is streamed into storage as `filename` instead.
+    """
+    loop = asyncio.get_running_loop()
+    digest = hashlib.sha256()
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_SIZE, dir=settings.storage.cache_dir) as spool:
+        async for chunk in chunks:
+            digest.update(chunk)
+            await loop.run_in_executor(None, spool.write, chunk)
+            if spool.tell() > settings.media.hash_max_size:
+                logger.debug(f'Media of {message.chat_id}-{message.id} is bigger than its size said, storing it as {filename}')
+                url = await put_media(filename, _unspool(spool, chunks))
+                await media_index.add([key], url)
+                return url
+
+        hashkey = mediaindex.content_key(digest)
+        url = await media_index.get(hashkey)
+        if url:
+            MEDIA_DEDUPLICATED.inc(by='content')
+            logger.debug(f'Media of {message.chat_id}-{message.id} is already stored as {hashkey}, skipping upload')
+        else:
+            url = await put_media(f"{digest.hexdigest()}{ext}", _unspool(spool))
+
+    await media_index.add([key, hashkey], url)
+    return url
+
+# Media transfers in flight, keyed by Telegram file or by "{chat_id}-{message_id}" so concurrent events share a single transfer.
+media_inflight = {}
+
+async def resolve_media(tgclient, message):
+    """Resolve the attachment of `message` to its public URL once, no matter how many events or webhooks ask for it."""
+    if not message.file or message.web_preview or is_oversized(message):
         return None
 
+    key = (settings.media.deduplicate and mediaindex.media_key(message)) or f"{message.chat_id}-{message.id}"
+    transfer = media_inflight.get(key)
+    if transfer is None:
+        transfer = asyncio.ensure_future(download_media_message(tgclient, message))
+        media_inflight[key] = transfer
+        transfer.add_done_callback(lambda _: media_inflight.pop(key, None))
+    else:
+        logger.debug(f'Joining in-flight transfer of {key}')
+
+    # Shielded so one caller being cancelled doesn't cancel the transfer for everyone else.
+    return await asyncio.shield(transfer)
 
 def is_watched(message):
-    session = sqlsessionmaker()
+    """Get the webhooks interested in `message` from the in-memory routing table."""
+    return routes.webhooks_for(message.chat_id)
 
-    try:
-        channel = session.query(TelegramChannel).filter(TelegramChannel.id == int(message.chat_id)).one()
-    except sqlalchemy.exc.NoResultFound:
-        return []
-
-    if not channel.registered:
-        logger.debug(f'{channel.name} ({channel.id}) is not registered')
-        return []  # return an empty list instead of None so list comprehension doesn't fail
-
-    outhooks = []
-
-    # Get webhooks which explicitly watch this channel.
-    outhooks += session.query(DBWebhook).filter(DBWebhook.watched.any(id=channel.id)).all()
-
-    # Get webhooks which watch this channel by watchgroup.
-    outhooks += session.query(DBWebhook).join(Watchgroup, DBWebhook.watchgroups).filter(Watchgroup.channels.any(id=channel.id)).all()
-
-    outhooks = list(set(outhooks))  # De-duplicate webhooks list.
-
-    session.close()
-    return outhooks
-
-async def format_forwarding(event):
-    if event.forward:
-        # Accounts which hide their account link in forwards will have a name but no ID.
-        if event.forward.from_name and not event.forward.from_id:
-            return f'{event.forward.from_name} (Hidden Account)'
-        # Accounts that allow passing their account link in forwards will have an attached PeerUser.
-        # In this context, the username is the account link.
-        elif isinstance(event.forward.from_id, telethon.types.PeerUser):
-            ent = await event.forward.get_sender()
-            fwname = "Forwarded from"
-
-            if ent.first_name:
-                fwname += " "+ent.first_name
-            if ent.last_name:
-                fwname += " "+ent.last_name
-            if ent.username:
-                fwname += " @"+ent.username
-
-            return fwname
-        # Channels will have an attached ID.
-        elif isinstance(event.forward.from_id, telethon.types.PeerChannel):
-            ent = await event.forward.get_chat()
-            # The channel has a channel link (public)
-            # In this context, the username is the channel link.
-            if ent.username:
-                if event.forward.post_author:
-                    # The channel will show the author of the message instead of only the channel name.
-                    return f'Forwarded from [{ent.title}](<https://t.me/{ent.username}> "Join this channel on Telegram") ({event.forward.post_author})'
-                else:
-                    return f'Forwarded from [{ent.title}](<https://t.me/{ent.username}> "Join this channel on Telegram")'
-            else:
-                # The channel has no link (private)
-                return f'Forwarded from {ent.title} (Private Channel)'
-
-
-# TODO: Might have an option to disable URL previews because most people who use Telegram
-# are used to not having them and will do it themselves
-# which may conflict with having URL previews
-async def format_message(message):
-    text = message.message
-    if message.entities:
-        for entity in message.entities:
-            # Telegram uses UTF-16 codepoint pairs so we can't just slice it.
-            # Massive thanks to python-telegram-bot for having information about this.
-            if sys.maxunicode == 0xFFFF:
-                entity_text = message.raw_text[entity.offset : entity.offset + entity.length]
-
-            entity_text = message.raw_text.encode("utf-16-le")
-            entity_text = entity_text[entity.offset * 2 : (entity.offset + entity.length) * 2]
-            entity_text = entity_text.decode("utf-16-le")
-
-            # "https://example.com" creates these. Telegram will automatically add "https://" to URLs without a scheme.
-            if isinstance(entity, telethon.types.MessageEntityUrl):
-                if "://" not in text:  # Don't add https:// if it's already there
-                    text = text.replace(entity_text, "https://"+entity_text)
-
-            # Special hyperlinks, Ctrl-K creates these on Telegram desktop.
-            elif isinstance(entity, telethon.types.MessageEntityTextUrl):
-                text = text.replace(entity_text, f"[{entity_text}]({entity.url})")
-
-            # "@username" creates these.
-            elif isinstance(entity, telethon.types.MessageEntityMention):
-                text = text.replace(entity_text, f"[{entity_text}](https://t.me/{entity_text})")
-
-            # Don't know what creates these, mentioning user who doesn't have username?
-            elif isinstance(entity, telethon.types.MessageEntityMentionName):
-                text = text.replace(entity_text, f"[{entity_text}](https://t.me/{entity.user_id})")
-
-            # "``` ```" creates these. Standard Markdown code block.
-            elif isinstance(entity, telethon.types.MessageEntityPre):
-                text = text.replace(entity_text, f"```{entity.language}\n{entity_text}```")
-
-            # These exist for making sure that the Telegram markdown syntax is translated to Discord's syntax,
-            # and are self-explanatory as a result.
-            elif isinstance(entity, telethon.types.MessageEntityBold):
-                text = text.replace(entity_text, f"**{entity_text}**")
-            elif isinstance(entity, telethon.types.MessageEntityItalic):
-                text = text.replace(entity_text, f"*{entity_text}*")
-            elif isinstance(entity, telethon.types.MessageEntityCode):
-                text = text.replace(entity_text, f"`{entity_text}`")
-            elif isinstance(entity, telethon.types.MessageEntityStrike):
-                text = text.replace(entity_text, f"~~{entity_text}~~")
-            elif isinstance(entity, telethon.types.MessageEntityUnderline):  # parsed as --text-- on telegram
-                text = text.replace(entity_text, f"__{entity_text}__")
-
-            # # username@domain.tld syntax creates these, but they are not supported on Discord.
-            # elif isinstance(entity, telethon.types.MessageEntityEmail):
-            #     text = text.replace(entity_text, f"[{entity_text}](mailto:{entity_text})")
-            else:
-                logger.warn(f'Invalid MessageEntity type {type(entity)}: {entity_text}')
+selfid = None  # user id of the logged in account, set once the client has started
 
+def format_username(message, chat):
+    """Name to show as the webhook author for messages from `chat`."""
+    if not isinstance(chat, telethon.types.User):
+        return f'{chat.title}'
+    elif selfid == message.chat_id:
+        return 'Saved Messages'
+    else:
+        return f'{chat.first_name} {chat.last_name} @{chat.username}'
+
+class Payload(NamedTuple):
+    """Everything sent to Discord for one Telegram event, rendered once and shared by every webhook."""
+    content: str
+    username: str
+    avatar_url: Optional[str]
+    embeds: Tuple[dict, ...]  # images, shown in the message instead of as links
+
+# Discord shows at most this many embeds in one message.
+MAX_EMBEDS = 10
+
+def is_image(message):
+    return message.photo is not None or (message.file.mime_type or '').startswith('image/')
+
+def is_oversized(message):
+    """Whether the file of `message` is over the size limit of its chat, and should be linked to instead of mirrored."""
+    if not message.file or message.web_preview:
+        return False
+
+    limit = settings.media.channel_max_file_size.get(message.chat_id, settings.media.max_file_size)
+    return limit is not None and (message.file.size or 0) > limit
+
+def oversized_placeholder(message, chat):
+    text = f'File too large to mirror ({media.human_size(message.file.size)})'
+    if isinstance(chat, telethon.types.Channel):
+        # t.me/c links only open for members, public channels get a link anyone can open
+        if chat.username:
+            return f'{text}: https://t.me/{chat.username}/{message.id}'
+        return f'{text}: https://t.me/c/{chat.id}/{message.id}'
     return text
 
-@tgevents.register(tgevents.Album())
-async def on_album(event):
-    sqlsession = sqlsessionmaker()
-    chat = await event.get_chat()
-    tgclient = event.client
-
-    ifp = await download_profile_photo(event)
-
-    webhooks = [webhook for webhook in is_watched(event)] # get webhooks that are interested in this message
-
-    for webhook in webhooks:
-        async with aiohttp.ClientSession() as session:
-
-            # forward handling
-            try:
-                fwname = await format_forwarding(event)
-            except:
-                fwname = "**An exception has occurred fetching the origin channel.**"
-
-            # message formatting handling
-            # TODO: do better
-            for message in event:
-                if message.message:
-                    content = await format_message(message)
-
-            # file download handling
-            # TODO: if there are more than 5 links (album or not) then not all of them will show.
-            urls = []
-            for message in event:
-                if message.file and not message.web_preview:
-                    urls.append(await download_media_message(tgclient, message))
-
-            webhookmsg = content
-
-            if fwname:
-                webhookmsg = fwname + "\n\n" + webhookmsg
-
-            if urls:
-                webhookmsg = webhookmsg + '\n\n' + "\n".join(urls)
-
-            # final webhook request handling
-            username = chat.title if chat.title else f'{chat.first_name} {chat.last_name}'
-            ent = await event.message.get_chat()
-            webhook = Webhook.from_url(webhook.url, session=session)
-            if not isinstance(chat, telethon.types.User):
-                dmessage = await webhook.send(webhookmsg, username=f'{chat.title}', avatar_url=ifp, wait=True)
-            elif (await tgclient.get_me()).id == event.chat_id:
-                dmessage = await webhook.send(webhookmsg, username=f'Saved Messages', avatar_url=ifp, wait=True)
-            elif isinstance(chat, telethon.types.User):
-                dmessage = await webhook.send(webhookmsg, username=f'{chat.first_name} {chat.last_name} @{ent.username}', avatar_url=ifp, wait=True)
-            else:
-                dmessage = await webhook.send(webhookmsg, username=f'Invalid channel', avatar_url=ifp, wait=True)
+async def render(tgclient, messages):
+    """Render a Telegram message, or the messages of an album, to the payload sent to Discord."""
+    first = messages[0]
+
+    chat = await first.get_chat()
+    ifp = await avatars.resolve(tgclient, chat)
+
+    # file download handling, every item of an album at once
+    urls = await asyncio.gather(*(resolve_media(tgclient, message) for message in messages))
+
+    # images become embeds so a whole album shows in one message, everything else is linked
+    embeds, links = [], []
+    for message, url in zip(messages, urls):
+        if is_oversized(message):
+            MEDIA_OVERSIZED.inc()
+            links.append(oversized_placeholder(message, chat))
+        elif not url:
+            continue
+        elif is_image(message) and len(embeds) < MAX_EMBEDS:
+            embeds.append({'image': {'url': url}})
+        else:
+            links.append(url)
 
+    # forward handling
+    try:
+        fwname = await format_forwarding(first)
+    except Exception as err:
+        fwname = "**An exception has occurred fetching the origin channel.**"
 
-@tgevents.register(tgevents.NewMessage())
-async def on_message(event):
-    sqlsession = sqlsessionmaker()
-    chat = await event.get_chat()
-    tgclient = event.client
+    # Message entity markdown handling, albums can have a caption on every item
+    with STAGE_SECONDS.time(stage='format'):
+        captions = [format_message(message) for message in messages if message.message]
 
-    if event.message.grouped_id:
-        return # albums will break
+    webhookmsg = "\n\n".join(captions)
 
-    if event.chat_id == 777000 or event.sender_id == 777000:
-        return # don't send anything from official telegram system channel either
+    if fwname:
+        webhookmsg = fwname + "\n\n" + webhookmsg
 
-    # if no TelegramMessage with this message id and channel id exists, create one.
-    tmsg = sqlsession.query(TelegramMessage).filter(TelegramMessage.messageid == event.message.id, TelegramMessage.channelid == event.chat_id).one_or_none()
-    if tmsg is None:
-        tmsg = TelegramMessage(messageid=event.message.id, channelid=event.chat_id)
-        sqlsession.add(tmsg)
-        sqlsession.commit()
-    else:
-        # this message MAY have been processed before, but check webhooks anyway
-        logger.warning(f"Telegram message with message id {tmsg.messageid} and chat id {tmsg.channelid} has been processed before")
+    if links:
+        webhookmsg = webhookmsg + '\n\n' + "\n".join(links)
+
+    return Payload(webhookmsg, format_username(first, chat), ifp, tuple(embeds))
 
-    webhooks = [webhook for webhook in is_watched(event)] # get webhooks that are interested in this message
+async def deliver(tgclient, messages):
+    """Send a Telegram message, or the messages of an album, to every webhook interested in it."""
+    first = messages[0]
 
-    ifp = await download_profile_photo(event)
+    webhooks = [webhook for webhook in is_watched(first)] # get webhooks that are interested in this message
+    if not webhooks:
+        return
 
-    for webhook in webhooks:
-        async with aiohttp.ClientSession() as session:
-            if sqlsession.query(DiscordMessage).filter(DiscordMessage.tgmessageid == tmsg.id, DiscordMessage.webhookid == webhook.id).count() >= 1:
-                logger.error(f"Webhook with id {webhook.id} has already sent Telegram message with message id {tmsg.messageid} and channel id {tmsg.channelid}, webhook will be skipped.")
-                continue # this has been processed before, skip to next webhook
+    claimed = await sqlexec.run(ledger.claim, first.chat_id, first.id, first.date, tgsettings.name, coordinator.timeout)
+    if claimed is None:
+        return # another shard delivers this message
 
-            fwname = ''
-            webhookmsg = ''
+    tmsgid, ledgerdate, sent = claimed
+    for webhook in [webhook for webhook in webhooks if webhook.id in sent]:
+        logger.error(f"Webhook with id {webhook.id} has already sent Telegram message with message id {first.id} and channel id {first.chat_id}, webhook will be skipped.")
+        webhooks.remove(webhook) # this has been processed before, skip to next webhook
 
-            # forward handling
-            try:
-                fwname = await format_forwarding(event)
-            except Exception as err:
-                fwname = "**An exception has occurred fetching the origin channel.**"
+    if not webhooks:
+        return
 
-            # Message entity markdown handling
-            content = await format_message(event.message)
+    with STAGE_SECONDS.time(stage='render'):
+        payload = await render(tgclient, messages)
 
-            # file download handling
-            url = await download_media_message(tgclient, event.message)
+    # the webhooks only send the rendered payload, all at once
+    with STAGE_SECONDS.time(stage='send'):
+        results = await dispatcher.fanout(webhooks, payload.content, username=payload.username, avatar_url=payload.avatar_url, embeds=list(payload.embeds) or None)
 
-            webhookmsg = content
+    # log that the telegram message has been sent to these webhooks
+    delivered = []
+    for webhook, result in zip(webhooks, results):
+        if isinstance(result, Exception):
+            logger.error(f"Webhook with id {webhook.id} failed to send Telegram message with message id {first.id} and channel id {first.chat_id}: {result!r}")
+            continue
+        delivered.append((result, webhook.id))
 
-            if fwname:
-                webhookmsg = fwname + "\n\n" + webhookmsg
+    if delivered:
+        await sqlexec.run(ledger.record, tmsgid, ledgerdate, delivered)
 
-            if url:
-                webhookmsg = webhookmsg + '\n\n' + url
+    if len(delivered) < len(webhooks):
+        # raised after recording the webhooks that did send it, so a retry only goes to the ones that failed
+        raise Exception(f"{len(webhooks) - len(delivered)} of {len(webhooks)} webhooks failed")
 
-            # final webhook request handling
-            username = chat.title if chat.title else f'{chat.first_name} {chat.last_name}'
-            ent = await event.message.get_chat()
-            webhook = Webhook.from_url(webhook.url, session=session)
-            if not isinstance(chat, telethon.types.User):
-                dmessage = await webhook.send(webhookmsg, username=f'{chat.title}', avatar_url=ifp, wait=True)
-            elif (await tgclient.get_me()).id == event.chat_id:
-                dmessage = await webhook.send(webhookmsg, username=f'Saved Messages', avatar_url=ifp, wait=True)
-            elif isinstance(chat, telethon.types.User):
-                dmessage = await webhook.send(webhookmsg, username=f'{chat.first_name} {chat.last_name} @{ent.username}', avatar_url=ifp, wait=True)
-            else:
-                dmessage = await webhook.send(webhookmsg, username=f'Invalid event type', avatar_url=ifp, wait=True)
+async def deliver_job(tgclient, channelid, messageids, messages):
+    if messages is None:
+        # Queued by a previous run, the messages have to be fetched again. Deleted ones come back as None.
+        messages = [message for message in await tgclient.get_messages(channelid, ids=messageids) if message]
+        if not messages:
+            logger.warning(f"Telegram message with message id {messageids[0]} and channel id {channelid} no longer exists, it will not be delivered.")
+            return
 
-            # log that the telegram message has been sent to this webhook
-            dmsg = DiscordMessage(id=dmessage.id, tgmessage=tmsg, webhookid=webhook.id)
-            sqlsession.add(dmsg)
-            sqlsession.commit()
+    with STAGE_SECONDS.time(stage='deliver'):
+        await deliver(tgclient, messages)
 
+    await sqlexec.run(backfill.advance, tgsettings.name, channelid, max(message.id for message in messages))
+
+@tgevents.register(tgevents.Album())
+async def on_album(event):
+    EVENTS.inc(kind='album')
+    if not is_watched(event):
+        EVENTS_UNWATCHED.inc(kind='album')
+        return
+
+    if not coordinator.owns(event.chat_id):
+        return # ingested by another shard
+
+    await deliveries.enqueue(event.chat_id, event.messages)
+
+@tgevents.register(tgevents.NewMessage())
+async def on_message(event):
+    if event.message.grouped_id:
+        return # albums will break
+
+    EVENTS.inc(kind='message')
+    if event.chat_id == 777000 or event.sender_id == 777000:
+        return # don't send anything from official telegram system channel either
+
+    if not is_watched(event):
+        EVENTS_UNWATCHED.inc(kind='message')
+        return
+
+    if not coordinator.owns(event.chat_id):
+        return # ingested by another shard
+
+    await deliveries.enqueue(event.chat_id, [event.message])
+
+async def album_of(tgclient, message):
+    """The messages of the album `message` is the first item of, or just `message` if it isn't part of one."""
+    if not message.grouped_id:
+        return [message]
+
+    # albums have at most 10 items, sent with consecutive ids
+    siblings = await tgclient.get_messages(message.chat_id, ids=list(range(message.id, message.id + 10)))
+    return [sibling for sibling in siblings if sibling and sibling.grouped_id == message.grouped_id]
+
+async def propagate(action, mirrored, *args):
+    """Run dispatcher `action` on every mirrored Discord message at once, logging the ones that fail."""
+    webhooks = [RoutedWebhook(webhookid, url) for _, _, webhookid, url in mirrored]
+    results = await asyncio.gather(*(action(webhook, dmessageid, *args) for webhook, (_, dmessageid, _, _) in zip(webhooks, mirrored)), return_exceptions=True)
+
+    for webhook, (tgmessageid, dmessageid, _, _), result in zip(webhooks, mirrored, results):
+        if isinstance(result, Exception):
+            logger.error(f"Webhook with id {webhook.id} failed to {action.__name__} Discord message {dmessageid} of Telegram message with message id {tgmessageid}: {result!r}")
+
+@tgevents.register(tgevents.MessageEdited())
+async def on_edit(event):
+    EVENTS.inc(kind='edit')
+    if not event.message.edit_date:
+        return # reactions and view counts also arrive as edits
+
+    if not is_watched(event):
+        EVENTS_UNWATCHED.inc(kind='edit')
+        return
+
+    if not coordinator.owns(event.chat_id):
+        return # edited by the shard that ingests the chat
+
+    # Only the first message of an album is in the ledger, it stands for the whole album.
+    mirrored = await sqlexec.run(ledger.lookup, event.chat_id, [event.message.id])
+    if not mirrored:
+        return # not delivered (yet), or an album item other than the first
+
+    messages = await album_of(event.client, event.message)
+    with STAGE_SECONDS.time(stage='render'):
+        payload = await render(event.client, messages)
+
+    with STAGE_SECONDS.time(stage='edit'):
+        await propagate(dispatcher.edit, mirrored, payload.content, list(payload.embeds))
+
+@tgevents.register(tgevents.MessageDeleted())
+async def on_delete(event):
+    EVENTS.inc(kind='delete')
+    if event.chat_id is not None:
+        if not is_watched(event):
+            EVENTS_UNWATCHED.inc(kind='delete')
+            return
+
+        if not coordinator.owns(event.chat_id):
+            return # deleted by the shard that ingests the chat
+
+    # a purge can delete thousands of messages at once, they are looked up in batches
+    mirrored = await sqlexec.run(ledger.lookup, event.chat_id, event.deleted_ids, tgsettings.name)
+    if not mirrored:
+        return
+
+    logger.debug(f'Deleting {len(mirrored)} Discord messages for {len(event.deleted_ids)} deleted Telegram messages')
+    with STAGE_SECONDS.time(stage='delete'):
+        await propagate(dispatcher.delete, mirrored)
+
+
+async def sync_dialogs(tgclient):
+    """
+    Reconcile the chats list with the database.
+
+    Dialogs come newest first, so the scan stops at the first dialog that hasn't changed since the
+    previous sync. Renames and joins after that are picked up from update events instead.
+    """
+    key = f'dialogs:{tgsettings.sessionfile}'
+    watermark = await sqlexec.run(dialogs.get_watermark, key)
+    if watermark and not await coordinator.sees_any():
+        logger.info('No chats are recorded for this shard, checking every chat')
+        watermark = None  # e.g. forgotten after being stopped for a long time, see shards.PRUNE_AFTER
+
+    chats = []
+    newest = None
+    async for dialog in tgclient.iter_dialogs():
+        if dialog.date is not None:
+            if watermark and dialog.date < watermark and not dialog.pinned:  # pinned dialogs are listed first regardless of date
+                break
+            newest = max(newest, dialog.date) if newest else dialog.date
+
+        logger.debug(f'Found chat {dialog.name} ({dialog.id})')
+        chats.append((dialog.id, dialog.name))
+
+    changed = await sqlexec.run(dialogs.upsert, chats)
+    await coordinator.record_visible(chatid for chatid, _ in chats)
+    logger.info(f'Checked {len(chats)} chats, {changed} were added or renamed in the database.')
+
+    if newest:
+        await sqlexec.run(dialogs.set_watermark, key, newest)
+
+@tgevents.register(tgevents.ChatAction())
+async def on_chat_action(event):
+    if event.new_title:
+        logger.info(f'Chat {event.chat_id} was renamed in Telegram, renaming to {event.new_title} in database.')
+        await sqlexec.run(dialogs.upsert, [(event.chat_id, event.new_title)])
+    elif (event.user_joined or event.user_added) and selfid in event.user_ids:
+        chat = await event.get_chat()
+        logger.info(f'Joined {telethon.utils.get_display_name(chat)} ({event.chat_id}), adding it to the database.')
+        await sqlexec.run(dialogs.upsert, [(event.chat_id, telethon.utils.get_display_name(chat))])
+        await coordinator.record_visible([event.chat_id])
+
+async def on_channel_update(tgclient, update):
+    # Sent when a channel is joined, left or edited, the update itself only carries the channel id.
+    try:
+        channel = await tgclient.get_entity(telethon.types.PeerChannel(update.channel_id))
+    except (ValueError, telethon.errors.RPCError):
+        return  # left or no longer accessible
+
+    if isinstance(channel, telethon.types.Channel) and not channel.left:
+        await sqlexec.run(dialogs.upsert, [(telethon.utils.get_peer_id(channel), channel.title)])
+        await coordinator.record_visible([telethon.utils.get_peer_id(channel)])
 
 async def main():
     # dev rant:
@@ -385,49 +571,54 @@ async def main():
     # but if we use async with (which runs .start or equivalent) it does work
     # what the hell
     logger.info("Starting Telethon client..")
-    async with telethon.TelegramClient(settings.telegram.sessionfile, settings.telegram.api_id, settings.telegram.api_hash) as tgclient:
-        session = sqlsessionmaker()
+    async with telethon.TelegramClient(tgsettings.sessionfile, tgsettings.api_id, tgsettings.api_hash) as tgclient:
+        global selfid
+        selfid = (await tgclient.get_me(input_peer=True)).user_id
+
+        # shards serve their metrics on consecutive ports
+        metricsport = settings.metrics.port + (settings.shards.index(tgsettings) if tgsettings in settings.shards else 0)
+        metricsserver = await metrics.serve(settings.metrics.host, metricsport) if settings.metrics.enabled else None
+
+        await routes.refresh()
+        await avatars.load()
+        await coordinator.refresh()
+        routing = asyncio.ensure_future(routes.listen(sqlengine))
+        coordination = asyncio.ensure_future(coordinator.run())
+        workers = asyncio.ensure_future(deliveries.run(functools.partial(deliver_job, tgclient)))
+        expiry = asyncio.ensure_future(ledger_retention.run())
 
         tgclient.add_event_handler(on_album)
         tgclient.add_event_handler(on_message)
+        tgclient.add_event_handler(on_edit)
+        tgclient.add_event_handler(on_delete)
+        tgclient.add_event_handler(on_chat_action)
+        tgclient.add_event_handler(functools.partial(on_channel_update, tgclient), tgevents.Raw(telethon.types.UpdateChannel))
 
         logger.info("Telethon client started, checking chats list..")
+        await sync_dialogs(tgclient)
+        await coordinator.refresh()
 
-        # TODO: change names of channels if they dont match since previous start
-        # TODO: listen for channel leaves/joins/renames and react accordingly
-        async for dialog in tgclient.iter_dialogs():
-            chname = ''
-            if dialog.title:
-                chname = dialog.title
-            elif dialog.first_name and dialog.last_name:
-                chname = f'{dialog.first_name} {dialog.last_name or ""}'
-            else:
-                # first name and/or last name is not available
-                chname = dialog.first_name
-                chname += " "+str(dialog.last_name) if dialog.last_name else "" # formatted last name
-
-            logger.debug(f'Found chat {chname} ({dialog.id})')
-            if session.query(TelegramChannel).filter(TelegramChannel.id == dialog.id).count() == 0:
-                if int(dialog.id) == 777000:  # do not add the Telegram system channel to the database at all
-                    continue
-
-                channel = TelegramChannel(id=dialog.id, name=chname, registered=False)
-                session.add(channel)
-                session.commit()
-                logger.info(f'{channel.name} ({channel.id} was added to the database.')
-            else:
-                channel = session.query(TelegramChannel).filter(TelegramChannel.id == dialog.id).one()
-                if channel.name != chname:
-                    channel.name = chname
-                    logger.info(f'Channel {chname} was renamed in Telegram, renaming to {channel.name} in database.')
-                    session.add(channel)
-                    session.commit()
-        else:
-            session.close()
+        catchup = None
+        if settings.backfill.enabled:
+            owned = lambda: [chat_id for chat_id in routes.watched() if coordinator.owns(chat_id)]
+            logger.info('Backfilling messages missed while the bridge was down..')
+            await backfiller.run(tgclient, owned())
+            catchup = asyncio.ensure_future(backfiller.watch(tgclient, owned))
 
         logger.info('Startup tasks were completed, listening for new events..')
         await tgclient.run_until_disconnected() # idle until told to stop
         logger.info("Signal received, exiting gracefully..")
+        routing.cancel()
+        coordination.cancel()
+        workers.cancel()
+        expiry.cancel()
+        if catchup:
+            catchup.cancel()
+        await dispatcher.close()
+        if metricsserver:
+            await metricsserver.cleanup()
+        await storage.close()
+        sqlexec.close()
 
         #we have received a signal to stop
         await tgclient.stop()
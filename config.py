@@ -1,14 +1,20 @@
-from typing import Tuple
-from pydantic import BaseModel, BaseSettings, root_validator, PostgresDsn
+from typing import Dict, List, Tuple
+from pydantic import BaseModel, BaseSettings, root_validator, validator
 from pydantic.env_settings import SettingsSourceCallable
 
 # pylint: disable=missing-class-docstring, missing-function-docstring, invalid-name
 
 class TelegramConfig(BaseModel):
     sessionfile: str = "tgbridge.session"  # TODO: make pathlike
+    name: str = None  # name of the shard running this account, defaults to sessionfile
     api_id: int
     api_hash: str
 
+    @validator('name', always=True)
+    def default_name(cls, value, values):
+        # pylint: disable=no-self-argument
+        return value or values.get('sessionfile')
+
 class LocalStorageConfig(BaseModel):
     enabled: bool = False
     file_prefix: str  # TODO: make pathlike
@@ -22,6 +28,10 @@ class B2StorageConfig(BaseModel):
     bucket_name: str = None
     bucket_id: str = None
     file_prefix: str = None  # TODO: make pathlike
+    realm: str = "production"  # or the URL of a local stand-in for the B2 API
+    upload_workers: int = 4  # files uploaded at the same time
+    part_workers: int = 4  # parts of a large file uploaded at the same time, each held in memory until it is
+    stream_buffer_size: int = 8 * 1024 * 1024  # bytes, streams bigger than this are uploaded as large files in parts of this size
 
     @root_validator
     def name_or_id(cls, values):
@@ -34,26 +44,126 @@ class B2StorageConfig(BaseModel):
 
         return values
 
+class S3StorageConfig(BaseModel):
+    enabled: bool = False
+    endpoint_url: str  # e.g. https://s3.eu-central-1.amazonaws.com, or http://127.0.0.1:9000 for a local MinIO
+    region: str = "us-east-1"
+    bucket_name: str
+    access_key: str
+    secret_key: str
+    url_prefix: str = None  # public URL of the bucket, defaults to the bucket under endpoint_url
+    file_prefix: str = None  # TODO: make pathlike
+    virtual_host: bool = False  # address the bucket as {bucket_name}.{endpoint host} instead of {endpoint_url}/{bucket_name}
+    connections: int = 16  # requests at the same time, over connections kept open between uploads
+    part_size: int = 8 * 1024 * 1024  # bytes, bigger files are uploaded in parts of this size
+    part_workers: int = 4  # parts of one file uploaded at the same time
+    timeout: float = 300.0  # seconds per request
+
+    @validator('part_size')
+    def minimum_part_size(cls, value):
+        # pylint: disable=no-self-argument
+        if value < 5 * 1024 * 1024:
+            raise ValueError("part_size must be at least 5 MiB, S3 rejects smaller parts")
+        return value
+
+# Names of the storage backends, each configured by the StorageConfig field of the same name.
+STORAGE_BACKENDS = ("local", "b2", "s3")
+
 class StorageConfig(BaseModel):
     cache_dir: str  # TODO: make pathlike
-    local: LocalStorageConfig = None  # needs one w/o enabled or both w/ enabled
+    backend: str = None  # one of STORAGE_BACKENDS, defaults to the enabled one
+    local: LocalStorageConfig = None
     b2: B2StorageConfig = None
+    s3: S3StorageConfig = None
 
     @root_validator
-    def one_handler(cls, values):
+    def one_backend(cls, values):
         # pylint: disable=no-self-argument
-        local, b2 = values.get('local'), values.get('b2')
-        if not local and not b2:
-            raise ValueError("One storage handler must be configured")
-        elif local.enabled and b2.enabled:
-            raise ValueError("Only one storage handler can be enabled")
-        
+        configured = [name for name in STORAGE_BACKENDS if values.get(name)]
+        if not configured:
+            raise ValueError("One storage backend must be configured")
+
+        backend = values.get('backend')
+        if backend is None:
+            enabled = [name for name in configured if values[name].enabled]
+            if len(enabled) > 1:
+                raise ValueError("Only one storage backend can be enabled, or pick one with backend")
+            elif not enabled and len(configured) > 1:
+                raise ValueError("Several storage backends are configured, enable one or pick one with backend")
+            backend = (enabled or configured)[0]
+        elif backend not in STORAGE_BACKENDS:
+            raise ValueError(f"backend must be one of {', '.join(STORAGE_BACKENDS)}")
+        elif backend not in configured:
+            raise ValueError(f"The {backend} storage backend is selected but not configured")
+
+        values['backend'] = backend
         return values
 
+class DeliveryConfig(BaseModel):
+    workers: int = 4  # messages delivered at the same time
+    max_attempts: int = 5  # deliveries tried before a message is marked dead
+    backoff: float = 5.0  # seconds before the first retry, doubled for every retry after it
+    lease: int = 300  # seconds before deliveries claimed by a bridge that stopped are taken over
+
+class MediaConfig(BaseModel):
+    max_file_size: int = None  # bytes, bigger files are linked to on Telegram instead of mirrored
+    channel_max_file_size: Dict[int, int] = {}  # chat id -> bytes, overrides max_file_size for that chat
+    parallel_threshold: int = 8 * 1024 * 1024  # bytes, bigger files are downloaded as parallel ranges
+    part_size: int = 2 * 1024 * 1024  # bytes per range, rounded down to a multiple of 512 KiB
+    connections: int = 4  # ranges of one file downloaded at the same time
+    deduplicate: bool = True  # store media posted in several chats or messages once, see mediaindex.py
+    hash_max_size: int = 16 * 1024 * 1024  # bytes, files of a known size up to this are also matched by content, spooled to cache_dir while hashed
+    index_cache_size: int = 10000  # stored media entries kept in memory
+
+class BackfillConfig(BaseModel):
+    enabled: bool = True
+    workers: int = 4  # chats backfilled at the same time
+    max_messages: int = 1000  # per chat, older missed messages are skipped
+    page_size: int = 100  # messages fetched per request, Telegram returns at most 100
+    page_wait: float = 1.0  # seconds between requests for one chat, keeps clear of flood waits
+
+class LedgerConfig(BaseModel):
+    retention_days: int = None  # ledger rows of messages older than this are dropped, kept forever if empty
+    partitioned: bool = False  # Postgres only, partition the ledger tables by message date
+    partition_interval: str = "month"  # day, week or month, the range of dates in one partition
+    archive: bool = False  # detach expired partitions and keep them as tables instead of dropping them
+    retention_interval: float = 3600.0  # seconds between retention runs
+
+    @validator('partition_interval')
+    def known_interval(cls, value):
+        # pylint: disable=no-self-argument
+        if value not in ("day", "week", "month"):
+            raise ValueError("partition_interval must be day, week or month")
+        return value
+
+class MetricsConfig(BaseModel):
+    enabled: bool = False
+    host: str = "127.0.0.1"  # serves http://host:port/metrics in the Prometheus text format
+    port: int = 9464
+
 class Settings(BaseSettings):
-    telegram: TelegramConfig
+    telegram: TelegramConfig = None
+    shards: List[TelegramConfig] = []  # accounts run in a process each, instead of telegram
     storage: StorageConfig
-    dburl: PostgresDsn  # TODO: allow building instead of raw db url
+    delivery: DeliveryConfig = DeliveryConfig()
+    media: MediaConfig = MediaConfig()
+    backfill: BackfillConfig = BackfillConfig()
+    ledger: LedgerConfig = LedgerConfig()
+    metrics: MetricsConfig = MetricsConfig()
+    dburl: str  # SQLAlchemy database URL, Postgres in production. TODO: allow building instead of raw db url
+    dbworkers: int = 4  # threads running database queries for the bridge
+    mediaworkers: int = 4  # media files downloaded and uploaded at the same time
+
+    @root_validator
+    def one_account(cls, values):
+        # pylint: disable=no-self-argument
+        shards = values.get('shards') or []
+        if not values.get('telegram') and not shards:
+            raise ValueError("Either telegram or shards must be configured")
+        if len({shard.name for shard in shards}) < len(shards):
+            raise ValueError("Shard names must be unique")
+
+        return values
 
     class Config:
         env_nested_delimiter = '__'
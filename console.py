@@ -3,10 +3,13 @@ from prompt_toolkit.patch_stdout import patch_stdout
 from rich.console import Console
 from rich.table import Table
 from rich import box
-from models import Webhook as DBWebhook, TelegramChannel, Watchgroup
+from models import Webhook as DBWebhook, TelegramChannel, Watchgroup, DeliveryJob, Shard, ShardChannel, dwh2tgc_association_table, dwh2wg_association_table
+from sqlalchemy import func
+import delivery
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from inspect import cleandoc
+from datetime import datetime
 import yaml
 import aiohttp
 import asyncio
@@ -19,152 +22,171 @@ config = yaml.safe_load(open('config.yml', mode="r"))
 sqlengine = create_engine(config['dburl'])
 sqlsessionmaker = sessionmaker(bind=sqlengine)
 
+# Rows per page of the list commands.
+PAGE_SIZE = 50
+
+# Webhooks and watchgroups are both numbered from 1, their ids are shown and typed with a prefix.
+PREFIXES = {DBWebhook: "wh", Watchgroup: "wg"}
+
+def display_id(object):
+    return f'{PREFIXES.get(type(object), "")}{object.id}'
+
+def parse_id(value):
+    """Model and primary key of an object id typed in the console, plain numbers are Telegram chats. (None, None) if it isn't an id."""
+    for model, prefix in PREFIXES.items():
+        if value.startswith(prefix) and value[len(prefix):].isdigit():
+            return model, int(value[len(prefix):])
+    if value.lstrip('-').isdigit():
+        return TelegramChannel, int(value)
+    return None, None
+
+def find(session, objectid):
+    """The webhook, watchgroup or Telegram channel with id `objectid`, or None."""
+    model, key = parse_id(objectid)
+    return session.get(model, key) if model else None
+
+def lookup(session, objectids):
+    """The webhooks, watchgroups and Telegram channels among `objectids`, with one query per type."""
+    keys = {DBWebhook: [], Watchgroup: [], TelegramChannel: []}
+    for value in objectids:
+        model, key = parse_id(value)
+        if model:
+            keys[model].append(key)
+
+    return tuple(session.query(model).filter(model.id.in_(ids)).all() if ids else [] for model, ids in keys.items())
+
+def listing(args):
+    """Name filter and page number of a list command, the page is given as `--page N` anywhere in it. Everything else is the filter, numbers too."""
+    args = [arg for arg in args if arg]
+    page = 1
+    for i, arg in enumerate(args[:-1]):
+        if arg == '--page' and args[i + 1].isdigit():
+            page = max(int(args[i + 1]), 1)
+            del args[i:i + 2]
+            break
+    return ' '.join(args), page
+
+def paginate(query, page):
+    """Rows of `page` of `query`, with the total number of rows and pages."""
+    total = query.order_by(None).count()
+    pages = max((total + PAGE_SIZE - 1) // PAGE_SIZE, 1)
+    return query.limit(PAGE_SIZE).offset((page - 1) * PAGE_SIZE).all(), total, pages
+
 def resolve(console, objects):
     session = sqlsessionmaker()
 
-    out = []
-    for object in objects:
-        try:
-            out += session.query(TelegramChannel).filter(TelegramChannel.id == int(object)).all()
-        except ValueError:
-            pass
+    webhooks, watchgroups, channels = lookup(session, objects)
+    out = [("Webhook", webhook) for webhook in webhooks] + [("Watchgroup", watchgroup) for watchgroup in watchgroups] + [("Telegram Channel", channel) for channel in channels]
 
-        out += session.query(DBWebhook).filter(DBWebhook.id == object).all()
-        out += session.query(Watchgroup).filter(Watchgroup.id == object).all()
+    table = Table("Type", "ID", box=box.SIMPLE, show_header=True, show_edge=True)
 
-    else:
-        table = Table("Type", "ID", box=box.SIMPLE, show_header=True, show_edge=True)
-
-        if len(out) > 0:
-            for object in out:
-                if isinstance(object, DBWebhook):
-                    objtype = "Webhook"
-                elif isinstance(object, Watchgroup):
-                    objtype = "Watchgroup"
-                elif isinstance(object, TelegramChannel):
-                    objtype = "Telegram Channel"
-                else:
-                    objtype = "Unknown"
-
-                table.add_row(str(objtype), str(object.id))
-            else:
-                console.print(table)
+    if len(out) > 0:
+        for objtype, object in out:
+            table.add_row(objtype, display_id(object))
         else:
-            print("No results found.")
+            console.print(table)
+    else:
+        print("No results found.")
 
 def info(console, object):
     session = sqlsessionmaker()
 
-    # TODO: optimize for one query if possible
-    if session.query(DBWebhook).filter(DBWebhook.id == object).count() > 0:
-        object = session.query(DBWebhook).filter(DBWebhook.id == object).one_or_none()
-
-        print(f'Webhook {object.id}')
+    object = find(session, object)
+    if isinstance(object, DBWebhook):
+        print(f'Webhook {display_id(object)}')
         print(f'URL: {object.url}')
         print(f'Managed by: {object.serverid}\n')
 
-        session.refresh(object)
+        channels = session.query(TelegramChannel).join(dwh2tgc_association_table).filter(dwh2tgc_association_table.c.webhookid == object.id).order_by(TelegramChannel.name)
+        channels, total, _ = paginate(channels, 1)
 
         table = Table("ID", "Name", "Registered?", title="Watched Channels", box=box.SIMPLE, show_header=True, show_edge=True)
-        if len(object.watched) > 0:
-            for channel in object.watched:
+        if len(channels) > 0:
+            for channel in channels:
                 table.add_row(str(channel.id), channel.name, str(channel.registered))
             else:
                 console.print(table)
+            if total > len(channels):
+                print(f'..and {total - len(channels)} more channels.')
         else:
             print("This webhook has no watched channels.")
 
-        session.refresh(object)
-
         table = Table("ID", "Name", title="Watched Watchgroups", box=box.SIMPLE, show_header=True, show_edge=True)
-        if len(object.watchgroups) > 0:
-            for channel in object.watchgroups:
-                table.add_row(str(channel.id), channel.name)
+        watchgroups = session.query(Watchgroup).join(dwh2wg_association_table).filter(dwh2wg_association_table.c.webhookid == object.id).order_by(Watchgroup.name).all()
+        if len(watchgroups) > 0:
+            for watchgroup in watchgroups:
+                table.add_row(display_id(watchgroup), watchgroup.name)
             else:
                 console.print(table)
         else:
             print("This webhook has no watched watchgroups.")
 
-    elif session.query(Watchgroup).filter(Watchgroup.id == object).count():
-        object = session.query(Watchgroup).filter(Watchgroup.id == object).one_or_none()
-
-        print(f'Watchgroup {object.id}')
+    elif isinstance(object, Watchgroup):
+        print(f'Watchgroup {display_id(object)}')
         print(f'Name: {object.name}')
+        print(f'Watched by {object.webhookcount} webhooks.')
 
-        session.refresh(object)
+        channels, total, _ = paginate(session.query(TelegramChannel).filter(TelegramChannel.watchgroupid == object.id).order_by(TelegramChannel.name), 1)
 
         table = Table("ID", "Name", "Registered?", title="Watched Channels", box=box.SIMPLE, show_header=True, show_edge=True)
-        if len(object.channels) > 0:
-            for channel in object.channels:
+        if len(channels) > 0:
+            for channel in channels:
                 table.add_row(str(channel.id), channel.name, str(channel.registered))
             else:
                 console.print(table)
+            if total > len(channels):
+                print(f'..and {total - len(channels)} more channels.')
         else:
             print("This watchgroup has no watched channels.")
 
-    elif session.query(TelegramChannel).filter(TelegramChannel.id == object).count():
-        object = session.query(TelegramChannel).filter(TelegramChannel.id == object).one_or_none()
-
+    elif isinstance(object, TelegramChannel):
         print(f'Telegram Channel {object.id}')
         print(f'Name: {object.name}')
         print(f'Registered? {object.registered}')
-
-        # print(f'Watched by {len(object.webhooks)} webhooks.')
+        print(f'Watched by {object.webhookcount} webhooks.')
     else:
         print("Unable to find any valid object with the given object id.")
 
 def remove(console, source, objects):
     session = sqlsessionmaker()
 
-    # TODO: optimize for one query if possible
-    if session.query(DBWebhook).filter(DBWebhook.id == source).count() > 0:
-        source = session.query(DBWebhook).filter(DBWebhook.id == source).one_or_none()
-    elif session.query(Watchgroup).filter(Watchgroup.id == source).count():
-        source = session.query(Watchgroup).filter(Watchgroup.id == source).one_or_none()
-    elif session.query(TelegramChannel).filter(TelegramChannel.id == object).count():
-        print("Telegram channels cannot have objects removed from them.")
-        return
-    else:
+    source = find(session, source)
+    if source is None:
         print("Unable to find any valid object with the given target object id.")
         return
+    elif isinstance(source, TelegramChannel):
+        print("Telegram channels cannot have objects removed from them.")
+        return
 
-    watchgroups = []
-    channels = []
+    _, watchgroups, channels = lookup(session, objects)
     dupcounter = 0
-    for value in objects:
-        watchgroups += session.query(Watchgroup).filter(Watchgroup.id == value).all()
-        try:
-            channels += session.query(TelegramChannel).filter(TelegramChannel.id == int(value)).all()
-        except ValueError:
-            pass
-
-    # TODO: DONT add if already in list instead of only incrementing dupcounter
+
     if isinstance(source, DBWebhook):
+        # each collection is loaded once, instead of scanned for every object
+        watched = set(source.watchgroups)
         for watchgroup in watchgroups:
-            if watchgroup not in source.watchgroups:
+            if watchgroup not in watched:
                 dupcounter += 1
             else:
                 source.watchgroups.remove(watchgroup)
+        watched = set(source.watched)
         for channel in channels:
-            if channel not in source.watched:
+            if channel not in watched:
                 dupcounter += 1
             else:
                 source.watched.remove(channel)
 
-        session.add(source)
         session.commit()
     elif isinstance(source, Watchgroup):
         for channel in channels:
-            if channel not in source.channels:
+            if channel.watchgroupid != source.id:
                 dupcounter += 1
             else:
-                source.channels.remove(channel)
+                channel.watchgroupid = None
 
-        session.add(source)
         session.commit()
         if len(watchgroups):
             print('Watchgroups cannot be removed from other watchgroups, because they cannot watch other watchgroups.')
-        # raise NotImplementedError("Adding to a Watchgroup is not implemented.")
 
     if dupcounter:
         print(f'Removed {len(watchgroups) + len(channels) - dupcounter} objects ({dupcounter} objects were not removed because they aren\'t watched)')
@@ -174,52 +196,43 @@ def remove(console, source, objects):
 def add(console, source, objects):
     session = sqlsessionmaker()
 
-    # TODO: optimize for one query if possible
-    if session.query(DBWebhook).filter(DBWebhook.id == source).count() > 0:
-        source = session.query(DBWebhook).filter(DBWebhook.id == source).one_or_none()
-    elif session.query(Watchgroup).filter(Watchgroup.id == source).count():
-        source = session.query(Watchgroup).filter(Watchgroup.id == source).one_or_none()
-    elif session.query(TelegramChannel).filter(TelegramChannel.id == object).count():
-        print("Telegram channels cannot have objects added to them.")
-        return
-    else:
+    source = find(session, source)
+    if source is None:
         print("Unable to find any valid object with the given target object id.")
         return
+    elif isinstance(source, TelegramChannel):
+        print("Telegram channels cannot have objects added to them.")
+        return
 
-    watchgroups = []
-    channels = []
+    _, watchgroups, channels = lookup(session, objects)
     dupcounter = 0
-    for value in objects:
-        watchgroups += session.query(Watchgroup).filter(Watchgroup.id == value).all()
-        try:
-            channels += session.query(TelegramChannel).filter(TelegramChannel.id == int(value)).all()
-        except ValueError:
-            pass
-
-    # TODO: DONT add if already in list instead of only incrementing dupcounter
+
     if isinstance(source, DBWebhook):
+        # each collection is loaded once, instead of scanned for every object
+        watched = set(source.watchgroups)
         for watchgroup in watchgroups:
-            if watchgroup in source.watchgroups:
+            if watchgroup in watched:
                 dupcounter += 1
-            source.watchgroups.append(watchgroup)
+            else:
+                source.watchgroups.append(watchgroup)
+        watched = set(source.watched)
         for channel in channels:
-            if channel in source.watched:
+            if channel in watched:
                 dupcounter += 1
-            source.watched.append(channel)
+            else:
+                source.watched.append(channel)
 
-        session.add(source)
         session.commit()
     elif isinstance(source, Watchgroup):
         for channel in channels:
-            if channel in source.channels:
+            if channel.watchgroupid == source.id:
                 dupcounter += 1
-            source.channels.append(channel)
+            else:
+                channel.watchgroupid = source.id
 
-        session.add(source)
         session.commit()
         if len(watchgroups):
             print('Watchgroups cannot be added to other watchgroups.')
-        # raise NotImplementedError("Adding to a Watchgroup is not implemented.")
 
     if dupcounter:
         print(f'Added {len(watchgroups) + len(channels) - dupcounter} objects ({dupcounter} objects were not added because they were already added)')
@@ -243,6 +256,8 @@ async def climain():
                     console.print(cleandoc("""
                         Telegram Bridge Commands
 
+                        Webhook ids start with wh, watchgroup ids with wg, Telegram channel ids are plain numbers.
+
                         info <object>                                    - Retrieve more detailed information on an object.
                         add <target> <object> <object> ...               - Add objects to target.
                         remove <target> <object> <object> ...            - Remove objects from target.
@@ -251,19 +266,23 @@ async def climain():
                         createwg <name>                                  - Create a Watchgroup
                         deletewebhook <id>                               - Delete a Discord Webhook
                         deletewg <id>                                    - Delete a Watchgroup
-                        listtgc                                          - List all Telegram channels
-                        listwg                                           - List all Watchgroups
-                        listwh                                           - List all Discord Webhooks
+                        listtgc [name] [--page N]                        - List Telegram channels, optionally only those named like name
+                        listwg [name] [--page N]                         - List Watchgroups, optionally only those named like name
+                        listwh [url] [--page N]                          - List Discord Webhooks, optionally only those with url in their URL
                         [strike]addtgctowg <telegram channel id> <watchgroup id>[/strike] - [strike]Add a Telegram channel to a Watchgroup[/strike]
                         [strike]addtgctowh <telegram channel id> <webhook id>[/strike]    - [strike]Add a Telegram channel to a Discord Webhook[/strike]
                         [strike]addwgtowh <watchgroup id> <webhook id>[/strike]           - [strike]Add a Watchgroup to a Discord Webhook[/strike]
                         registertg <telegram channel id>                 - Register a Telegram channel for use with the news feed.
                         deregistertg <telegram channel id>               - Revoke a Telegram channel from usage with the news feed.
+                        queue                                            - Show the delivery queue depth and dead deliveries.
+                        requeue <job id|dead>                            - Retry a dead delivery, or all of them.
+                        shards                                           - List shards, when they were last seen and how many chats they see.
+                        assignshard <telegram channel id> <shard|auto>   - Pin a Telegram channel to a shard, or let the shards assign it.
                     """))
 
                 elif result[0] == "clearwh":
-                    source = session.query(DBWebhook).filter(DBWebhook.id == result[1]).one_or_none()
-                    if source:
+                    source = find(session, result[1])
+                    if isinstance(source, DBWebhook):
                         source.watched.clear()
                         source.watchgroups.clear()
 
@@ -282,70 +301,82 @@ async def climain():
                                 session.add(wh)
                                 session.commit()
 
-                                print(f'created webhook with id {wh.id}')
+                                print(f'created webhook with id {display_id(wh)}')
                             else:
                                 print("failed")
                     else:
                         print('invalid')
                 elif result[0] == "deletewebhook":
-                    object = session.query(DBWebhook).filter(DBWebhook.id == result[1]).one_or_none()
+                    object = find(session, result[1])
 
-                    if object:
+                    if isinstance(object, DBWebhook):
                         session.delete(object)
                         session.commit()
-                        print(f"Deleted webhook with id {object.id}")
+                        print(f"Deleted webhook with id {display_id(object)}")
                 
                 elif result[0] == "deletewg":
-                    object = session.query(Watchgroup).filter(Watchgroup.id == result[1]).one_or_none()
+                    object = find(session, result[1])
 
-                    if object:
+                    if isinstance(object, Watchgroup):
                         session.delete(object)
                         session.commit()
-                        print(f"Deleted watchgroup named {object.name} with id {object.id}")
+                        print(f"Deleted watchgroup named {object.name} with id {display_id(object)}")
 
                 elif result[0] == "createwg":
                     wg = Watchgroup(name=result[1])
                     session.add(wg)
                     session.commit()
+                    print(f'created watchgroup with id {display_id(wg)}')
 
                 elif result[0] == 'listtgc':
-                    channels = session.query(TelegramChannel).all()
-                    table = Table("ID", "Name", "Registered?", box=box.SIMPLE, show_header=True, show_edge=True)
+                    search, page = listing(result[1:])
+                    query = session.query(TelegramChannel.id, TelegramChannel.name, TelegramChannel.registered, TelegramChannel.webhookcount.label('webhookcount')).order_by(TelegramChannel.name, TelegramChannel.id)
+                    if search:
+                        query = query.filter(TelegramChannel.name.ilike(f'%{search}%'))
+                    channels, total, pages = paginate(query, page)
+                    table = Table("ID", "Name", "Registered?", "Webhooks", box=box.SIMPLE, show_header=True, show_edge=True)
 
                     if len(channels) > 0:
                         for channel in channels:
-                            table.add_row(str(channel.id), channel.name, str(channel.registered))
+                            table.add_row(str(channel.id), channel.name, str(channel.registered), str(channel.webhookcount))
                         else:
                             console.print(table)
+                            print(f'Page {page} of {pages} ({total} channels)')
                     else:
                         print("There are no Telegram channels to list.")
 
                 elif result[0] == "listwg":
-                    table = Table("ID", "Name", "Watched Channels", box=box.SIMPLE, show_header=True, show_edge=True)
+                    search, page = listing(result[1:])
+                    query = session.query(Watchgroup.id, Watchgroup.name, Watchgroup.channelcount.label('channelcount'), Watchgroup.webhookcount.label('webhookcount')).order_by(Watchgroup.name)
+                    if search:
+                        query = query.filter(Watchgroup.name.ilike(f'%{search}%'))
+                    watchgroups, total, pages = paginate(query, page)
+                    table = Table("ID", "Name", "Watched Channels", "Webhooks", box=box.SIMPLE, show_header=True, show_edge=True)
 
-                    watchgroups = session.query(Watchgroup).all()
                     if len(watchgroups) > 0:
                         for watchgroup in watchgroups:
-                            table.add_row(str(watchgroup.id), watchgroup.name, str(len(watchgroup.channels)))
+                            table.add_row(f'wg{watchgroup.id}', watchgroup.name, str(watchgroup.channelcount), str(watchgroup.webhookcount))
                         else:
                             console.print(table)
+                            print(f'Page {page} of {pages} ({total} watchgroups)')
                     else:
                         print("There are no watchgroups to list.")
 
                 elif result[0] == 'listwh':
-                    webhooks = session.query(DBWebhook).all()
+                    search, page = listing(result[1:])
+                    query = session.query(DBWebhook.id, DBWebhook.url, DBWebhook.channelcount.label('channelcount'), DBWebhook.watchgroupcount.label('watchgroupcount')).order_by(DBWebhook.id)
+                    if search:
+                        query = query.filter(DBWebhook.url.contains(search))
+                    webhooks, total, pages = paginate(query, page)
                     table = Table("ID", "URL", "Watched Channels", "Watched Watchgroups", box=box.SIMPLE, show_header=True, show_edge=True)
 
                     # TODO: hide webhook data using regex: https:\/\/discord\.com\/api\/webhooks\/.*
                     if len(webhooks) > 0:
                         for webhook in webhooks:
-                            # SQLAlchemy ORM is weird and won't refresh changed children when appended
-                            # It WILL refresh the changed children list when it's cleared though
-                            # Occam's Razor method is just to session.refresh() it
-                            session.refresh(webhook)
-                            table.add_row(str(webhook.id), webhook.url[:50], str(len(webhook.watched)), str(len(webhook.watchgroups)))
+                            table.add_row(f'wh{webhook.id}', webhook.url[:50], str(webhook.channelcount), str(webhook.watchgroupcount))
                         else:
                             console.print(table)
+                            print(f'Page {page} of {pages} ({total} webhooks)')
                     else:
                         print("There are no webhooks to list.")
 
@@ -384,8 +415,8 @@ async def climain():
                         continue
 
                 elif result[0] == "registertg":
-                    for channel in result[1:]:
-                        tgc = session.query(TelegramChannel).filter(TelegramChannel.id == channel).one()
+                    _, _, channels = lookup(session, result[1:])
+                    for tgc in channels:
                         if int(tgc.id) == 777000:
                             print("The Telegram channel cannot be registered.")
                             continue
@@ -396,14 +427,58 @@ async def climain():
                         session.commit()
 
                 elif result[0] == "deregistertg":
-                    for channel in result[1:]:
-                        tgc = session.query(TelegramChannel).filter(TelegramChannel.id == channel).one()
+                    _, _, channels = lookup(session, result[1:])
+                    for tgc in channels:
                         tgc.registered = False
                         session.add(tgc)
                         print(f'Deregistered {tgc.name}')
                     else:
                         session.commit()
 
+                elif result[0] == "queue":
+                    counts, oldest = delivery.stats(session)
+                    print(f'Pending: {counts.get("pending", 0)}, Running: {counts.get("running", 0)}, Dead: {counts.get("dead", 0)}')
+                    if oldest is not None:
+                        print(f'Oldest pending delivery was queued {int(oldest.total_seconds())} seconds ago')
+
+                    jobs = session.query(DeliveryJob).filter(DeliveryJob.state == "dead").order_by(DeliveryJob.id).limit(20).all()
+                    if len(jobs) > 0:
+                        table = Table("ID", "Channel", "Message", "Attempts", "Error", title="Dead Deliveries", box=box.SIMPLE, show_header=True, show_edge=True)
+                        for job in jobs:
+                            table.add_row(str(job.id), str(job.channelid), str(job.messageid), str(job.attempts), (job.error or '')[:80])
+                        else:
+                            console.print(table)
+
+                elif result[0] == "requeue":
+                    query = session.query(DeliveryJob).filter(DeliveryJob.state == "dead")
+                    if len(result) > 1 and result[1] != "dead":
+                        query = query.filter(DeliveryJob.id == int(result[1]))
+
+                    count = query.update({"state": "pending", "attempts": 0, "availableat": datetime.utcnow(), "error": None}, synchronize_session=False)
+                    session.commit()
+                    print(f'Requeued {count} deliveries')
+
+                elif result[0] == "shards":
+                    visible = dict(session.query(ShardChannel.shard, func.count()).group_by(ShardChannel.shard).all())
+                    pinned = dict(session.query(TelegramChannel.shard, func.count()).filter(TelegramChannel.shard.isnot(None)).group_by(TelegramChannel.shard).all())
+                    shards = session.query(Shard).order_by(Shard.name).all()
+                    table = Table("Name", "Last Heartbeat", "Visible Chats", "Pinned Channels", box=box.SIMPLE, show_header=True, show_edge=True)
+
+                    if len(shards) > 0:
+                        for shard in shards:
+                            table.add_row(shard.name, f'{int((datetime.utcnow() - shard.heartbeat).total_seconds())} seconds ago', str(visible.get(shard.name, 0)), str(pinned.get(shard.name, 0)))
+                        else:
+                            console.print(table)
+                    else:
+                        print("There are no shards to list.")
+
+                elif result[0] == "assignshard":
+                    tgc = session.query(TelegramChannel).filter(TelegramChannel.id == result[1]).one()
+                    tgc.shard = None if result[2] == "auto" else result[2]
+                    session.add(tgc)
+                    session.commit()
+                    print(f'{tgc.name} is now ingested by {tgc.shard or "any shard that sees it"}')
+
                 elif result[0] == "exit":
                     exit(0)
 
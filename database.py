@@ -0,0 +1,54 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy.dialects import postgresql, sqlite
+
+from metrics import DB_SECONDS
+
+# pylint: disable=missing-class-docstring, missing-function-docstring, invalid-name
+
+
+def insert(session, model):
+    """INSERT statement for `model` supporting ON CONFLICT in the session's database."""
+    dialect = session.get_bind().dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert(model.__table__)
+    elif dialect == "sqlite":
+        return sqlite.insert(model.__table__)
+    else:
+        raise NotImplementedError(f"Upserts are not supported on {dialect}")
+
+
+class SessionExecutor:
+    """
+    Runs blocking SQLAlchemy work on a dedicated thread pool so it never stalls the event loop.
+
+    Every call gets a session of its own which is committed when the function returns and rolled
+    back if it raises. Sessions never cross threads or outlive the call, so functions should return
+    plain values rather than ORM objects.
+    """
+
+    def __init__(self, sessionmaker, max_workers=4):
+        self.sessionmaker = sessionmaker
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='db')
+
+    def _call(self, fn, *args, **kwargs):
+        session = self.sessionmaker()
+        try:
+            with DB_SECONDS.time(function=fn.__name__):
+                result = fn(session, *args, **kwargs)
+                session.commit()
+            return result
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    async def run(self, fn, *args, **kwargs):
+        """Call `fn(session, *args, **kwargs)` on the database thread pool and return its result."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(self._call, fn, *args, **kwargs))
+
+    def close(self):
+        self._executor.shutdown(wait=True)
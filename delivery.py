@@ -0,0 +1,187 @@
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime, timedelta
+from typing import List, NamedTuple
+
+from sqlalchemy import select, update, delete, func, or_, and_
+
+from database import insert
+from models import DeliveryJob
+
+# pylint: disable=missing-class-docstring, missing-function-docstring, invalid-name
+
+logger = logging.getLogger('bridge.delivery')
+
+
+class Job(NamedTuple):
+    id: int
+    channelid: int
+    messageid: int
+    messageids: List[int]
+    attempts: int
+
+
+def _enqueue(session, owner, channelid, messageids, now):
+    return session.execute(
+        insert(session, DeliveryJob)
+        .values(channelid=channelid, messageid=messageids[0], messageids=messageids, owner=owner, availableat=now, createdat=now)
+        .on_conflict_do_nothing(index_elements=["channelid", "messageid"])
+    ).rowcount
+
+def _claim(session, owner, limit, now, lease):
+    jobs = session.execute(
+        select(DeliveryJob)
+        .where(or_(DeliveryJob.owner == owner, DeliveryJob.owner.is_(None)))  # other shards' accounts may not see the chat
+        .where(or_(
+            and_(DeliveryJob.state == "pending", DeliveryJob.availableat <= now),
+            and_(DeliveryJob.state == "running", DeliveryJob.lockedat < now - timedelta(seconds=lease))  # stuck
+        ))
+        .order_by(DeliveryJob.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    ).scalars().all()
+
+    for job in jobs:
+        job.state, job.owner, job.lockedat = "running", owner, now
+
+    return [Job(job.id, job.channelid, job.messageid, job.messageids, job.attempts) for job in jobs]
+
+def _release(session, owner):
+    """Put jobs a previous run of `owner` was working on back in the queue."""
+    return session.execute(
+        update(DeliveryJob).where(DeliveryJob.state == "running", DeliveryJob.owner == owner).values(state="pending", lockedat=None)
+    ).rowcount
+
+def _complete(session, jobid):
+    session.execute(delete(DeliveryJob).where(DeliveryJob.id == jobid))
+
+def _fail(session, jobid, attempts, dead, availableat, error):
+    session.execute(
+        update(DeliveryJob).where(DeliveryJob.id == jobid)
+        .values(state="dead" if dead else "pending", attempts=attempts, availableat=availableat, lockedat=None, error=error)
+    )
+
+def stats(session):
+    """Number of jobs in each state and the age of the oldest pending job."""
+    counts = dict(session.execute(select(DeliveryJob.state, func.count()).group_by(DeliveryJob.state)).all())
+    oldest = session.execute(select(func.min(DeliveryJob.createdat)).where(DeliveryJob.state == "pending")).scalar()
+    return counts, (datetime.utcnow() - oldest if oldest else None)
+
+
+class DeliveryQueue:
+    """
+    Durable queue of Telegram messages waiting to be delivered, kept in the deliveryjob table.
+
+    Event handlers only enqueue a job, so slow webhooks or storage never hold up update processing
+    and a crash doesn't lose messages in flight. Workers claim jobs with SELECT .. FOR UPDATE SKIP
+    LOCKED, deliver the messages of a channel in order and messages of different channels in
+    parallel, and retry failures with exponential backoff until a job is marked dead.
+    """
+
+    def __init__(self, sqlexec, owner, workers=4, max_attempts=5, backoff=5.0, lease=300, poll_interval=5.0):
+        self.sqlexec = sqlexec
+        self.owner = owner  # name of this shard, it only delivers the jobs it enqueued
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self._messages = {}  # (channel id, message id) -> Telethon messages of jobs enqueued by this process
+        self._lanes = {}  # channel id -> jobs claimed for that channel, delivered one at a time
+        self._claimed = 0
+        self._slots = None
+        self._wakeup = None
+
+    @property
+    def inflight(self):
+        return self._claimed
+
+    async def enqueue(self, channelid, messages):
+        """Queue `messages` (a message or the messages of an album) from `channelid` for delivery."""
+        key = (channelid, messages[0].id)
+        queued = key in self._messages
+        self._messages[key] = messages  # before the job exists, a worker may claim it right away
+
+        try:
+            inserted = await self.sqlexec.run(_enqueue, self.owner, channelid, [message.id for message in messages], datetime.utcnow())
+        except BaseException:
+            if not queued:
+                self._messages.pop(key, None)
+            raise
+
+        if not inserted:
+            logger.debug(f'Telegram message with message id {messages[0].id} and chat id {channelid} is already queued')
+            if not queued:
+                self._messages.pop(key, None)  # queued by another shard, which delivers it
+
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def run(self, deliver):
+        """
+        Claim and deliver jobs until cancelled.
+
+        `deliver(channelid, messageids, messages)` is awaited for every job, `messages` is None when
+        the job was enqueued by another process or before a restart and has to be fetched again.
+        """
+        self._slots = asyncio.Semaphore(self.workers)
+        self._wakeup = asyncio.Event()
+
+        released = await self.sqlexec.run(_release, self.owner)
+        if released:
+            logger.info(f'Requeued {released} deliveries left unfinished by the last run')
+
+        while True:
+            self._wakeup.clear()
+
+            capacity = self.workers * 4 - self._claimed  # claim ahead a little so busy channels don't starve the rest
+            jobs = await self.sqlexec.run(_claim, self.owner, capacity, datetime.utcnow(), self.lease) if capacity > 0 else []
+
+            for job in jobs:
+                self._claimed += 1
+                if job.channelid in self._lanes:
+                    self._lanes[job.channelid].append(job)
+                else:
+                    self._lanes[job.channelid] = deque([job])
+                    asyncio.ensure_future(self._drain(job.channelid, deliver))
+
+            if not jobs or len(jobs) == capacity:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _drain(self, channelid, deliver):
+        lane = self._lanes[channelid]
+        while lane:
+            job = lane.popleft()
+            try:
+                async with self._slots:
+                    await self._process(job, deliver)
+            except Exception:
+                logger.exception(f'Unable to update delivery job {job.id}, it will be retried after {self.lease} seconds')
+            finally:
+                self._claimed -= 1
+                self._wakeup.set()
+
+        del self._lanes[channelid]
+
+    async def _process(self, job, deliver):
+        messages = self._messages.pop((job.channelid, job.messageid), None)
+
+        try:
+            await deliver(job.channelid, job.messageids, messages)
+        except Exception as err:  # pylint: disable=broad-except
+            attempts = job.attempts + 1
+            dead = attempts >= self.max_attempts
+            delay = self.backoff * 2 ** (attempts - 1)
+
+            if dead:
+                logger.exception(f'Giving up on Telegram message with message id {job.messageid} and chat id {job.channelid} after {attempts} attempts')
+            else:
+                logger.warning(f'Delivering Telegram message with message id {job.messageid} and chat id {job.channelid} failed ({err!r}), retrying in {delay} seconds')
+
+            await self.sqlexec.run(_fail, job.id, attempts, dead, datetime.utcnow() + timedelta(seconds=delay), repr(err))
+        else:
+            await self.sqlexec.run(_complete, job.id)
@@ -0,0 +1,44 @@
+import logging
+from datetime import datetime
+
+from sqlalchemy import select
+
+from database import insert
+from models import TelegramChannel, BridgeState
+
+# pylint: disable=missing-class-docstring, missing-function-docstring, invalid-name
+
+logger = logging.getLogger('bridge.dialogs')
+
+# Rows per INSERT statement, keeps SQLite under its bound parameter limit.
+BATCH_SIZE = 300
+
+
+def upsert(session, chats):
+    """
+    Add new chats and rename the ones renamed on Telegram, `chats` is a list of (chat id, name).
+
+    Renames are detected by the database, rows whose name didn't change are not written at all.
+    Returns the number of chats added or renamed.
+    """
+    names = {int(chid): name for chid, name in chats if int(chid) != 777000}  # never add the Telegram system channel
+    rows = [{"id": chid, "name": name, "registered": False} for chid, name in names.items()]
+
+    changed = 0
+    for i in range(0, len(rows), BATCH_SIZE):
+        stmt = insert(session, TelegramChannel).values(rows[i:i + BATCH_SIZE])
+        changed += session.execute(stmt.on_conflict_do_update(
+            index_elements=["id"],
+            set_={"name": stmt.excluded.name},
+            where=TelegramChannel.__table__.c.name.is_distinct_from(stmt.excluded.name)
+        )).rowcount
+
+    return changed
+
+def get_watermark(session, key):
+    """Date of the newest dialog seen by the last sync under `key`, or None if it never ran."""
+    value = session.execute(select(BridgeState.value).where(BridgeState.key == key)).scalar_one_or_none()
+    return datetime.fromisoformat(value) if value else None
+
+def set_watermark(session, key, date):
+    session.merge(BridgeState(key=key, value=date.isoformat()))
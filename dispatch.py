@@ -0,0 +1,151 @@
+import asyncio
+import json
+import logging
+import time
+
+import aiohttp
+
+from httpclient import ClientPool
+from metrics import WEBHOOK_REQUESTS, WEBHOOK_SECONDS, INFLIGHT
+
+# pylint: disable=missing-class-docstring, missing-function-docstring, invalid-name
+
+logger = logging.getLogger('bridge.dispatch')
+
+
+def _outcome(status):
+    if status == 429:
+        return 'rate_limited'
+    elif status >= 500:
+        return 'server_error'
+    elif status >= 400:
+        return 'client_error'
+    return 'success'
+
+
+class RateLimited(Exception):
+    """Discord kept rate limiting a request after every retry."""
+
+
+class RateLimitBucket:
+    """Discord rate limit state of one route of one webhook. Requests through a bucket are sent one at a time."""
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.remaining = None
+        self.reset_at = 0.0
+
+    def update(self, headers):
+        if headers.get('X-RateLimit-Remaining') is not None:
+            self.remaining = int(headers['X-RateLimit-Remaining'])
+        if headers.get('X-RateLimit-Reset-After') is not None:
+            self.reset_at = time.monotonic() + float(headers['X-RateLimit-Reset-After'])
+
+    async def wait(self):
+        if self.remaining == 0:
+            delay = self.reset_at - time.monotonic()
+            if delay > 0:
+                logger.debug(f'Rate limit bucket exhausted, waiting {delay:.2f} seconds')
+                await asyncio.sleep(delay)
+            self.remaining = None
+
+
+class WebhookDispatcher:
+    """
+    Executes Discord webhooks over one pooled HTTP session for the whole process.
+
+    Every webhook route gets its own rate limit bucket fed by Discord's X-RateLimit-* headers,
+    so a burst for one webhook waits for its bucket to reset instead of running into 429s,
+    and different webhooks are sent to in parallel.
+    """
+
+    def __init__(self, max_connections=100, max_retries=5, timeout=30):
+        self.max_retries = max_retries
+        self._pool = ClientPool(max_connections, timeout)
+        self._buckets = {}
+        self._global_reset = 0.0
+
+    @property
+    def session(self):
+        return self._pool.session
+
+    async def close(self):
+        await self._pool.close()
+
+    async def request(self, route, webhook, method, url, **kwargs):
+        """Make a request against `webhook`'s `route` bucket, return the decoded JSON response if there is one."""
+        bucket = self._buckets.setdefault((route, webhook.url), RateLimitBucket())
+
+        async with bucket.lock:
+            for _ in range(self.max_retries):
+                await bucket.wait()
+
+                delay = self._global_reset - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                with WEBHOOK_SECONDS.time(route=route), INFLIGHT.track_inprogress(kind='webhook_requests'):
+                    try:
+                        response = await self.session.request(method, url, **kwargs)
+                    except (aiohttp.ClientError, asyncio.TimeoutError):
+                        WEBHOOK_REQUESTS.inc(webhook=webhook.id, outcome='network_error')
+                        raise
+
+                async with response:
+                    bucket.update(response.headers)
+                    WEBHOOK_REQUESTS.inc(webhook=webhook.id, outcome=_outcome(response.status))
+
+                    if response.status == 429:
+                        try:
+                            data = await response.json(content_type=None)
+                        except ValueError:
+                            data = {}  # Cloudflare bans aren't JSON
+                        retry_after = float(data.get('retry_after') or response.headers.get('Retry-After', 1))
+
+                        if data.get('global') or response.headers.get('X-RateLimit-Global'):
+                            logger.warning(f'Hit the global rate limit, pausing all webhooks for {retry_after} seconds')
+                            self._global_reset = time.monotonic() + retry_after
+                        else:
+                            logger.warning(f'Webhook {webhook.id} was rate limited on {route}, retrying in {retry_after} seconds')
+                            bucket.remaining, bucket.reset_at = 0, time.monotonic() + retry_after
+                        continue
+
+                    response.raise_for_status()
+                    if response.status == 204:
+                        return None
+                    return await response.json()
+
+        raise RateLimited(f'Webhook {webhook.id} is still rate limited on {route} after {self.max_retries} attempts')
+
+    @staticmethod
+    def encode(content, username=None, avatar_url=None, embeds=None):
+        """JSON body executing a webhook, encoded once so it can be sent to any number of webhooks."""
+        payload = {'content': content, 'username': username, 'avatar_url': avatar_url, 'embeds': embeds}
+        return json.dumps({key: value for key, value in payload.items() if value is not None}).encode()
+
+    async def execute(self, webhook, body):
+        """Execute `webhook` with an encoded body and return the id of the Discord message it created."""
+        message = await self.request('execute', webhook, 'POST', webhook.url, params={'wait': 'true'}, data=body, headers={'Content-Type': 'application/json'})
+        return int(message['id'])
+
+    async def send(self, webhook, content, username=None, avatar_url=None, embeds=None):
+        """Execute `webhook` and return the id of the Discord message it created."""
+        return await self.execute(webhook, self.encode(content, username=username, avatar_url=avatar_url, embeds=embeds))
+
+    async def edit(self, webhook, messageid, content, embeds=None):
+        """Replace the content and embeds of message `messageid` sent by `webhook`."""
+        body = json.dumps({'content': content, 'embeds': embeds or []}).encode()
+        await self.request('edit', webhook, 'PATCH', f'{webhook.url}/messages/{messageid}', data=body, headers={'Content-Type': 'application/json'})
+
+    async def delete(self, webhook, messageid):
+        """Delete message `messageid` sent by `webhook`, messages that are already gone count as deleted."""
+        try:
+            await self.request('delete', webhook, 'DELETE', f'{webhook.url}/messages/{messageid}')
+        except aiohttp.ClientResponseError as err:
+            if err.status != 404:
+                raise
+
+    async def fanout(self, webhooks, content, **kwargs):
+        """Send the same message to every webhook at once. Returns message ids, or exceptions for failed sends, in webhook order."""
+        body = self.encode(content, **kwargs)
+        return await asyncio.gather(*(self.execute(webhook, body) for webhook in webhooks), return_exceptions=True)
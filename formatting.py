@@ -0,0 +1,234 @@
+import asyncio
+import logging
+import re
+from typing import NamedTuple, Optional
+
+import telethon
+
+from cache import TTLCache
+
+# pylint: disable=missing-class-docstring, missing-function-docstring, invalid-name
+
+logger = logging.getLogger('bridge.formatting')
+
+# Characters Discord reads as markdown, escaped in plain text so they show up literally.
+MARKDOWN_CHARS = re.compile(r"[\\*_~`|>\[\]]")
+# Between two backticks in code, which Discord would otherwise read as the end of it.
+BACKTICK_RUN = re.compile(r"(?<=`)(?=`)")
+ZERO_WIDTH_SPACE = "\u200b"
+
+# Entities that are wrapped in Discord markdown markers as-is.
+WRAPPING_ENTITIES = {
+    telethon.types.MessageEntityBold: "**",
+    telethon.types.MessageEntityItalic: "*",
+    telethon.types.MessageEntityStrike: "~~",
+    telethon.types.MessageEntityUnderline: "__",  # parsed as --text-- on telegram
+    telethon.types.MessageEntitySpoiler: "||",
+}
+
+# Entities that Discord either detects by itself or has no equivalent for, their text is kept as-is.
+PLAIN_ENTITIES = tuple(getattr(telethon.types, name) for name in (
+    "MessageEntityHashtag", "MessageEntityCashtag", "MessageEntityBotCommand", "MessageEntityEmail",
+    "MessageEntityPhone", "MessageEntityBankCard", "MessageEntityCustomEmoji"
+) if hasattr(telethon.types, name))
+
+
+def escape_markdown(text):
+    return MARKDOWN_CHARS.sub(lambda match: "\\" + match.group(), text)
+
+def _wrap(text, marker):
+    # Discord doesn't render "** bold **", so surrounding whitespace is moved outside of the markers.
+    stripped = text.strip()
+    if not stripped:
+        return text
+
+    start = len(text) - len(text.lstrip())
+    return f'{text[:start]}{marker}{stripped}{marker}{text[start + len(stripped):]}'
+
+def _decode(utf16, start, end):
+    return utf16[start * 2 : end * 2].decode("utf-16-le", errors="replace")
+
+def _span_key(span):
+    return span[0], -span[1]  # outer entities before the entities nested in them
+
+def _render_entity(utf16, start, end, entity, children):
+    raw = _decode(utf16, start, end)
+
+    # "https://example.com" creates these. Telegram will automatically add "https://" to URLs without a scheme.
+    if isinstance(entity, telethon.types.MessageEntityUrl):
+        return raw if "://" in raw else "https://" + raw
+
+    # "``` ```" creates these. Standard Markdown code block.
+    if isinstance(entity, telethon.types.MessageEntityPre):
+        # Discord has no longer fences, backticks are kept apart so they can't close the block early
+        raw = BACKTICK_RUN.sub(ZERO_WIDTH_SPACE, raw)
+        if raw.endswith("`"):
+            raw += ZERO_WIDTH_SPACE
+        return f"```{entity.language}\n{raw}```"
+
+    if isinstance(entity, telethon.types.MessageEntityCode):
+        if "`" not in raw:
+            return f"`{raw}`"
+        # Discord drops one space on each side of double backtick code, like CommonMark
+        raw = BACKTICK_RUN.sub(ZERO_WIDTH_SPACE, raw)
+        pad = " " if raw.startswith("`") or raw.endswith("`") else ""
+        return f"``{pad}{raw}{pad}``"
+
+    inner = _render(utf16, children, start, end)
+
+    # Special hyperlinks, Ctrl-K creates these on Telegram desktop.
+    if isinstance(entity, telethon.types.MessageEntityTextUrl):
+        return f"[{inner}]({entity.url.replace(')', '%29').replace(' ', '%20')})"
+
+    # "@username" creates these.
+    if isinstance(entity, telethon.types.MessageEntityMention):
+        return f"[{inner}](https://t.me/{raw.lstrip('@')})"
+
+    # Don't know what creates these, mentioning user who doesn't have username?
+    if isinstance(entity, telethon.types.MessageEntityMentionName):
+        return f"[{inner}](https://t.me/{entity.user_id})"
+
+    # These exist for making sure that the Telegram markdown syntax is translated to Discord's syntax,
+    # and are self-explanatory as a result.
+    marker = WRAPPING_ENTITIES.get(type(entity))
+    if marker:
+        return _wrap(inner, marker)
+
+    if isinstance(entity, telethon.types.MessageEntityBlockquote):
+        return "\n".join("> " + line for line in inner.split("\n"))
+
+    if not isinstance(entity, PLAIN_ENTITIES):
+        logger.warning(f'Invalid MessageEntity type {type(entity)}: {raw}')
+    return inner
+
+def _render(utf16, spans, start, end):
+    out = []
+    pos = start
+    i = 0
+
+    while i < len(spans):
+        span_start, span_end, entity = spans[i]
+
+        # Everything starting before this entity ends is nested in it. Entities crossing its end
+        # can't be expressed in markdown, so they are split at the boundary.
+        j = i + 1
+        children, overflow = [], []
+        while j < len(spans) and spans[j][0] < span_end:
+            child_start, child_end, child = spans[j]
+            if child_end > span_end:
+                children.append((child_start, span_end, child))
+                overflow.append((span_end, child_end, child))
+            else:
+                children.append(spans[j])
+            j += 1
+
+        out.append(escape_markdown(_decode(utf16, pos, span_start)))
+        out.append(_render_entity(utf16, span_start, span_end, entity, children))
+        pos = span_end
+
+        if overflow:
+            spans, i = sorted(overflow + spans[j:], key=_span_key), 0
+        else:
+            i = j
+
+    out.append(escape_markdown(_decode(utf16, pos, end)))
+    return "".join(out)
+
+def render_entities(text, entities):
+    """
+    Translate `text` with Telegram message entities to Discord markdown in a single pass.
+
+    Telegram offsets are in UTF-16 code units, so the text is encoded once and every piece is sliced
+    out by offset instead of searched for. Nested entities are rendered inside their parent and plain
+    text is escaped so Discord shows it literally.
+    """
+    if not text:
+        return ""
+
+    utf16 = text.encode("utf-16-le")
+    size = len(utf16) // 2
+
+    spans = []
+    for entity in entities or ():
+        start, end = max(entity.offset, 0), min(entity.offset + entity.length, size)
+        if start < end:
+            spans.append((start, end, entity))
+    spans.sort(key=_span_key)
+
+    return _render(utf16, spans, 0, size)
+
+
+# TODO: Might have an option to disable URL previews because most people who use Telegram
+# are used to not having them and will do it themselves
+# which may conflict with having URL previews
+def format_message(message):
+    return render_entities(message.message, message.entities)
+
+class ForwardOrigin(NamedTuple):
+    title: Optional[str]  # channels and groups
+    username: Optional[str]
+    first_name: Optional[str]  # users
+    last_name: Optional[str]
+
+# Forward origins by peer id, news channels forward from the same few sources all day.
+forward_origins = TTLCache(maxsize=1024, ttl=3600)
+_origins_inflight = {}
+
+async def _fetch_forward_origin(forward):
+    if isinstance(forward.from_id, telethon.types.PeerUser):
+        ent = await forward.get_sender()
+    else:
+        ent = await forward.get_chat()
+
+    return ForwardOrigin(getattr(ent, 'title', None), ent.username, getattr(ent, 'first_name', None), getattr(ent, 'last_name', None))
+
+async def resolve_forward_origin(forward):
+    """Name and username of the chat or user `forward` came from, Telegram is only asked when it isn't cached."""
+    peerid = telethon.utils.get_peer_id(forward.from_id)
+    origin = forward_origins.get(peerid)
+    if origin is not None:
+        return origin
+
+    fetch = _origins_inflight.get(peerid)
+    if fetch is None:
+        fetch = asyncio.ensure_future(_fetch_forward_origin(forward))
+        _origins_inflight[peerid] = fetch
+        fetch.add_done_callback(lambda _: _origins_inflight.pop(peerid, None))
+
+    origin = await asyncio.shield(fetch)
+    forward_origins.put(peerid, origin)
+    return origin
+
+async def format_forwarding(event):
+    if event.forward:
+        # Accounts which hide their account link in forwards will have a name but no ID.
+        if event.forward.from_name and not event.forward.from_id:
+            return f'{event.forward.from_name} (Hidden Account)'
+        # Accounts that allow passing their account link in forwards will have an attached PeerUser.
+        # In this context, the username is the account link.
+        elif isinstance(event.forward.from_id, telethon.types.PeerUser):
+            ent = await resolve_forward_origin(event.forward)
+            fwname = "Forwarded from"
+
+            if ent.first_name:
+                fwname += " "+ent.first_name
+            if ent.last_name:
+                fwname += " "+ent.last_name
+            if ent.username:
+                fwname += " @"+ent.username
+
+            return fwname
+        # Channels will have an attached ID.
+        elif isinstance(event.forward.from_id, telethon.types.PeerChannel):
+            ent = await resolve_forward_origin(event.forward)
+            # The channel has a channel link (public)
+            # In this context, the username is the channel link.
+            if ent.username:
+                if event.forward.post_author:
+                    # The channel will show the author of the message instead of only the channel name.
+                    return f'Forwarded from [{ent.title}](<https://t.me/{ent.username}> "Join this channel on Telegram") ({event.forward.post_author})'
+                else:
+                    return f'Forwarded from [{ent.title}](<https://t.me/{ent.username}> "Join this channel on Telegram")'
+            else:
+                # The channel has no link (private)
+                return f'Forwarded from {ent.title} (Private Channel)'
@@ -0,0 +1,30 @@
+import aiohttp
+
+# pylint: disable=missing-class-docstring, missing-function-docstring, invalid-name
+
+
+class ClientPool:
+    """
+    One pooled aiohttp session for the life of the process, so connections are kept open between requests.
+
+    The session is created lazily on first use, aiohttp sessions must be made inside the running
+    event loop, and again if it was closed.
+    """
+
+    def __init__(self, max_connections=100, timeout=30):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
@@ -0,0 +1,100 @@
+import logging
+from datetime import timezone
+
+from sqlalchemy import select, update
+
+from database import insert
+from models import TelegramMessage, DiscordMessage, Webhook
+import shards
+
+# pylint: disable=missing-class-docstring, missing-function-docstring, invalid-name
+
+logger = logging.getLogger('bridge.ledger')
+
+
+def utc(date):
+    """Telegram message date as it is stored in the ledger, naive UTC like the other DateTime columns."""
+    return date.astimezone(timezone.utc).replace(tzinfo=None) if date.tzinfo else date
+
+def _find(session, channelid, messageid):
+    # by the prefix of the unique index, rows from before the ledger was dated carry the date of the migration instead
+    return session.execute(
+        select(TelegramMessage.id, TelegramMessage.shard, TelegramMessage.date)
+        .where(TelegramMessage.channelid == channelid, TelegramMessage.messageid == messageid)
+        .order_by(TelegramMessage.date).limit(1)
+    ).first()
+
+def claim(session, channelid, messageid, date, shard=None, timeout=shards.HEARTBEAT_TIMEOUT):
+    """
+    Get the ledger entry of a Telegram message for `shard`, creating it if needed. Returns its id and ledger date with the ids of webhooks that already sent the message.
+
+    `date` is the date of the message on Telegram, it is the same for every event of a message.
+    An existing entry keeps its own date, which is passed on to record(). Returns None if another
+    shard that is still alive, by a heartbeat in the last `timeout` seconds, claimed the message first.
+    Pass the coordinator's timeout so the ledger and the shard assignment agree on which shards are alive.
+    """
+    found = _find(session, channelid, messageid)
+    if found is None:
+        inserted = session.execute(
+            insert(session, TelegramMessage)
+            .values(channelid=channelid, messageid=messageid, shard=shard, date=utc(date))
+            .on_conflict_do_nothing(index_elements=["channelid", "messageid", "date"])
+        ).rowcount
+
+        found = _find(session, channelid, messageid)  # or the entry of a shard that claimed it at the same time
+        if inserted:
+            return found.id, found.date, set()
+
+    tmsgid, owner, date = found
+    if shard is not None and owner not in (None, shard):
+        if shards.is_alive(session, owner, timeout):
+            logger.warning(f"Telegram message with message id {messageid} and chat id {channelid} was claimed by shard {owner}")
+            return None
+
+        # the shard that claimed it stopped, take the message over unless another shard just did
+        if not session.execute(update(TelegramMessage).where(TelegramMessage.id == tmsgid, TelegramMessage.shard == owner).values(shard=shard)).rowcount:
+            return None
+
+    # this message MAY have been processed before, but check webhooks anyway
+    logger.warning(f"Telegram message with message id {messageid} and chat id {channelid} has been processed before")
+    return tmsgid, date, set(session.execute(select(DiscordMessage.webhookid).where(DiscordMessage.tgmessageid == tmsgid, DiscordMessage.date == date)).scalars())
+
+def record(session, tmsgid, date, delivered):
+    """Log a whole fan-out of a Telegram message at once, `delivered` is a list of (Discord message id, webhook id). `date` is the ledger date claim() returned."""
+    if not delivered:
+        return
+
+    date = utc(date)
+    session.execute(
+        insert(session, DiscordMessage).on_conflict_do_nothing(),
+        [{"id": dmessageid, "tgmessageid": tmsgid, "webhookid": webhookid, "date": date} for dmessageid, webhookid in delivered]
+    )
+
+# Telegram message ids per IN list, Telegram deletes up to 100 at once but channels can be purged in bulk.
+BATCH_SIZE = 500
+
+def lookup(session, channelid, messageids, shard=None):
+    """
+    Discord messages mirroring the Telegram messages `messageids` of `channelid`, as (Telegram message id, Discord message id, webhook id, webhook URL).
+
+    Deletions outside of channels don't say which chat they were in, message ids are unique per
+    account there, so `channelid` None looks the messages up in every chat that isn't a channel
+    and was delivered by `shard`.
+    """
+    found = []
+    messageids = list(messageids)
+    for i in range(0, len(messageids), BATCH_SIZE):
+        query = (
+            select(TelegramMessage.messageid, DiscordMessage.id, Webhook.id, Webhook.url)
+            .join(DiscordMessage, (DiscordMessage.tgmessageid == TelegramMessage.id) & (DiscordMessage.date == TelegramMessage.date))
+            .join(Webhook, Webhook.id == DiscordMessage.webhookid)
+            .where(TelegramMessage.messageid.in_(messageids[i:i + BATCH_SIZE]))
+        )
+        if channelid is None:
+            query = query.where(TelegramMessage.channelid > -1000000000000, TelegramMessage.shard == shard)  # channel ids are marked below this
+        else:
+            query = query.where(TelegramMessage.channelid == channelid)
+
+        found += [tuple(row) for row in session.execute(query)]
+
+    return found
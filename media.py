@@ -0,0 +1,101 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import deque
+
+from metrics import MEDIA_BYTES, MEDIA_PENDING, STAGE_SECONDS
+
+# pylint: disable=missing-class-docstring, missing-function-docstring, invalid-name
+
+logger = logging.getLogger('bridge.media')
+
+# Bytes asked from Telegram per request, the largest size it allows. Offsets have to be multiples of it.
+REQUEST_SIZE = 512 * 1024
+
+
+class Progress:
+    """Bytes received of a download in progress, logged every quarter of the way."""
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.received = 0
+        self.waited = 0.0  # seconds the reader spent waiting for Telegram
+        self._logged = 0
+
+    @property
+    def remaining(self):
+        return max(self.size - self.received, 0) if self.size else 0
+
+    def add(self, count):
+        self.received += count
+        MEDIA_BYTES.inc(count)
+
+        if self.size:
+            quarter = self.received * 4 // self.size
+            if quarter > self._logged:
+                self._logged = quarter
+                logger.debug(f'Downloaded {self.received} of {self.size} bytes of {self.name} ({min(quarter, 4) * 25}%)')
+
+# Downloads in progress by name.
+downloads = {}
+MEDIA_PENDING.set_function(lambda: sum(progress.remaining for progress in list(downloads.values())))
+
+def human_size(size):
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+async def _fetch_range(tgclient, media, offset, size):
+    chunks = []
+    async for chunk in tgclient.iter_download(media, offset=offset, request_size=REQUEST_SIZE, limit=-(-size // REQUEST_SIZE)):
+        chunks.append(chunk)
+    return b"".join(chunks)[:size]
+
+async def iter_download(tgclient, media, size, name, part_size=4 * REQUEST_SIZE, connections=4, threshold=8 * 1024 * 1024):
+    """
+    Download `media` of `size` bytes as an async iterator of bytes, in order.
+
+    Files of at least `threshold` bytes are fetched as `part_size` byte ranges, `connections` of
+    them at a time, so a big file isn't limited to the throughput of a single request stream. At
+    most `connections` ranges are held in memory. Only the time spent waiting for Telegram counts as
+    the download stage, not the time the reader spends on each chunk.
+    """
+    progress = downloads[name] = Progress(name, size)
+    try:
+        if not size or size < threshold:
+            resumed = time.perf_counter()
+            async for chunk in tgclient.iter_download(media):
+                progress.waited += time.perf_counter() - resumed
+                progress.add(len(chunk))
+                yield chunk
+                resumed = time.perf_counter()
+            return
+
+        part_size = max(part_size // REQUEST_SIZE, 1) * REQUEST_SIZE
+        offsets = iter(range(0, size, part_size))
+        window = deque(
+            asyncio.ensure_future(_fetch_range(tgclient, media, offset, min(part_size, size - offset)))
+            for offset in itertools.islice(offsets, connections)
+        )
+        try:
+            while window:
+                start = time.perf_counter()
+                data = await window.popleft()
+                progress.waited += time.perf_counter() - start
+
+                offset = next(offsets, None)
+                if offset is not None:
+                    window.append(asyncio.ensure_future(_fetch_range(tgclient, media, offset, min(part_size, size - offset))))
+
+                progress.add(len(data))
+                yield data
+        finally:
+            for task in window:
+                task.cancel()
+    finally:
+        downloads.pop(name, None)
+        STAGE_SECONDS.observe(progress.waited, stage='media_download')
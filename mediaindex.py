@@ -0,0 +1,65 @@
+import logging
+
+import telethon
+from sqlalchemy import select
+
+from cache import TTLCache
+from database import insert
+from models import StoredMedia
+
+# pylint: disable=missing-class-docstring, missing-function-docstring, invalid-name
+
+logger = logging.getLogger('bridge.mediaindex')
+
+
+def media_key(message):
+    """Key of the file of `message` by its Telegram id, which forwards of the message share. None if it has no such id."""
+    media = message.file.media if message.file else None
+    if isinstance(media, telethon.types.Document):
+        return f"document:{media.id}"
+    elif isinstance(media, telethon.types.Photo):
+        return f"photo:{media.id}"
+    return None
+
+def content_key(digest):
+    """Key of a file by the hashlib SHA-256 `digest` of its content, shared by copies uploaded to Telegram separately."""
+    return f"sha256:{digest.hexdigest()}"
+
+def _lookup(session, key):
+    return session.execute(select(StoredMedia.url).where(StoredMedia.key == key)).scalar()
+
+def _store(session, keys, url):
+    statement = insert(session, StoredMedia).values([{"key": key, "url": url} for key in keys])
+    session.execute(statement.on_conflict_do_nothing(index_elements=["key"]))
+
+
+class MediaIndex:
+    """
+    Maps media that is already stored to its public URL, so media posted in many chats is stored once.
+
+    Entries are persisted in the database and the recently used ones are kept in memory in front of
+    it. A file stays in storage once uploaded, so entries never go stale.
+    """
+
+    def __init__(self, sqlexec, cache_size=10000):
+        self.sqlexec = sqlexec
+        self._urls = TTLCache(maxsize=cache_size, ttl=24 * 3600)
+
+    async def get(self, key):
+        """Public URL of the media stored under `key`, or None if it hasn't been stored yet."""
+        url = self._urls.get(key)
+        if url is None:
+            url = await self.sqlexec.run(_lookup, key)
+            if url is not None:
+                self._urls.put(key, url)
+        return url
+
+    async def add(self, keys, url):
+        """Record that the media known by each of `keys` is stored at `url`."""
+        keys = [key for key in keys if key]
+        if not keys:
+            return
+
+        for key in keys:
+            self._urls.put(key, url)
+        await self.sqlexec.run(_store, keys, url)
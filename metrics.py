@@ -0,0 +1,182 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+# pylint: disable=missing-class-docstring, missing-function-docstring, invalid-name
+
+logger = logging.getLogger('bridge.metrics')
+
+# Seconds, long enough at the top for big media transfers.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{_escape(value)}"' for name, value in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """A metric with a value per combination of label values, safe to update from any thread."""
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} takes labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, (), value) for key, value in self._values.items()]
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for name, key, extra, value in self.samples():
+            lines.append(f'{name}{_labels(self.labelnames, key, extra)} {_number(value)}')
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self._functions = {}
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, fn, **labels):
+        """Read the value from `fn()` whenever the metric is scraped."""
+        self._functions[self._key(labels)] = fn
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def samples(self):
+        samples = super().samples()
+        for key, fn in list(self._functions.items()):
+            samples.append((self.name, key, (), fn()))
+        return samples
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self.buckets), 0.0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the body of the with statement took, also when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    samples.append((f'{self.name}_bucket', key, (('le', _number(bound)),), cumulative))
+                samples.append((f'{self.name}_sum', key, (), total))
+                samples.append((f'{self.name}_count', key, (), cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def expose(self):
+        """All metrics in the Prometheus text exposition format."""
+        return '\n'.join(metric.expose() for metric in self._metrics) + '\n'
+
+REGISTRY = Registry()
+
+
+async def serve(host, port, registry=REGISTRY):
+    """Serve `registry` on http://host:port/metrics until the returned runner is cleaned up."""
+    async def handle(request):
+        return web.Response(text=registry.expose(), content_type='text/plain', charset='utf-8', headers={'X-Content-Type-Options': 'nosniff'})
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f'Serving metrics on http://{host}:{port}/metrics')
+    return runner
+
+
+# Metrics of the bridge pipeline.
+EVENTS = Counter('tgbridge_events_total', 'Telegram events received.', ['kind'])
+EVENTS_UNWATCHED = Counter('tgbridge_events_unwatched_total', 'Telegram events dropped because no webhook watches their chat.', ['kind'])
+STAGE_SECONDS = Histogram('tgbridge_stage_duration_seconds', 'Time spent in each stage of the pipeline.', ['stage'])
+WEBHOOK_REQUESTS = Counter('tgbridge_webhook_requests_total', 'Discord webhook requests by outcome, rate_limited counts 429 responses.', ['webhook', 'outcome'])
+WEBHOOK_SECONDS = Histogram('tgbridge_webhook_request_duration_seconds', 'Duration of Discord webhook requests.', ['route'])
+INFLIGHT = Gauge('tgbridge_inflight', 'Work currently in progress.', ['kind'])
+MEDIA_BYTES = Counter('tgbridge_media_downloaded_bytes_total', 'Bytes of media downloaded from Telegram.')
+MEDIA_PENDING = Gauge('tgbridge_media_pending_bytes', 'Bytes of the media downloads in progress that are still to be downloaded.')
+MEDIA_DEDUPLICATED = Counter('tgbridge_media_deduplicated_total', 'Media files not stored again because the same file already was, by what matched it.', ['by'])
+MEDIA_OVERSIZED = Counter('tgbridge_media_oversized_total', 'Media files linked instead of mirrored because they are over the size limit.')
+DB_SECONDS = Histogram('tgbridge_db_query_duration_seconds', 'Duration of database work run on the database executor.', ['function'])
@@ -0,0 +1,174 @@
+"""
+Versioned schema changes that can't be made by adding tables, columns or indexes, see schema.py.
+
+Each migration gets a connection inside the upgrade transaction and brings a database from the
+previous version to its own. Migrations describe the tables they create themselves, models.py
+keeps changing after a migration is written.
+"""
+import logging
+from datetime import datetime
+
+from sqlalchemy import MetaData, Table, Column, String, BigInteger, Integer, Boolean, DateTime, ForeignKey, Index, inspect, select, func, text, insert, null
+
+# pylint: disable=missing-class-docstring, missing-function-docstring, invalid-name
+
+logger = logging.getLogger('bridge.schema')
+
+
+def _v1_tables():
+    key = BigInteger().with_variant(Integer, "sqlite")
+    metadata = MetaData()
+
+    Table('dwebhook', metadata,
+        Column('id', key, primary_key=True, autoincrement=True),
+        Column('url', String(128), nullable=False, unique=True),
+        Column('serverid', BigInteger, nullable=False),
+        Column('active', Boolean, server_default='1'),
+    )
+    Table('tgwatchgroup', metadata,
+        Column('id', key, primary_key=True, autoincrement=True),
+        Column('name', String(128), unique=True, nullable=False),
+    )
+    Table('tgchannel', metadata,
+        Column('id', BigInteger, primary_key=True),
+        Column('name', String(128)),
+        Column('registered', Boolean, server_default='1'),
+        Column('watchgroupid', BigInteger, ForeignKey('tgwatchgroup.id')),
+        Column('shard', String(128)),
+        Index('ix_tgchannel_watchgroupid', 'watchgroupid'),
+    )
+    Table('dwh2wg_association', metadata,
+        Column('webhookid', BigInteger, ForeignKey('dwebhook.id'), primary_key=True),
+        Column('watchgroupid', BigInteger, ForeignKey('tgwatchgroup.id'), primary_key=True),
+        Index('ix_dwh2wg_association_watchgroupid', 'watchgroupid'),
+    )
+    Table('dwh2tgc_association', metadata,
+        Column('webhookid', BigInteger, ForeignKey('dwebhook.id'), primary_key=True),
+        Column('tgchannelid', BigInteger, ForeignKey('tgchannel.id'), primary_key=True),
+        Index('ix_dwh2tgc_association_tgchannelid', 'tgchannelid'),
+    )
+    Table('tgmessage', metadata,
+        Column('id', key, primary_key=True, autoincrement=True),
+        Column('messageid', BigInteger),
+        Column('channelid', BigInteger),
+        Column('shard', String(128)),
+        Index('ix_tgmessage_channel_message', 'channelid', 'messageid', unique=True),
+    )
+    Table('dmessage', metadata,
+        Column('id', BigInteger, primary_key=True),
+        Column('tgmessageid', BigInteger, ForeignKey('tgmessage.id')),
+        Column('webhookid', BigInteger),
+        Index('ix_dmessage_tgmessage_webhook', 'tgmessageid', 'webhookid', unique=True),
+    )
+    return metadata
+
+def _idmap(conn, metadata, old, order_by, rank=func.row_number):
+    """Number the rows of `old` in `order_by` order, returns a table mapping their uuid to the number."""
+    idmap = Table(f'{old.name}_idmap', metadata,
+        Column('old', String(128), primary_key=True),
+        Column('new', BigInteger, nullable=False, index=True),
+    )
+    idmap.create(conn)
+    conn.execute(insert(idmap).from_select(['old', 'new'], select(old.c.id, rank().over(order_by=order_by))))
+    return idmap
+
+def bigint_keys(conn):
+    """
+    Version 1: bigint surrogate keys for webhooks, watchgroups and the message ledger.
+
+    The tables with uuid keys, or columns referencing them, are renamed and rebuilt with the new
+    keys, numbered in their natural order (ledger rows by chat and message) so related rows end up
+    next to each other. Ledger rows that were duplicated before the unique index existed are merged,
+    and Discord messages of webhooks that were deleted are dropped since they can't be edited anymore.
+    """
+    names = ['dmessage', 'tgmessage', 'dwh2tgc_association', 'dwh2wg_association', 'tgchannel', 'tgwatchgroup', 'dwebhook']
+    inspector = inspect(conn)
+
+    # index names are global in Postgres and SQLite, they have to go before the new tables are made
+    for name in names:
+        for index in inspector.get_indexes(name):
+            if index['name'] and 'duplicates_constraint' not in index:  # constraint indexes are handled below
+                conn.execute(text(f'DROP INDEX {index["name"]}'))
+        conn.execute(text(f'ALTER TABLE {name} RENAME TO {name}_v0'))
+
+        if conn.dialect.name == 'postgresql':
+            # SQLite names constraint indexes after their table, Postgres keeps the names of constraints,
+            # their indexes and serial sequences, so the new tables would get e.g. dwebhook_pkey1
+            for (constraint,) in conn.execute(text("SELECT conname FROM pg_constraint WHERE conrelid = CAST(:table AS regclass)"), {"table": f'{name}_v0'}).all():
+                conn.execute(text(f'ALTER TABLE {name}_v0 RENAME CONSTRAINT {constraint} TO {constraint}_v0'))
+            for (sequence,) in conn.execute(text(
+                "SELECT s.relname FROM pg_class s JOIN pg_depend d ON d.objid = s.oid "
+                "WHERE s.relkind = 'S' AND d.refobjid = CAST(:table AS regclass) AND d.deptype = 'a'"
+            ), {"table": f'{name}_v0'}).all():
+                conn.execute(text(f'ALTER SEQUENCE {sequence} RENAME TO {sequence}_v0'))
+
+    legacy = MetaData()
+    legacy.reflect(conn, only=[f'{name}_v0' for name in names])
+    webhook, watchgroup, channel, wg, tgc, tgmessage, dmessage = (legacy.tables[f'{name}_v0'] for name in reversed(names))
+
+    v1 = _v1_tables()
+    v1.create_all(conn)
+
+    webhooks = _idmap(conn, legacy, webhook, webhook.c.url)
+    watchgroups = _idmap(conn, legacy, watchgroup, watchgroup.c.name)
+    # duplicated ledger rows get the same number and are merged below
+    tgmessages = _idmap(conn, legacy, tgmessage, (tgmessage.c.channelid, tgmessage.c.messageid), rank=func.dense_rank)
+
+    def copy(table, query):
+        table = v1.tables[table]
+        conn.execute(insert(table).from_select([column.name for column in query.selected_columns], query))
+        logger.info(f'Copied {conn.execute(select(func.count()).select_from(table)).scalar()} rows into {table.name}')
+
+    copy('dwebhook', select(webhooks.c.new.label('id'), webhook.c.url, webhook.c.serverid, webhook.c.active).select_from(webhook).join(webhooks, webhooks.c.old == webhook.c.id))
+    copy('tgwatchgroup', select(watchgroups.c.new.label('id'), watchgroup.c.name).select_from(watchgroup).join(watchgroups, watchgroups.c.old == watchgroup.c.id))
+    copy('tgchannel', select(
+        channel.c.id, channel.c.name, channel.c.registered, watchgroups.c.new.label('watchgroupid'),
+        (channel.c.shard if 'shard' in channel.c else null()).label('shard')
+    ).select_from(channel).outerjoin(watchgroups, watchgroups.c.old == channel.c.watchgroupid))
+    copy('dwh2wg_association', select(webhooks.c.new.label('webhookid'), watchgroups.c.new.label('watchgroupid')).select_from(wg)
+         .join(webhooks, webhooks.c.old == wg.c.webhookid).join(watchgroups, watchgroups.c.old == wg.c.watchgroupid).distinct())
+    copy('dwh2tgc_association', select(webhooks.c.new.label('webhookid'), tgc.c.tgchannelid).select_from(tgc)
+         .join(webhooks, webhooks.c.old == tgc.c.webhookid).distinct())
+    copy('tgmessage', select(
+        tgmessages.c.new.label('id'), func.min(tgmessage.c.messageid).label('messageid'), func.min(tgmessage.c.channelid).label('channelid'),
+        (func.max(tgmessage.c.shard) if 'shard' in tgmessage.c else null()).label('shard')
+    ).select_from(tgmessage).join(tgmessages, tgmessages.c.old == tgmessage.c.id).group_by(tgmessages.c.new))
+    copy('dmessage', select(func.min(dmessage.c.id).label('id'), tgmessages.c.new.label('tgmessageid'), webhooks.c.new.label('webhookid')).select_from(dmessage)
+         .join(tgmessages, tgmessages.c.old == dmessage.c.tgmessageid).join(webhooks, webhooks.c.old == dmessage.c.webhookid)
+         .group_by(tgmessages.c.new, webhooks.c.new))
+
+    if conn.dialect.name == 'postgresql':
+        # the rows were inserted with their ids, the sequences have to continue after them
+        for name in ['dwebhook', 'tgwatchgroup', 'tgmessage']:
+            conn.execute(text(f"SELECT setval(pg_get_serial_sequence('{name}', 'id'), COALESCE(MAX(id), 0) + 1, false) FROM {name}"))
+
+    for table in [webhooks, watchgroups, tgmessages] + [legacy.tables[f'{name}_v0'] for name in names]:
+        table.drop(conn)
+
+def ledger_dates(conn):
+    """
+    Version 2: a date on ledger rows, which they are expired and optionally partitioned by.
+
+    Existing rows are dated at the time of the migration, so they are expired a full retention
+    period later. The unique indexes include the date, which a partitioned table requires. A
+    message always has the same Telegram date, so they still catch duplicates.
+    """
+    now = datetime.utcnow()
+    for table in ['tgmessage', 'dmessage']:
+        conn.execute(text(f'ALTER TABLE {table} ADD COLUMN date {DateTime().compile(dialect=conn.dialect)}'))
+        conn.execute(text(f'UPDATE {table} SET date = :now'), {"now": now})
+
+    for name in ['ix_tgmessage_channel_message', 'ix_dmessage_tgmessage_webhook']:
+        conn.execute(text(f'DROP INDEX IF EXISTS {name}'))
+
+    conn.execute(text('CREATE UNIQUE INDEX ix_tgmessage_channel_message_date ON tgmessage (channelid, messageid, date)'))
+    conn.execute(text('CREATE INDEX ix_tgmessage_date ON tgmessage (date)'))
+    conn.execute(text('CREATE UNIQUE INDEX ix_dmessage_tgmessage_webhook_date ON dmessage (tgmessageid, webhookid, date)'))
+    conn.execute(text('CREATE INDEX ix_dmessage_date ON dmessage (date)'))
+
+
+# (version, migration) in order, a database at version n runs every migration after it.
+MIGRATIONS = [
+    (1, bigint_keys),
+    (2, ledger_dates),
+]
@@ -1,7 +1,8 @@
-from sqlalchemy import Column, String, BigInteger, Boolean, ForeignKey, Table
+from itertools import chain
+from sqlalchemy import Column, String, BigInteger, Integer, Boolean, DateTime, Text, JSON, ForeignKey, Table, Index
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, object_session
-from sqlalchemy import text, select, func
+from sqlalchemy.orm import relationship, object_session, Session
+from sqlalchemy import text, select, func, event, case
 from sqlalchemy.ext.hybrid import hybrid_property
 
 db = declarative_base()
@@ -11,14 +12,20 @@ db = declarative_base()
 
 # pylint: disable=missing-class-docstring, missing-function-docstring, invalid-name
 
+# Surrogate keys, SQLite only autoincrements INTEGER primary keys.
+SurrogateKey = BigInteger().with_variant(Integer, "sqlite")
+
+# The primary keys cover lookups by webhook, the indexes lookups from the other side.
 dwh2wg_association_table = Table('dwh2wg_association', db.metadata,
-    Column('webhookid', ForeignKey('dwebhook.id'), primary_key=True),
-    Column('watchgroupid', ForeignKey('tgwatchgroup.id'), primary_key=True)
+    Column('webhookid', BigInteger, ForeignKey('dwebhook.id'), primary_key=True),
+    Column('watchgroupid', BigInteger, ForeignKey('tgwatchgroup.id'), primary_key=True),
+    Index('ix_dwh2wg_association_watchgroupid', 'watchgroupid')
 )
 
 dwh2tgc_association_table = Table('dwh2tgc_association', db.metadata,
-    Column('webhookid', ForeignKey('dwebhook.id'), primary_key=True),
-    Column('tgchannelid', ForeignKey('tgchannel.id'), primary_key=True)
+    Column('webhookid', BigInteger, ForeignKey('dwebhook.id'), primary_key=True),
+    Column('tgchannelid', BigInteger, ForeignKey('tgchannel.id'), primary_key=True),
+    Index('ix_dwh2tgc_association_tgchannelid', 'tgchannelid')
 )
 
 class Webhook(db):
@@ -30,8 +37,7 @@ class Webhook(db):
     # TODO: mandate that webhooks must be added from the same server they were created from
     # TODO: might remove serverid entirely instead
     # TODO: change watched to channels
-    # TODO: id should be an integer
-    id = Column(String(128), primary_key=True, server_default=text("gen_random_uuid()"))
+    id = Column(SurrogateKey, primary_key=True, autoincrement=True)
     url = Column(String(128), nullable=False, unique=True)  # The webhook.
     serverid = Column(BigInteger, nullable=False)  # Server that created this webhook.
 
@@ -42,19 +48,19 @@ class Webhook(db):
 
     @hybrid_property
     def channelcount(self):
-        return object_session(self).query(Webhook).where(Webhook.id == self.id).join(Webhook, TelegramChannel.webhooks).count()
+        return object_session(self).scalar(select([func.count()]).where(dwh2tgc_association_table.c.webhookid == self.id))
 
     @channelcount.expression
     def channelcount(self):
-        return select([func.count(Webhook.id)]).where(Webhook.id == self.id).join(Webhook, TelegramChannel.webhooks)
+        return select([func.count()]).where(dwh2tgc_association_table.c.webhookid == self.id).scalar_subquery()
 
     @hybrid_property
     def watchgroupcount(self):
-        return object_session(self).query(Webhook).where(Webhook.id == self.id).join(Webhook, Watchgroup.webhooks).count()
+        return object_session(self).scalar(select([func.count()]).where(dwh2wg_association_table.c.webhookid == self.id))
 
     @watchgroupcount.expression
     def watchgroupcount(self):
-        return select([func.count(Webhook.id)]).where(Webhook.id == self.id).join(Webhook, Watchgroup.webhooks)
+        return select([func.count()]).where(dwh2wg_association_table.c.webhookid == self.id).scalar_subquery()
 
 class Watchgroup(db):
     __tablename__ = "tgwatchgroup"
@@ -62,7 +68,7 @@ class Watchgroup(db):
     def __repr__(self):
         return f'<Watchgroup id="{self.id}" name="{self.name}">'
 
-    id = Column(String(128), primary_key=True, server_default=text("gen_random_uuid()"))
+    id = Column(SurrogateKey, primary_key=True, autoincrement=True)
     name = Column(String(128), unique=True, nullable=False)
 
     channels = relationship("TelegramChannel", cascade="all,delete")
@@ -70,19 +76,19 @@ class Watchgroup(db):
 
     @hybrid_property
     def channelcount(self):
-        return object_session(self).query(Watchgroup).where(Watchgroup.id == self.id).join(TelegramChannel, Watchgroup.channels).count()
+        return object_session(self).scalar(select([func.count()]).where(TelegramChannel.watchgroupid == self.id))
 
     @channelcount.expression
     def channelcount(self):
-        return select([func.count(Watchgroup.id)]).where(Watchgroup.id == self.id).join(TelegramChannel, Watchgroup.channels)
+        return select([func.count()]).where(TelegramChannel.watchgroupid == self.id).scalar_subquery()
 
     @hybrid_property
     def webhookcount(self):
-        return object_session(self).query(Watchgroup).where(Watchgroup.id == self.id).join(Webhook, Watchgroup.webhooks).count()
+        return object_session(self).scalar(select([func.count()]).where(dwh2wg_association_table.c.watchgroupid == self.id))
 
     @webhookcount.expression
     def webhookcount(self):
-        return select([func.count(Watchgroup.id)]).where(Watchgroup.id == self.id).join(Webhook, Watchgroup.webhooks)
+        return select([func.count()]).where(dwh2wg_association_table.c.watchgroupid == self.id).scalar_subquery()
 
 
 class TelegramChannel(db):
@@ -92,43 +98,136 @@ class TelegramChannel(db):
         return f'<TelegramChannel id="{self.id}" name="{self.name}" registered={self.registered}>'
 
     __tablename__ = "tgchannel"
+    __table_args__ = (
+        Index("ix_tgchannel_watchgroupid", "watchgroupid"),
+    )
     id = Column(BigInteger, unique=True, primary_key=True)  # Telegram Chat ID.
     name = Column(String(128))  # TODO: auto-generated
     registered = Column(Boolean, server_default='1')  # Whether or not this channel can be used.
 
     # TODO: use many-to-many for telegram channel to watchgroup relationship instead of one to many?
-    watchgroupid = Column(String(128), ForeignKey('tgwatchgroup.id'))
+    watchgroupid = Column(BigInteger, ForeignKey('tgwatchgroup.id'))
+    shard = Column(String(128))  # shard this channel is pinned to, assigned automatically if empty
     webhooks = relationship("Webhook", secondary=dwh2tgc_association_table, back_populates="watched", cascade="all,delete")
 
     @hybrid_property
     def watchgroupcount(self):
-        return object_session(self).query(TelegramChannel).where(TelegramChannel.id == self.id).join(TelegramChannel, Watchgroup.channels).count()
+        return 0 if self.watchgroupid is None else 1  # a channel is in one watchgroup at most
 
     @watchgroupcount.expression
     def watchgroupcount(self):
-        return select([func.count(TelegramChannel.id)]).where(TelegramChannel.id == self.id).join(TelegramChannel, Watchgroup.channels)
+        return case((self.watchgroupid.is_(None), 0), else_=1)
 
     @hybrid_property
     def webhookcount(self):
-        return object_session(self).query(TelegramChannel).where(TelegramChannel.id == self.id).join(TelegramChannel, Webhook.watched).count()
+        return object_session(self).scalar(select([func.count()]).where(dwh2tgc_association_table.c.tgchannelid == self.id))
 
     @webhookcount.expression
     def webhookcount(self):
-        return select([func.count(TelegramChannel.id)]).where(TelegramChannel.id == self.id).join(TelegramChannel, Webhook.watched)
+        return select([func.count()]).where(dwh2tgc_association_table.c.tgchannelid == self.id).scalar_subquery()
 
 class TelegramMessage(db):
     """A Telegram message."""
     __tablename__ = "tgmessage"
-    id = Column(String(128), primary_key=True, server_default=text("gen_random_uuid()"))
+    __table_args__ = (
+        # the date is part of every unique index so they also work with the table partitioned by it
+        Index("ix_tgmessage_channel_message_date", "channelid", "messageid", "date", unique=True),
+        Index("ix_tgmessage_date", "date"),
+    )
+    id = Column(SurrogateKey, primary_key=True, autoincrement=True)
     messageid = Column(BigInteger) # telegram message id
     channelid = Column(BigInteger) # telegram channel id
+    shard = Column(String(128)) # shard that claimed the message for delivery
+    date = Column(DateTime) # UTC, when the message was posted on Telegram, see retention.py
 
     dmessages = relationship("DiscordMessage", back_populates="tgmessage")
 
 class DiscordMessage(db):
     __tablename__ = "dmessage"
-    id = Column(BigInteger, unique=True, primary_key=True) # discord message id
-    tgmessageid = Column(String(128), ForeignKey("tgmessage.id"))
-    webhookid = Column(String(128))
+    __table_args__ = (
+        Index("ix_dmessage_tgmessage_webhook_date", "tgmessageid", "webhookid", "date", unique=True),
+        Index("ix_dmessage_date", "date"),
+    )
+    id = Column(BigInteger, primary_key=True) # discord message id
+    tgmessageid = Column(BigInteger, ForeignKey("tgmessage.id"))  # not enforced when the ledger is partitioned
+    webhookid = Column(BigInteger)
+    date = Column(DateTime) # UTC, date of the Telegram message, so both ledger tables expire together
     
-    tgmessage = relationship("TelegramMessage", back_populates="dmessages")
\ No newline at end of file
+    tgmessage = relationship("TelegramMessage", back_populates="dmessages")
+
+class ChatAvatar(db):
+    """The profile photo of a Telegram chat, as uploaded to the configured storage."""
+    __tablename__ = "tgavatar"
+    chatid = Column(BigInteger, primary_key=True)  # Telegram Chat ID.
+    photoid = Column(BigInteger, nullable=False)  # Telegram photo id, changes along with the photo.
+    url = Column(String(512), nullable=False)
+
+class StoredMedia(db):
+    """A file in the configured storage, by a key identifying its content, see mediaindex.py."""
+    __tablename__ = "tgmedia"
+    key = Column(String(128), primary_key=True)  # "document:{id}", "photo:{id}" or "sha256:{hex digest}"
+    url = Column(String(512), nullable=False)
+
+class DeliveryJob(db):
+    """A Telegram message, or the messages of an album, waiting to be delivered to its webhooks."""
+    __tablename__ = "deliveryjob"
+    __table_args__ = (
+        Index("ix_deliveryjob_channel_message", "channelid", "messageid", unique=True),
+        Index("ix_deliveryjob_state_available", "state", "availableat"),
+    )
+
+    def __repr__(self):
+        return f'<DeliveryJob id={self.id} channelid={self.channelid} messageid={self.messageid} state="{self.state}">'
+
+    id = Column(SurrogateKey, primary_key=True, autoincrement=True)
+    channelid = Column(BigInteger, nullable=False)  # telegram channel id
+    messageid = Column(BigInteger, nullable=False)  # telegram message id, the first one for albums
+    messageids = Column(JSON, nullable=False)  # every telegram message id in the job
+    state = Column(String(16), nullable=False, server_default="pending")  # pending, running or dead
+    attempts = Column(Integer, nullable=False, server_default="0")
+    availableat = Column(DateTime, nullable=False)  # UTC, not claimed before this time
+    owner = Column(String(128))  # shard that enqueued the job and delivers it
+    lockedat = Column(DateTime)  # UTC, when the job was claimed
+    error = Column(Text)  # last delivery error
+    createdat = Column(DateTime, nullable=False)  # UTC
+
+class Shard(db):
+    """A running Telegram account of the bridge, see shards.py."""
+    __tablename__ = "shard"
+    name = Column(String(128), primary_key=True)
+    heartbeat = Column(DateTime, nullable=False)  # UTC
+
+class ShardChannel(db):
+    """A chat the account of a shard can see."""
+    __tablename__ = "shardchannel"
+    shard = Column(String(128), primary_key=True)
+    channelid = Column(BigInteger, primary_key=True)
+
+class ChannelWatermark(db):
+    """Id of the newest message of a chat a shard delivered, missed messages after it are backfilled on startup."""
+    __tablename__ = "channelwatermark"
+    shard = Column(String(128), primary_key=True)  # message ids of private chats and groups are per account
+    channelid = Column(BigInteger, primary_key=True)
+    messageid = Column(BigInteger, nullable=False)
+
+class BridgeState(db):
+    """Small values the bridge keeps between runs, such as sync watermarks."""
+    __tablename__ = "bridgestate"
+    key = Column(String(128), primary_key=True)
+    value = Column(Text)
+
+
+# Postgres NOTIFY channel that running bridges LISTEN on to rebuild their routing table.
+ROUTING_CHANNEL = "tgbridge_routing"
+
+@event.listens_for(Session, "after_flush")
+def notify_routing_change(session, flush_context):
+    """Notify running bridges when a flush touches channels, webhooks, watchgroups or their associations."""
+    # Association table changes show up as the owning Webhook/Watchgroup/TelegramChannel being dirty.
+    changed = chain(session.new, session.dirty, session.deleted)
+    if not any(isinstance(obj, (Webhook, Watchgroup, TelegramChannel)) for obj in changed):
+        return
+
+    connection = session.connection()
+    if connection.dialect.name == "postgresql":
+        connection.execute(text(f"NOTIFY {ROUTING_CHANNEL}"))  # delivered on commit, dropped on rollback
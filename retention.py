@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import re
+from datetime import datetime, timedelta
+
+from sqlalchemy import inspect, select, delete, text
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import TelegramMessage, DiscordMessage
+
+# pylint: disable=missing-class-docstring, missing-function-docstring, invalid-name
+
+logger = logging.getLogger('bridge.retention')
+
+# The ledger tables, which are expired and partitioned by the date of their Telegram message.
+LEDGER = [DiscordMessage, TelegramMessage]
+
+# Partitions are kept ready for the current interval and the ones after it up to this many in total,
+# rows dated after them land in the default partition.
+AHEAD = 2
+
+# Rows deleted per transaction from unpartitioned tables, keeps locks and WAL bursts short.
+BATCH_SIZE = 5000
+
+_BOUNDS = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+
+def floor(date, interval):
+    """Start of the partition interval `date` is in."""
+    if interval == "month":
+        return datetime(date.year, date.month, 1)
+
+    day = datetime(date.year, date.month, date.day)
+    return day - timedelta(days=day.weekday()) if interval == "week" else day
+
+def step(start, interval):
+    """Start of the interval after the one starting at `start`."""
+    if interval == "month":
+        return datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+    return start + timedelta(days=7 if interval == "week" else 1)
+
+def horizon(now, interval):
+    end = floor(now, interval)
+    for _ in range(AHEAD):
+        end = step(end, interval)
+    return end
+
+def is_partitioned(conn, table):
+    return conn.execute(text(
+        "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = :table AND pg_table_is_visible(c.oid)"
+    ), {"table": table}).scalar() is not None
+
+def partitions(conn, table):
+    """Date range partitions of `table`, by name as (from, to). The default partition isn't included."""
+    rows = conn.execute(text(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = :table AND pg_table_is_visible(p.oid)"
+    ), {"table": table})
+
+    found = {}
+    for name, bound in rows:
+        match = _BOUNDS.search(bound or '')
+        if match:
+            found[name] = (datetime.fromisoformat(match.group(1)), datetime.fromisoformat(match.group(2)))
+    return found
+
+def create_partitions(conn, table, start, end, interval):
+    """Create the partitions of `table` missing between the interval containing `start` and `end`. Existing partitions are kept even if their interval differs."""
+    existing = sorted(partitions(conn, table).values())
+    lower = floor(start, interval)
+
+    while lower < end:
+        covering = next((upper for low, upper in existing if low <= lower < upper), None)
+        if covering:
+            lower = covering
+            continue
+
+        upper = min([step(lower, interval)] + [low for low, _ in existing if low > lower])
+        name = f'{table}_p{lower:%Y%m%d}'
+        try:
+            with conn.begin_nested():
+                conn.execute(text(f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM ('{lower:%Y-%m-%d %H:%M:%S}') TO ('{upper:%Y-%m-%d %H:%M:%S}')"))
+        except SQLAlchemyError as err:
+            # e.g. rows in the default partition that belong in the new one
+            logger.error(f"Unable to create partition {name}, its rows stay in the default partition: {err}")
+        else:
+            logger.info(f"Created partition {name}")
+        lower = upper
+
+def expire_partitions(conn, table, cutoff, archive):
+    """Drop, or detach when archiving, the partitions of `table` with only rows older than `cutoff`."""
+    for name, (_, upper) in sorted(partitions(conn, table).items()):
+        if upper > cutoff:
+            continue
+
+        if archive:
+            conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+            logger.info(f"Detached expired partition {name}, it is kept as a table of its own")
+        else:
+            conn.execute(text(f"DROP TABLE {name}"))
+            logger.info(f"Dropped expired partition {name}")
+
+    # whatever landed in the default partition is expired row by row, there should be little of it
+    conn.execute(text(f"DELETE FROM {table}_default WHERE date < :cutoff"), {"cutoff": cutoff})
+
+def maintain_partitions(session, now, interval, cutoff, archive):
+    """Create upcoming partitions and expire old ones. Returns False if the ledger isn't partitioned."""
+    conn = session.connection()
+    if conn.dialect.name != "postgresql" or not all(is_partitioned(conn, model.__tablename__) for model in LEDGER):
+        return False
+
+    if not conn.execute(text("SELECT pg_try_advisory_xact_lock(hashtext('tgbridge_retention'))")).scalar():
+        return True  # another shard is maintaining them right now
+
+    for model in LEDGER:
+        create_partitions(conn, model.__tablename__, now, horizon(now, interval), interval)
+        if cutoff is not None:
+            expire_partitions(conn, model.__tablename__, cutoff, archive)
+    return True
+
+def prune(session, model, cutoff):
+    """Delete up to BATCH_SIZE rows of `model` older than `cutoff`, returns how many were deleted."""
+    expired = select(model.id).where(model.date < cutoff).limit(BATCH_SIZE).scalar_subquery()
+    return session.execute(delete(model).where(model.id.in_(expired)).execution_options(synchronize_session=False)).rowcount
+
+def partition(engine, interval, now=None):
+    """
+    Convert the ledger tables to tables partitioned by date, in one transaction. Does nothing if they already are.
+
+    Every row is copied, so this takes a while on a big ledger. Partitions are created from the
+    oldest row up to AHEAD intervals from now, plus a default partition for anything outside them.
+    """
+    if engine.dialect.name != "postgresql":
+        logger.warning(f"Ledger partitioning needs Postgres, the {engine.dialect.name} ledger is pruned row by row instead")
+        return
+
+    now = now or datetime.utcnow()
+    with engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('tgbridge_schema'))"))
+        pending = [model.__table__ for model in LEDGER if not is_partitioned(conn, model.__tablename__)]
+        if not pending:
+            return
+
+        # a partitioned table can't be referenced by a foreign key on its id alone
+        for foreignkey in inspect(conn).get_foreign_keys(DiscordMessage.__tablename__):
+            if foreignkey["referred_table"] == TelegramMessage.__tablename__ and foreignkey["name"]:
+                conn.execute(text(f'ALTER TABLE {DiscordMessage.__tablename__} DROP CONSTRAINT {foreignkey["name"]}'))
+
+        for table in pending:
+            _convert(conn, table, interval, now)
+
+def _convert(conn, table, interval, now):
+    name, old = table.name, f'{table.name}_unpartitioned'
+    logger.info(f"Partitioning {name} by date, every row is copied..")
+
+    sequence = conn.execute(text("SELECT pg_get_serial_sequence(:table, 'id')"), {"table": name}).scalar()
+    conn.execute(text(f"ALTER TABLE {name} RENAME TO {old}"))
+    for index in inspect(conn).get_indexes(old):
+        if "duplicates_constraint" not in index:  # index names are global, the new table reuses them
+            conn.execute(text(f'ALTER INDEX {index["name"]} RENAME TO {index["name"]}_unpartitioned'))
+
+    conn.execute(text(f"UPDATE {old} SET date = :now WHERE date IS NULL"), {"now": now})
+    conn.execute(text(f"CREATE TABLE {name} (LIKE {old} INCLUDING DEFAULTS) PARTITION BY RANGE (date)"))
+    conn.execute(text(f"ALTER TABLE {name} ADD PRIMARY KEY (id, date)"))
+    for index in table.indexes:
+        index.create(conn)
+
+    oldest = conn.execute(text(f"SELECT MIN(date) FROM {old}")).scalar() or now
+    create_partitions(conn, name, oldest, horizon(now, interval), interval)
+    conn.execute(text(f"CREATE TABLE {name}_default PARTITION OF {name} DEFAULT"))
+
+    copied = conn.execute(text(f"INSERT INTO {name} SELECT * FROM {old}")).rowcount
+    if sequence:
+        conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY {name}.id"))
+    conn.execute(text(f"DROP TABLE {old}"))
+    logger.info(f"Partitioned {name}, {copied} rows were copied")
+
+
+class LedgerRetention:
+    """
+    Expires the message ledger and keeps its partitions ready.
+
+    Only recent ledger rows matter, they stop duplicate deliveries and map edits and deletions to
+    Discord. On a partitioned ledger partitions are created ahead of time and expired ones are
+    dropped whole, so expiry leaves nothing for vacuum to clean up. Unpartitioned ledgers are pruned
+    in small batches instead.
+    """
+
+    def __init__(self, sqlexec, retention_days=None, interval="month", archive=False, period=3600.0):
+        self.sqlexec = sqlexec
+        self.retention_days = retention_days
+        self.interval = interval
+        self.archive = archive
+        self.period = period
+
+    async def maintain(self):
+        now = datetime.utcnow()
+        cutoff = now - timedelta(days=self.retention_days) if self.retention_days else None
+        if await self.sqlexec.run(maintain_partitions, now, self.interval, cutoff, self.archive) or cutoff is None:
+            return
+
+        for model in LEDGER:  # Discord messages first, they belong to the Telegram messages
+            deleted, total = BATCH_SIZE, 0
+            while deleted == BATCH_SIZE:
+                deleted = await self.sqlexec.run(prune, model, cutoff)
+                total += deleted
+            if total:
+                logger.info(f"Expired {total} rows of {model.__tablename__} older than {cutoff:%Y-%m-%d}")
+
+    async def run(self):
+        while True:
+            try:
+                await self.maintain()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Ledger retention failed, it is retried at the next run')
+            await asyncio.sleep(self.period)
@@ -0,0 +1,154 @@
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Dict, FrozenSet, List, NamedTuple, Optional
+
+from sqlalchemy import select
+
+from models import Webhook, TelegramChannel, dwh2tgc_association_table, dwh2wg_association_table, ROUTING_CHANNEL
+
+# pylint: disable=missing-class-docstring, missing-function-docstring, invalid-name
+
+logger = logging.getLogger('bridge.routing')
+
+
+class RoutedWebhook(NamedTuple):
+    id: int
+    url: str
+
+class Route(NamedTuple):
+    name: str
+    registered: bool
+    webhooks: FrozenSet[RoutedWebhook]  # explicitly watching or watching by watchgroup, active only
+
+
+class RoutingTable:
+    """
+    Resident index of Telegram chat id to the webhooks interested in that chat.
+
+    The index is built from the database once and rebuilt whenever the channel, webhook or
+    watchgroup tables change (see `models.notify_routing_change`), so routing a message never
+    touches the database. Every change rebuilds the whole index rather than patching it, which is
+    a few set-based queries even for thousands of channels and keeps it from drifting.
+    """
+
+    def __init__(self, sqlexec, refresh_interval=60):
+        self.sqlexec = sqlexec
+        self.refresh_interval = refresh_interval  # only used on databases without LISTEN/NOTIFY
+        self.version = 0
+        self._routes: Dict[int, Route] = {}
+        self._stale: Optional[asyncio.Event] = None
+
+    def webhooks_for(self, chat_id) -> List[RoutedWebhook]:
+        route = self._routes.get(int(chat_id))
+        if route is None:
+            return []
+
+        if not route.registered:
+            logger.debug(f'{route.name} ({chat_id}) is not registered')
+            return []  # return an empty list instead of None so list comprehension doesn't fail
+
+        return list(route.webhooks)
+
+    def watched(self) -> List[int]:
+        """Ids of the registered chats at least one active webhook is interested in."""
+        return [chat_id for chat_id, route in self._routes.items() if route.registered and route.webhooks]
+
+    def load(self, session):
+        """Rebuild the whole index from the database. This blocks, use `refresh()` from async code."""
+        channels = session.execute(select(TelegramChannel.id, TelegramChannel.name, TelegramChannel.registered, TelegramChannel.watchgroupid)).all()
+        webhooks = {row.id: RoutedWebhook(row.id, row.url) for row in session.execute(select(Webhook.id, Webhook.url).where(Webhook.active.isnot(False)))}
+        explicit = session.execute(select(dwh2tgc_association_table.c.tgchannelid, dwh2tgc_association_table.c.webhookid)).all()
+        bygroup = session.execute(select(dwh2wg_association_table.c.watchgroupid, dwh2wg_association_table.c.webhookid)).all()
+
+        channelhooks = defaultdict(set)
+        for channelid, webhookid in explicit:
+            if webhookid in webhooks:
+                channelhooks[channelid].add(webhooks[webhookid])
+
+        grouphooks = defaultdict(set)
+        for watchgroupid, webhookid in bygroup:
+            if webhookid in webhooks:
+                grouphooks[watchgroupid].add(webhooks[webhookid])
+
+        routes = {}
+        for channel in channels:
+            hooks = channelhooks.get(channel.id, set()) | grouphooks.get(channel.watchgroupid, set())
+            routes[channel.id] = Route(channel.name, bool(channel.registered), frozenset(hooks))
+
+        self._routes = routes  # swapped in one go, lookups never see a half-built table
+        self.version += 1
+        logger.debug(f'Routing table v{self.version} loaded with {len(routes)} channels and {len(webhooks)} active webhooks')
+
+    async def refresh(self):
+        await self.sqlexec.run(self.load)
+
+    async def listen(self, engine):
+        """Keep the index current until cancelled."""
+        self._stale = asyncio.Event()
+
+        if engine.dialect.name == 'postgresql':
+            notifier = asyncio.ensure_future(self._listen_postgres(engine))
+        else:
+            logger.warning(f'{engine.dialect.name} has no change notifications, routes will be refreshed every {self.refresh_interval} seconds.')
+            notifier = asyncio.ensure_future(self._poll())
+
+        try:
+            while True:
+                await self._stale.wait()
+                await asyncio.sleep(0.5)  # coalesce a burst of changes into a single rebuild
+                self._stale.clear()
+
+                try:
+                    await self.refresh()
+                except Exception:
+                    logger.exception('Failed to reload the routing table, keeping the previous one.')
+        finally:
+            notifier.cancel()
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            self._stale.set()
+
+    async def _listen_postgres(self, engine):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            try:
+                conn = await loop.run_in_executor(None, engine.raw_connection)
+            except Exception as err:
+                logger.warning(f'Unable to listen for routing changes ({err}), retrying in 5 seconds..')
+                await asyncio.sleep(5)
+                continue
+
+            conn.detach()  # this connection is ours for good, don't hand it back to the pool
+            dbapi = conn.connection
+            dbapi.autocommit = True
+            dbapi.cursor().execute(f'LISTEN {ROUTING_CHANNEL}')
+            fd = dbapi.fileno()
+            lost = loop.create_future()
+
+            def on_readable():
+                try:
+                    dbapi.poll()
+                except Exception as err:  # pylint: disable=broad-except
+                    if not lost.done():
+                        lost.set_result(err)
+                    return
+
+                if dbapi.notifies:
+                    dbapi.notifies.clear()
+                    self._stale.set()
+
+            loop.add_reader(fd, on_readable)
+            self._stale.set()  # anything changed while we weren't listening is picked up by a reload
+
+            try:
+                err = await lost
+                logger.warning(f'Lost the routing change notification connection ({err}), reconnecting..')
+            finally:
+                loop.remove_reader(fd)
+                conn.close()
+
+            await asyncio.sleep(5)
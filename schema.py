@@ -0,0 +1,104 @@
+import logging
+from contextlib import contextmanager
+
+from sqlalchemy import inspect, text, select, insert, delete
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.schema import CreateColumn
+
+from models import db, BridgeState
+from migrations import MIGRATIONS
+
+# pylint: disable=missing-class-docstring, missing-function-docstring, invalid-name
+
+logger = logging.getLogger('bridge.schema')
+
+# Schema version of models.py, kept in the bridgestate table under this key.
+VERSION = MIGRATIONS[-1][0]
+VERSION_KEY = "schema"
+
+
+def get_version(conn):
+    """Schema version of the database, None if it is empty. Databases from before versioning are version 0."""
+    tables = inspect(conn).get_table_names()
+    if "dwebhook" not in tables:
+        return None
+    if "bridgestate" not in tables:
+        return 0
+
+    value = conn.execute(select(BridgeState.value).where(BridgeState.key == VERSION_KEY)).scalar()
+    return int(value) if value else 0
+
+def set_version(conn, version):
+    conn.execute(delete(BridgeState).where(BridgeState.key == VERSION_KEY))
+    conn.execute(insert(BridgeState).values(key=VERSION_KEY, value=str(version)))
+
+@contextmanager
+def locked(engine):
+    """Hold the schema lock on Postgres, so bridges starting at once upgrade the database one at a time."""
+    if engine.dialect.name != "postgresql":
+        yield
+        return
+
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:  # not left idle in a transaction
+        conn.execute(text("SELECT pg_advisory_lock(hashtext('tgbridge_schema'))"))
+        try:
+            yield
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(hashtext('tgbridge_schema'))"))
+
+def migrate(engine):
+    """Run the migrations the database is missing, all in one transaction. Call it with the schema lock held."""
+    with engine.begin() as conn:
+        version = get_version(conn)
+        if version is None:
+            db.metadata.create_all(conn)
+            set_version(conn, VERSION)
+            logger.info(f"Created the database at schema version {VERSION}")
+            return
+        elif version > VERSION:
+            raise RuntimeError(f"The database is at schema version {version}, this bridge only knows up to {VERSION}")
+
+        for target, migration in MIGRATIONS:
+            if target > version:
+                logger.info(f"Migrating the database to schema version {target} ({migration.__name__})..")
+                migration(conn)
+                db.metadata.tables["bridgestate"].create(conn, checkfirst=True)
+                set_version(conn, target)
+
+def upgrade(engine):
+    """
+    Bring the database up to date with models.py.
+
+    Changes that rewrite data run as versioned migrations (see migrations.py). After them,
+    create_all() only creates missing tables, so columns and indexes added to tables that already
+    exist are created here as well.
+    """
+    with locked(engine):
+        migrate(engine)
+        add_missing(engine)
+
+def add_missing(engine):
+    db.metadata.create_all(engine)
+    inspector = inspect(engine)
+
+    for table in db.metadata.sorted_tables:
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in columns:
+                with engine.begin() as conn:
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {CreateColumn(column).compile(dialect=engine.dialect)}"))
+                logger.info(f"Added column {column.name} to {table.name}")
+
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        indexes |= {constraint["name"] for constraint in inspector.get_unique_constraints(table.name)}
+        for index in table.indexes:
+            if index.name in indexes:
+                continue
+
+            try:
+                index.create(engine)
+            except SQLAlchemyError as err:
+                # e.g. a unique index over rows that were duplicated before it existed
+                logger.error(f"Unable to create index {index.name} on {table.name}, lookups will be slow until it is created: {err}")
+            else:
+                logger.info(f"Created index {index.name} on {table.name}")
@@ -0,0 +1,132 @@
+import asyncio
+import hashlib
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select
+
+from database import insert
+from models import Shard, ShardChannel, TelegramChannel
+
+# pylint: disable=missing-class-docstring, missing-function-docstring, invalid-name
+
+logger = logging.getLogger('bridge.shards')
+
+# Seconds without a heartbeat after which a shard counts as stopped and its chats move.
+HEARTBEAT_TIMEOUT = 60
+# A shard stopped for this long is taken as removed from the config and forgotten. One that comes back
+# after all records every chat it sees again on its first dialog sync, see sees_any().
+PRUNE_AFTER = timedelta(days=1)
+
+
+def _heartbeat(session, name, now):
+    session.execute(
+        insert(session, Shard)
+        .values(name=name, heartbeat=now)
+        .on_conflict_do_update(index_elements=["name"], set_={"heartbeat": now})
+    )
+
+def live_shards(session, now, timeout):
+    """Names of the shards that sent a heartbeat in the last `timeout` seconds."""
+    return set(session.execute(select(Shard.name).where(Shard.heartbeat >= now - timedelta(seconds=timeout))).scalars())
+
+def is_alive(session, name, timeout=HEARTBEAT_TIMEOUT):
+    return name in live_shards(session, datetime.utcnow(), timeout)
+
+def record_visible(session, name, chatids):
+    """Remember that the account of shard `name` can see the chats `chatids`."""
+    rows = [{"shard": name, "channelid": chatid} for chatid in set(chatids)]
+    if rows:
+        session.execute(insert(session, ShardChannel).on_conflict_do_nothing(), rows)
+
+def sees_any(session, name):
+    """Whether any chats are recorded for shard `name`, none are for a new or a pruned shard."""
+    return session.execute(select(ShardChannel.channelid).where(ShardChannel.shard == name).limit(1)).first() is not None
+
+def _rank(shard, chatid):
+    return hashlib.sha1(f"{shard}:{chatid}".encode()).digest()
+
+def assign(visible, pinned, live):
+    """
+    Pick the shard that ingests every chat.
+
+    `visible` maps chat ids to the shards that can see them and `pinned` chat ids to the shard
+    they were assigned to by hand. Pinned chats go to their shard while it is alive, the rest are
+    spread over the live shards that can see them by rendezvous hashing, so a shard joining or
+    leaving only moves the chats it gains or loses.
+    """
+    owners = {}
+    for chatid, shards in visible.items():
+        if pinned.get(chatid) in live:
+            owners[chatid] = pinned[chatid]
+            continue
+
+        candidates = [shard for shard in shards if shard in live]
+        if candidates:
+            owners[chatid] = max(candidates, key=lambda shard, chatid=chatid: _rank(shard, chatid))
+
+    return owners
+
+def prune(session, now):
+    """Forget the shards that haven't sent a heartbeat for PRUNE_AFTER and the chats they could see."""
+    removed = select(Shard.name).where(Shard.heartbeat < now - PRUNE_AFTER)
+    pruned = session.execute(delete(ShardChannel).where(ShardChannel.shard.in_(removed)).execution_options(synchronize_session=False)).rowcount
+    if pruned:
+        logger.info(f'Forgot {pruned} chats of shards without a heartbeat since {now - PRUNE_AFTER}')
+    session.execute(delete(Shard).where(Shard.heartbeat < now - PRUNE_AFTER).execution_options(synchronize_session=False))
+
+def _sync(session, name, now, timeout):
+    _heartbeat(session, name, now)
+    prune(session, now)
+    live = live_shards(session, now, timeout) | {name}
+
+    visible = defaultdict(list)
+    for shard, chatid in session.execute(select(ShardChannel.shard, ShardChannel.channelid)):
+        visible[chatid].append(shard)
+    pinned = dict(session.execute(select(TelegramChannel.id, TelegramChannel.shard).where(TelegramChannel.shard.isnot(None))).all())
+
+    return live, assign(visible, pinned, live)
+
+
+class ShardCoordinator:
+    """
+    Decides which shard (Telegram account) ingests each chat.
+
+    Every shard heartbeats into the shard table and records the chats its account can see. The
+    assignment is recomputed from those on every heartbeat, so when a shard stops its chats move to
+    the other shards that can see them once its heartbeat times out. The message ledger claim stays
+    the final word on which shard delivers a message.
+    """
+
+    def __init__(self, sqlexec, name, interval=15, timeout=HEARTBEAT_TIMEOUT):
+        self.sqlexec = sqlexec
+        self.name = name
+        self.interval = interval
+        self.timeout = timeout
+        self.live = set()
+        self._owners = {}
+
+    def owns(self, chat_id):
+        """Whether this shard ingests `chat_id`. Chats no shard has reported seeing yet are ingested by everyone who sees them."""
+        return self._owners.get(int(chat_id), self.name) == self.name
+
+    async def refresh(self):
+        live, owners = await self.sqlexec.run(_sync, self.name, datetime.utcnow(), self.timeout)
+        if live != self.live:
+            logger.info(f'Live shards: {", ".join(sorted(live))}')
+        self.live, self._owners = live, owners
+
+    async def record_visible(self, chatids):
+        await self.sqlexec.run(record_visible, self.name, list(chatids))
+
+    async def sees_any(self):
+        return await self.sqlexec.run(sees_any, self.name)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refresh()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Unable to update the shard assignment, keeping the previous one')
@@ -0,0 +1,483 @@
+import asyncio
+import hashlib
+import hmac
+import io
+import logging
+import mimetypes
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import quote, urlsplit
+from xml.sax.saxutils import escape
+
+import b2sdk.exception
+import yarl
+from b2sdk.v2 import InMemoryAccountInfo, B2Api
+
+from httpclient import ClientPool
+
+# pylint: disable=missing-class-docstring, missing-function-docstring, invalid-name
+
+logger = logging.getLogger('bridge.storage')
+
+# Smallest part of a B2 large file but the last, in bytes.
+MIN_PART_SIZE = 5 * 1000 * 1000
+# Tries at uploading one part of a B2 large file.
+PART_ATTEMPTS = 3
+
+# The process umask, which can only be read by setting it. Read once at import, before any threads write files.
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def slash_join(*args):
+    '''
+    Joins a set of strings with a slash (/) between them. Useful for creating URLs.
+    If the strings already have a trailing or leading slash, it is ignored, as are empty strings and None.
+    Note that the python's urllib.parse.urljoin() does not offer this functionality.
+
+    https://codereview.stackexchange.com/questions/175421/joining-strings-to-form-a-url
+    '''
+    return "/".join(arg.strip("/") for arg in args if arg)
+
+
+class AsyncStreamReader:
+    """
+    Blocking file-like view of an async iterator of bytes, for libraries reading from a worker thread.
+
+    Chunks are pulled from the event loop only as they are read, so a slow upload slows the
+    download down instead of buffering the whole file in memory.
+    """
+
+    def __init__(self, chunks, loop):
+        self._chunks = chunks.__aiter__()
+        self._loop = loop
+        self._buffer = bytearray()
+        self._done = False
+
+    def _next(self):
+        try:
+            return asyncio.run_coroutine_threadsafe(self._chunks.__anext__(), self._loop).result()
+        except StopAsyncIteration:
+            return None
+
+    def read(self, size=-1):
+        while not self._done and (size is None or size < 0 or len(self._buffer) < size):
+            chunk = self._next()
+            if chunk is None:
+                self._done = True
+            else:
+                self._buffer.extend(chunk)
+
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+class StorageError(Exception):
+    """A storage backend refused a request."""
+
+
+async def _chunks(data):
+    """Async iterator of bytes over `data`, which is either bytes or an async iterator of bytes already."""
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        yield bytes(data)
+        return
+
+    async for chunk in data:
+        yield chunk
+
+async def _read_file(path, size=1024 * 1024):
+    loop = asyncio.get_running_loop()
+    with open(path, "rb") as f:
+        while True:
+            chunk = await loop.run_in_executor(None, f.read, size)
+            if not chunk:
+                return
+            yield chunk
+
+
+class Storage:
+    """
+    Interface of the backends media is stored in and served from, see BACKENDS.
+
+    Files are named by the bridge and data is bytes or an async iterator of bytes. Backends keep
+    their connections open between calls and can be called concurrently, the batch operations
+    run their files at the same time.
+    """
+
+    async def url_for(self, filename):
+        """Public URL of `filename`, whether it is stored or not."""
+        raise NotImplementedError
+
+    async def exists(self, filename):
+        raise NotImplementedError
+
+    async def put(self, filename, data):
+        """Store `data` as `filename`, replacing it if it exists, and return its public URL."""
+        raise NotImplementedError
+
+    async def upload(self, local_file, filename):
+        """Store the file at `local_file` as `filename` and return its public URL. The local file may be moved."""
+        return await self.put(filename, _read_file(local_file))
+
+    async def exists_many(self, filenames):
+        return list(await asyncio.gather(*(self.exists(filename) for filename in filenames)))
+
+    async def put_many(self, files):
+        """Store every (filename, data) of `files` and return their public URLs in the same order."""
+        return list(await asyncio.gather(*(self.put(filename, data) for filename, data in files)))
+
+    async def close(self):
+        pass
+
+
+class LocalStorage(Storage):
+    """Files served from a local directory, e.g. by the web server in front of `url_prefix`."""
+
+    def __init__(self, config):
+        self.config = config
+
+    def _path(self, filename):
+        return os.path.join(self.config.file_prefix, filename)
+
+    async def url_for(self, filename):
+        # {url_prefix}/{filename}
+        return slash_join(self.config.url_prefix, filename)
+
+    async def exists(self, filename):
+        return os.path.exists(self._path(filename))
+
+    async def upload(self, local_file, filename):
+        # A rename when both are on the same filesystem, copying can take a while for big files otherwise.
+        await asyncio.get_running_loop().run_in_executor(None, shutil.move, local_file, self._path(filename))
+        return await self.url_for(filename)
+
+    async def put(self, filename, data):
+        """
+        Write `data` to storage as `filename` and return its public URL.
+
+        The data goes to a temporary file next to the final one which is renamed into place once
+        complete, so the file is written once and a partial file is never served. Writes run on the
+        default executor so a slow disk doesn't stall the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        path = self._path(filename)
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".", suffix=".part")
+        try:
+            # mkstemp makes the file private, the web server serving it has to be able to read it
+            os.fchmod(fd, 0o666 & ~UMASK)
+            with os.fdopen(fd, "wb") as f:
+                async for chunk in _chunks(data):
+                    await loop.run_in_executor(None, f.write, chunk)
+            os.replace(temp, path)
+        except BaseException:
+            try:
+                os.remove(temp)
+            except FileNotFoundError:
+                pass
+            raise
+
+        return await self.url_for(filename)
+
+
+class B2Storage(Storage):
+    """
+    Long-lived Backblaze B2 client.
+
+    The account is authorized once and the bucket handle is kept, b2sdk re-authorizes on its own
+    when the token expires. b2sdk is blocking, so every call runs on a bounded thread pool instead
+    of the event loop. Streams bigger than one part are uploaded as a large file, `part_workers`
+    parts at a time on a pool of their own.
+    """
+
+    def __init__(self, config, api_config=None):
+        self.config = config
+        # Pass e.g. B2HttpApiConfig(_raw_api_class=RawSimulator), or point config.realm at a
+        # local server, to run against a stand-in for the B2 API.
+        self.api_config = api_config
+        self._executor = ThreadPoolExecutor(max_workers=config.upload_workers, thread_name_prefix='b2')
+        self._parts = ThreadPoolExecutor(max_workers=config.upload_workers * config.part_workers, thread_name_prefix='b2-part')
+        self._lock = threading.Lock()
+        self._api = None
+        self._bucket = None
+
+    def _get_bucket(self):
+        with self._lock:
+            if self._bucket is None:
+                kwargs = {'max_upload_workers': self.config.part_workers}
+                if self.api_config is not None:
+                    kwargs['api_config'] = self.api_config
+
+                api = B2Api(InMemoryAccountInfo(), **kwargs)
+                api.authorize_account(self.config.realm, self.config.api_id, self.config.api_key)
+
+                if self.config.bucket_name:
+                    bucket = api.get_bucket_by_name(self.config.bucket_name)
+                else:
+                    bucket = api.get_bucket_by_id(self.config.bucket_id)
+
+                logger.debug(f'Authorized with B2 Backblaze using bucket {bucket.name}')
+                self._api, self._bucket = api, bucket
+
+            return self._bucket
+
+    def _url_for(self, filename):
+        # {url_prefix}/file/{bucket.name}/{file_prefix}/{filename}
+        return slash_join(self.config.url_prefix, "/file/"+self._get_bucket().name, self.config.file_prefix, filename)
+
+    async def url_for(self, filename):
+        if self._bucket is None:
+            # only the first call authorizes, it isn't queued behind uploads after that
+            return await asyncio.get_running_loop().run_in_executor(self._executor, self._url_for, filename)
+        return self._url_for(filename)
+
+    def _exists(self, filename):
+        try:
+            self._get_bucket().get_file_info_by_name(slash_join(self.config.file_prefix, filename))
+        except b2sdk.exception.FileNotPresent:
+            return False
+        return True
+
+    async def exists(self, filename):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._exists, filename)
+
+    def _upload(self, local_file, filename):
+        if self._exists(filename):
+            logger.debug(f"File \"{filename}\" already exists on B2 Backblaze.")
+        else:
+            self._get_bucket().upload_local_file(local_file=local_file, file_name=slash_join(self.config.file_prefix, filename))
+        return self._url_for(filename)
+
+    async def upload(self, local_file, filename):
+        """Upload `local_file` as `filename` unless it already exists, and return its public URL."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._upload, local_file, filename)
+
+    def _put_bytes(self, data, filename):
+        self._get_bucket().upload_bytes(data, slash_join(self.config.file_prefix, filename))
+        return self._url_for(filename)
+
+    def _put_part(self, fileid, number, part):
+        sha1 = hashlib.sha1(part).hexdigest()
+        for attempt in range(PART_ATTEMPTS):
+            try:
+                self._api.session.upload_part(fileid, number, len(part), sha1, io.BytesIO(part))
+                return sha1
+            except (b2sdk.exception.B2ConnectionError, b2sdk.exception.ServiceError):
+                if attempt == PART_ATTEMPTS - 1:
+                    raise
+                time.sleep(2 ** attempt)  # B2 asks for a new upload URL after a busy one, b2sdk gets one per attempt
+
+    def _put_stream(self, reader, filename):
+        bucket = self._get_bucket()
+        name = slash_join(self.config.file_prefix, filename)
+        part_size = max(self.config.stream_buffer_size, MIN_PART_SIZE)
+
+        # Small files go up in one request, anything bigger than a part as a large file whose parts
+        # are uploaded while the next one is still being downloaded.
+        part = reader.read(part_size)
+        if len(part) < part_size:
+            bucket.upload_bytes(part, name)
+            return self._url_for(filename)
+
+        session = self._api.session
+        fileid = session.start_large_file(bucket.id_, name, 'b2/x-auto', {})['fileId']
+        window, sha1s = deque(), []
+        try:
+            number = 0
+            while part:
+                number += 1
+                window.append(self._parts.submit(self._put_part, fileid, number, part))
+                if len(window) >= self.config.part_workers:
+                    sha1s.append(window.popleft().result())
+                part = reader.read(part_size)
+            while window:
+                sha1s.append(window.popleft().result())
+            session.finish_large_file(fileid, sha1s)
+        except BaseException:
+            for upload in window:
+                upload.cancel()
+            try:
+                session.cancel_large_file(fileid)
+            except b2sdk.exception.B2Error:
+                logger.warning(f"Unable to cancel the large file upload of {filename}, B2 keeps its parts until it is cancelled", exc_info=True)
+            raise
+
+        return self._url_for(filename)
+
+    async def put(self, filename, data):
+        """Upload `data` as `filename`, streams while they are being read, and return its public URL."""
+        loop = asyncio.get_running_loop()
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            return await loop.run_in_executor(self._executor, self._put_bytes, bytes(data), filename)
+        return await loop.run_in_executor(self._executor, self._put_stream, AsyncStreamReader(data, loop), filename)
+
+    async def close(self):
+        self._executor.shutdown(wait=False)
+        self._parts.shutdown(wait=False)
+
+
+def sign(method, url, headers, access_key, secret_key, region, now=None):
+    """
+    Headers of an S3 request to `url` signed with AWS Signature Version 4, `url` has to be encoded
+    with its query in canonical order already. The payload is left unsigned, as S3 allows.
+    """
+    now = now or datetime.now(timezone.utc)
+    parts = urlsplit(url)
+    headers = {name.lower(): str(value).strip() for name, value in headers.items()}
+    headers.update({'host': parts.netloc, 'x-amz-date': f"{now:%Y%m%dT%H%M%SZ}", 'x-amz-content-sha256': 'UNSIGNED-PAYLOAD'})
+
+    names = sorted(headers)
+    signed = ';'.join(names)
+    canonical = '\n'.join([method, parts.path or '/', parts.query, ''.join(f'{name}:{headers[name]}\n' for name in names), signed, 'UNSIGNED-PAYLOAD'])
+    scope = f"{now:%Y%m%d}/{region}/s3/aws4_request"
+    tosign = '\n'.join(['AWS4-HMAC-SHA256', headers['x-amz-date'], scope, hashlib.sha256(canonical.encode()).hexdigest()])
+
+    key = f"AWS4{secret_key}".encode()
+    for part in (f"{now:%Y%m%d}", region, 's3', 'aws4_request'):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    signature = hmac.new(key, tosign.encode(), hashlib.sha256).hexdigest()
+
+    headers['authorization'] = f"AWS4-HMAC-SHA256 Credential={access_key}/{scope}, SignedHeaders={signed}, Signature={signature}"
+    return headers
+
+def _xml_value(body, tag):
+    match = re.search(rf"<{tag}>([^<]*)</{tag}>".encode(), body)
+    return match.group(1).decode() if match else None
+
+
+class S3Storage(Storage):
+    """
+    S3 compatible object storage, e.g. AWS S3, MinIO, Cloudflare R2 or Backblaze B2's S3 API.
+
+    Requests go over one pooled HTTP session for the whole process, so connections are kept alive
+    between uploads and up to `connections` requests run at once. Data bigger than one part is
+    sent as a multipart upload whose parts are uploaded while the next ones are still being read.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        # a pool of its own, uploads have other connection limits and timeouts than webhooks
+        self._pool = ClientPool(config.connections, config.timeout)
+
+    async def close(self):
+        await self._pool.close()
+
+    def _bucket_url(self):
+        if self.config.virtual_host:
+            parts = urlsplit(self.config.endpoint_url)
+            return f"{parts.scheme}://{self.config.bucket_name}.{parts.netloc}"
+        return slash_join(self.config.endpoint_url, self.config.bucket_name)
+
+    def _key(self, filename):
+        return slash_join(self.config.file_prefix, filename)
+
+    async def url_for(self, filename):
+        # {url_prefix}/{file_prefix}/{filename}, the bucket under its endpoint unless url_prefix is set
+        return slash_join(self.config.url_prefix or self._bucket_url(), self.config.file_prefix, filename)
+
+    async def _request(self, method, filename, query=None, data=None, headers=None, allow=()):
+        """Make a signed request for the object `filename`, returns the response status, headers and body."""
+        url = slash_join(self._bucket_url(), quote(self._key(filename), safe="/-_.~"))
+        if query:
+            url += "?" + "&".join(f"{quote(name, safe='-_.~')}={quote(str(value), safe='-_.~')}" for name, value in sorted(query.items()))
+
+        headers = sign(method, url, headers or {}, self.config.access_key, self.config.secret_key, self.config.region)
+        async with self._pool.session.request(method, yarl.URL(url, encoded=True), data=data, headers=headers) as response:
+            body = await response.read()
+            if response.status >= 300 and response.status not in allow:
+                raise StorageError(f"S3 {method} of {filename} failed with {response.status}: {_xml_value(body, 'Message') or body[:200]!r}")
+            return response.status, response.headers, body
+
+    async def exists(self, filename):
+        status, _, _ = await self._request("HEAD", filename, allow=(404,))
+        return status != 404
+
+    async def put(self, filename, data):
+        headers = {'content-type': mimetypes.guess_type(filename)[0] or 'application/octet-stream'}
+        parts = self._parts(data).__aiter__()
+
+        first = await parts.__anext__()
+        try:
+            second = await parts.__anext__()
+        except StopAsyncIteration:
+            await self._request("PUT", filename, data=first, headers=headers)
+            return await self.url_for(filename)
+
+        _, _, body = await self._request("POST", filename, query={"uploads": ""}, headers=headers)
+        uploadid = _xml_value(body, "UploadId")
+        try:
+            etags = await self._put_parts(filename, uploadid, [first, second], parts)
+            complete = "".join(f"<Part><PartNumber>{number}</PartNumber><ETag>{escape(etag)}</ETag></Part>" for number, etag in enumerate(etags, 1))
+            _, _, body = await self._request("POST", filename, query={"uploadId": uploadid},
+                                             data=f"<CompleteMultipartUpload>{complete}</CompleteMultipartUpload>".encode())
+            if b"<Error>" in body:  # S3 can fail a completion after answering 200
+                raise StorageError(f"S3 multipart upload of {filename} failed: {_xml_value(body, 'Message')}")
+        except BaseException:
+            try:
+                await asyncio.shield(self._request("DELETE", filename, query={"uploadId": uploadid}, allow=(404,)))
+            except Exception:  # pylint: disable=broad-except
+                logger.warning(f"Unable to abort the multipart upload of {filename}, the bucket's lifecycle rules have to clean it up", exc_info=True)
+            raise
+
+        return await self.url_for(filename)
+
+    async def _parts(self, data):
+        """`data` in parts of part_size bytes, the last one can be smaller. No data is one empty part."""
+        buffer, parts = bytearray(), 0
+        async for chunk in _chunks(data):
+            buffer.extend(chunk)
+            while len(buffer) >= self.config.part_size:
+                yield bytes(buffer[:self.config.part_size])
+                del buffer[:self.config.part_size]
+                parts += 1
+
+        if buffer or not parts:
+            yield bytes(buffer)
+
+    async def _put_parts(self, filename, uploadid, first, rest):
+        """Upload the parts, `part_workers` of them at a time, and return their ETags in order."""
+        async def put_part(number, part):
+            _, headers, _ = await self._request("PUT", filename, query={"partNumber": number, "uploadId": uploadid}, data=part)
+            return headers["ETag"]
+
+        async def numbered():
+            for part in first:
+                yield part
+            async for part in rest:
+                yield part
+
+        window, etags = deque(), []
+        try:
+            number = 0
+            async for part in numbered():
+                number += 1
+                window.append(asyncio.ensure_future(put_part(number, part)))
+                if len(window) >= self.config.part_workers:
+                    etags.append(await window.popleft())
+            while window:
+                etags.append(await window.popleft())
+        finally:
+            for upload in window:
+                upload.cancel()
+        return etags
+
+
+# Storage backends by the name StorageConfig.backend selects them with, its field of the same name configures them.
+BACKENDS = {
+    "local": LocalStorage,
+    "b2": B2Storage,
+    "s3": S3Storage,
+}
+
+def open_storage(config):
+    """The backend selected by the StorageConfig `config`."""
+    return BACKENDS[config.backend](getattr(config, config.backend))